@@ -0,0 +1,180 @@
+"""
+通用缓存工具
+"""
+import re
+import time
+import threading
+import unicodedata
+from collections import OrderedDict
+
+# 查询末尾的无意义标点（问号、句号等）不影响语义，归一化时去掉
+_TRAILING_PUNCT = "?？!！。.，,;；~～ "
+
+
+def normalize_query(text: str) -> str:
+    """
+    归一化查询文本，作为缓存键
+
+    全角/半角统一（NFKC）、转小写、合并空白、去掉末尾标点
+    """
+    text = unicodedata.normalize("NFKC", text or "")
+    text = re.sub(r"\s+", " ", text).strip().lower()
+    return text.rstrip(_TRAILING_PUNCT)
+
+
+class LRUCache:
+    """线程安全的 LRU 缓存，支持可选 TTL（秒）和命中率统计"""
+
+    def __init__(self, max_size: int = 1024, ttl: float = 0):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._data = OrderedDict()  # key -> (value, 写入时间)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                self.misses += 1
+                return default
+            value, stored_at = item
+            if self.ttl and time.monotonic() - stored_at > self.ttl:
+                del self._data[key]
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            self._data[key] = (value, time.monotonic())
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self) -> dict:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "size": len(self._data),
+                "max_size": self.max_size,
+                "ttl": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / total, 4) if total else 0.0,
+            }
+
+
+class SemanticCache:
+    """
+    按向量相似度命中的 LRU 缓存（线程安全，可选 TTL）
+
+    条目按精确的分组键（例如检索到的块ID + 模型名 + 索引版本）划分，
+    同组内查询向量的余弦相似度不低于阈值即视为命中，返回相似度最高的条目。
+    条目数较少（数百条），逐条比较即可，不需要向量索引。
+    """
+
+    def __init__(self, max_size: int = 500, ttl: float = 0, threshold: float = 0.95):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.threshold = threshold
+        self._data = OrderedDict()  # 条目ID -> (分组键, 单位向量, value, 写入时间)
+        self._next_id = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _unit(vector):
+        import numpy as np
+
+        vector = np.asarray(vector, dtype="float32").ravel()
+        norm = float(np.linalg.norm(vector))
+        return vector / norm if norm else None
+
+    def _best_match(self, unit, group_key):
+        """返回 (条目ID, 相似度)，调用方持有锁；顺带清除过期条目"""
+        now = time.monotonic()
+        best_id, best_score = None, self.threshold
+        for entry_id, (key, stored_vector, _, stored_at) in list(self._data.items()):
+            if self.ttl and now - stored_at > self.ttl:
+                del self._data[entry_id]
+                continue
+            if key != group_key or stored_vector.shape != unit.shape:
+                continue
+            score = float(stored_vector @ unit)
+            if score >= best_score:
+                best_id, best_score = entry_id, score
+        return best_id, best_score
+
+    def get(self, vector, group_key, default=None):
+        unit = self._unit(vector)
+        with self._lock:
+            entry_id = self._best_match(unit, group_key)[0] if unit is not None else None
+            if entry_id is None:
+                self.misses += 1
+                return default
+            self._data.move_to_end(entry_id)
+            self.hits += 1
+            return self._data[entry_id][2]
+
+    def set(self, vector, group_key, value):
+        """写入条目；同组内已有足够相似的条目时替换它，避免重复"""
+        if self.max_size <= 0:
+            return
+        unit = self._unit(vector)
+        if unit is None:
+            return
+        with self._lock:
+            entry_id = self._best_match(unit, group_key)[0]
+            if entry_id is None:
+                entry_id = self._next_id
+                self._next_id += 1
+            self._data[entry_id] = (group_key, unit, value, time.monotonic())
+            self._data.move_to_end(entry_id)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def purge(self, predicate) -> int:
+        """删除分组键满足 predicate 的条目，返回删除数"""
+        with self._lock:
+            stale = [entry_id for entry_id, (key, _, _, _) in self._data.items() if predicate(key)]
+            for entry_id in stale:
+                del self._data[entry_id]
+            return len(stale)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self) -> dict:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "size": len(self._data),
+                "max_size": self.max_size,
+                "ttl": self.ttl,
+                "threshold": self.threshold,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / total, 4) if total else 0.0,
+            }
@@ -0,0 +1,222 @@
+"""
+对话记忆：按 token 预算选取同一主题最近的对话轮次作为上下文，
+窗口之外更早的轮次在后台增量生成摘要，摘要按主题缓存（进程内 LRU）。
+"""
+import os
+import re
+import asyncio
+
+from database import get_async_db_connection
+from cache_utils import LRUCache
+from token_budget import (count_tokens, count_static_tokens, truncate_to_tokens, get_max_context,
+                          MESSAGE_OVERHEAD_TOKENS, SAFETY_TOKENS)
+
+CONVERSATION_MEMORY = os.getenv("CONVERSATION_MEMORY", "true").lower() in ("1", "true", "yes")
+HISTORY_TOKEN_BUDGET = int(os.getenv("HISTORY_TOKEN_BUDGET", 1500))       # 历史消息最多占用的 token
+HISTORY_FETCH_LIMIT = int(os.getenv("HISTORY_FETCH_LIMIT", 40))           # 每轮最多读取的最近消息数
+HISTORY_MESSAGE_MAX_TOKENS = int(os.getenv("HISTORY_MESSAGE_MAX_TOKENS", 600))  # 单条历史消息截断长度
+HISTORY_RESERVED_OUTPUT = int(os.getenv("HISTORY_RESERVED_OUTPUT", 500))  # 带历史时至少给回复保留的 token
+SUMMARY_MAX_TOKENS = int(os.getenv("SUMMARY_MAX_TOKENS", 300))
+SUMMARY_CACHE_SIZE = int(os.getenv("SUMMARY_CACHE_SIZE", 1000))
+SUMMARY_BATCH_SIZE = 40      # 每次摘要调用最多合并的消息数（同时受上下文长度限制）
+SUMMARY_MAX_BATCHES = 3      # 每次更新最多调用的次数，更早的内容不再计入
+
+SUMMARY_SYSTEM_PROMPT = "你是对话摘要助手。请用简洁的中文概括对话要点，保留关键事实、实体名称、用户的问题与结论，不要添加评论。"
+SUMMARY_PROMPT_TEMPLATE = """已有摘要：
+{summary}
+
+新增对话：
+{transcript}
+
+请将新增对话合并进已有摘要，输出更新后的完整摘要（不超过 {max_tokens} 个 token），只输出摘要正文。"""
+
+_THINK_RE = re.compile(r"<think>.*?</think>", re.S)
+
+# subjectid -> {"upto_id": 摘要覆盖到的最后一条消息ID, "summary": 摘要文本}
+_summary_cache = LRUCache(max_size=SUMMARY_CACHE_SIZE)
+_summary_updating = set()
+
+
+def history_budget(prompt_tokens: int) -> int:
+    """本轮提示词（系统提示词 + 用户消息）之外，上下文中还能留给历史消息的 token 数"""
+    available = get_max_context() - SAFETY_TOKENS - HISTORY_RESERVED_OUTPUT - prompt_tokens
+    return max(0, min(HISTORY_TOKEN_BUDGET, available))
+
+
+def _clean_content(row: dict) -> str:
+    """去掉模型回复中的思考过程，并截断过长的消息"""
+    content = row.get("content") or ""
+    if row.get("role") == "assistant":
+        content = _THINK_RE.sub("", content).strip()
+    return truncate_to_tokens(content, HISTORY_MESSAGE_MAX_TOKENS)
+
+
+async def _fetch_messages(subjectid: int, after_id: int = 0, upto_id: int = None, limit: int = HISTORY_FETCH_LIMIT):
+    """读取主题下 (after_id, upto_id] 范围内最新的 limit 条消息，按时间正序返回"""
+    sql = "SELECT id, role, content FROM chatcontent WHERE subjectid = %s AND id > %s"
+    params = [subjectid, after_id]
+    if upto_id is not None:
+        sql += " AND id <= %s"
+        params.append(upto_id)
+    sql += " ORDER BY id DESC LIMIT %s"
+    params.append(limit)
+    async with get_async_db_connection() as conn:
+        async with conn.cursor() as cursor:
+            await cursor.execute(sql, params)
+            rows = await cursor.fetchall()
+    return list(reversed(rows))
+
+
+def _select_window(rows: list, budget: int):
+    """从最新的消息往前选取，直到用完 token 预算；返回 (窗口内消息, 窗口外消息)"""
+    selected = []
+    used = 0
+    for index in range(len(rows) - 1, -1, -1):
+        row = rows[index]
+        content = _clean_content(row)
+        tokens = count_tokens(content) + MESSAGE_OVERHEAD_TOKENS
+        if used + tokens > budget:
+            return selected, rows[:index + 1]
+        selected.insert(0, {"id": row["id"], "role": row["role"], "content": content})
+        used += tokens
+    return selected, []
+
+
+async def build_conversation_context(subjectid: int, current_text: str, budget: int = None) -> dict:
+    """
+    构建当前轮次的对话上下文
+
+    Args:
+        subjectid: 主题ID
+        current_text: 本轮用户消息（路由已入库，这里从历史中排除）
+        budget: 历史消息（含摘要）可用的 token 数，默认 HISTORY_TOKEN_BUDGET
+
+    Returns:
+        {"summary": 摘要或 None, "messages": [{"role", "content"}], "tokens": 占用的 token 数}
+    """
+    empty = {"summary": None, "messages": [], "tokens": 0}
+    if not CONVERSATION_MEMORY or not subjectid:
+        return empty
+    budget = HISTORY_TOKEN_BUDGET if budget is None else min(budget, HISTORY_TOKEN_BUDGET)
+    if budget <= 0:
+        return empty
+
+    # 之前轮次尚在写入队列中的消息先入库（只有本轮用户消息待写入时不等待，反正要排除它）
+    from message_store import get_message_store
+    await get_message_store().sync_subject(subjectid, current_text)
+
+    entry = _summary_cache.get(subjectid) or {"upto_id": 0, "summary": None}
+    rows = await _fetch_messages(subjectid, after_id=entry["upto_id"], limit=HISTORY_FETCH_LIMIT + 1)
+    if rows and rows[-1]["role"] == "user" and rows[-1]["content"] == current_text:
+        rows = rows[:-1]
+    if not rows and not entry["summary"]:
+        return empty
+
+    # 分词计数是 CPU 计算，放到线程中执行，避免阻塞事件循环
+    summary, window, outside, tokens = await asyncio.to_thread(_fit_history, entry["summary"], rows, budget)
+
+    # 窗口之外还有未摘要的消息（或读取数量达到上限），后台更新摘要供后续轮次使用
+    if outside or len(rows) > HISTORY_FETCH_LIMIT:
+        upto_id = (window[0]["id"] - 1) if window else rows[-1]["id"]
+        schedule_summary_update(subjectid, upto_id)
+
+    messages = [{"role": m["role"], "content": m["content"]} for m in window]
+    return {"summary": summary, "messages": messages, "tokens": tokens}
+
+
+def _fit_history(summary: str, rows: list, budget: int):
+    """
+    在预算内放入摘要（最多占一半）和最近的消息
+
+    Returns:
+        (摘要, 窗口内消息, 窗口外消息, 占用的 token 数)
+    """
+    summary_tokens = count_tokens(summary) + MESSAGE_OVERHEAD_TOKENS if summary else 0
+    if summary_tokens > budget // 2:
+        summary = truncate_to_tokens(summary, budget // 2)
+        summary_tokens = count_tokens(summary) + MESSAGE_OVERHEAD_TOKENS
+    window, outside = _select_window(rows, budget - summary_tokens)
+    tokens = summary_tokens + sum(count_tokens(m["content"]) + MESSAGE_OVERHEAD_TOKENS for m in window)
+    return summary, window, outside, tokens
+
+
+def schedule_summary_update(subjectid: int, upto_id: int):
+    """在后台把 upto_id 及之前的消息合并进主题摘要（同一主题同时只有一个更新）"""
+    if subjectid in _summary_updating:
+        return
+    entry = _summary_cache.get(subjectid)
+    if entry and entry["upto_id"] >= upto_id:
+        return
+    from llm_utils import spawn_background_task
+    _summary_updating.add(subjectid)
+    spawn_background_task(_update_summary(subjectid, upto_id))
+
+
+async def _update_summary(subjectid: int, upto_id: int):
+    from llm_utils import async_llm
+
+    try:
+        entry = _summary_cache.get(subjectid) or {"upto_id": 0, "summary": None}
+        # 只摘要最近的 SUMMARY_BATCH_SIZE * SUMMARY_MAX_BATCHES 条，避免长历史首次摘要调用过多
+        rows = await _fetch_messages(subjectid, after_id=entry["upto_id"], upto_id=upto_id,
+                                     limit=SUMMARY_BATCH_SIZE * SUMMARY_MAX_BATCHES)
+        summary = entry["summary"]
+        start = 0
+        for _ in range(SUMMARY_MAX_BATCHES):
+            if start >= len(rows):
+                break
+            # 分词计数放到线程中执行，避免阻塞事件循环
+            prompt, count = await asyncio.to_thread(_summary_prompt, summary, rows[start:start + SUMMARY_BATCH_SIZE])
+            batch = rows[start:start + count]
+            start += count
+            summary = (await async_llm(prompt, use_rag=False, system_prompt=SUMMARY_SYSTEM_PROMPT,
+                                       max_tokens=SUMMARY_MAX_TOKENS)).strip()
+            summary = _THINK_RE.sub("", summary).strip()
+            entry = {"upto_id": batch[-1]["id"], "summary": summary}
+            _summary_cache.set(subjectid, entry)
+        if rows:
+            print(f"主题 {subjectid} 摘要已更新至消息 {entry['upto_id']}")
+    except Exception as e:
+        print(f"主题 {subjectid} 摘要更新失败: {e}")
+    finally:
+        _summary_updating.discard(subjectid)
+
+
+def _summary_prompt(summary: str, rows: list):
+    """
+    把尽可能多的消息放进一次摘要请求（已有摘要 + 新增对话 + 摘要输出都要放进模型上下文）
+
+    Returns:
+        (提示词, 使用的消息数)
+    """
+    transcript_budget = (get_max_context() - SAFETY_TOKENS - SUMMARY_MAX_TOKENS
+                         - count_static_tokens(SUMMARY_SYSTEM_PROMPT) - 2 * MESSAGE_OVERHEAD_TOKENS
+                         - count_tokens(SUMMARY_PROMPT_TEMPLATE.format(
+                               summary=summary or "（无）", transcript="", max_tokens=SUMMARY_MAX_TOKENS)))
+    lines = []
+    used = 0
+    for row in rows:
+        line = f"{'用户' if row['role'] == 'user' else '助手'}：{truncate_to_tokens(_clean_content(row), 300)}"
+        tokens = count_tokens(line) + 1
+        if lines and used + tokens > transcript_budget:
+            break
+        lines.append(truncate_to_tokens(line, transcript_budget) if not lines else line)
+        used += tokens
+    prompt = SUMMARY_PROMPT_TEMPLATE.format(
+        summary=summary or "（无）", transcript="\n".join(lines), max_tokens=SUMMARY_MAX_TOKENS
+    )
+    return prompt, len(lines)
+
+
+def forget_subject(subjectid: int):
+    """删除主题时清除摘要缓存"""
+    _summary_cache.delete(subjectid)
+
+
+def get_memory_stats() -> dict:
+    return {
+        "enabled": CONVERSATION_MEMORY,
+        "history_token_budget": HISTORY_TOKEN_BUDGET,
+        "summary_cache": _summary_cache.stats(),
+        "summaries_updating": len(_summary_updating),
+    }
@@ -1,68 +1,404 @@
 import os
+import time
+import threading
+from collections import deque
 import pymysql
 from pymysql import Error
+from pymysql.constants import SERVER_STATUS
 from dotenv import load_dotenv
-from contextlib import contextmanager
+from contextlib import contextmanager, asynccontextmanager
 
 
 # 加载环境变量
 load_dotenv()
 
-# 创建数据库连接,使用上下文管理器
+# 物理连接建立时执行一次的会话设置
+_SESSION_INIT_SQL = (
+    "SET NAMES utf8mb4 COLLATE utf8mb4_unicode_ci, "
+    "SESSION wait_timeout = 28800, "
+    "SESSION interactive_timeout = 28800"
+)
+
+
+class ConnectionPool:
+    """
+    有界 MySQL 连接池（线程安全）
+
+    - 物理连接数量限制在 [min_size, max_size] 之间
+    - 借出前检查连接是否可用（空闲超过 ping_interval 才发送 ping）
+    - 空闲超过 recycle 秒的连接直接关闭重建
+    - 字符集/会话超时等设置只在物理连接创建时执行一次
+    """
+
+    def __init__(self, min_size: int = 1, max_size: int = 10, recycle: int = 3600,
+                 ping_interval: int = 30, acquire_timeout: int = 30):
+        if max_size < 1:
+            raise ValueError("max_size 必须大于 0")
+        self.min_size = max(0, min(min_size, max_size))
+        self.max_size = max_size
+        self.recycle = recycle
+        self.ping_interval = ping_interval
+        self.acquire_timeout = acquire_timeout
+
+        self._idle = deque()  # (connection, 最近归还时间)
+        self._size = 0        # 当前物理连接数（空闲 + 借出）
+        self._cond = threading.Condition()
+        self._prefilled = False
+
+        # 统计信息
+        self._created = 0
+        self._reused = 0
+        self._recycled = 0
+
+    def _create_connection(self):
+        """创建新的物理连接，并执行一次性会话设置"""
+        connection = pymysql.connect(
+            host=os.getenv("DB_HOST", "localhost"),
+            user=os.getenv("DB_USER"),
+            port=int(os.getenv("DB_PORT", 3306)),
+            password=os.getenv("DB_PASSWORD"),
+            database=os.getenv("DB_NAME"),
+            charset="utf8mb4",
+            cursorclass=pymysql.cursors.DictCursor,
+            autocommit=False,
+            connect_timeout=30,  # 增加连接超时时间
+            read_timeout=30,     # 增加读取超时时间
+            write_timeout=30,    # 增加写入超时时间
+        )
+        # 强制设置本连接使用 utf8mb4，避免 1366 错误（每个物理连接只执行一次）
+        try:
+            with connection.cursor() as _c:
+                _c.execute(_SESSION_INIT_SQL)
+        except Exception as _:
+            pass
+        with self._cond:
+            self._created += 1
+        print("成功连接到MySQL数据库")
+        return connection
+
+    @staticmethod
+    def _close_quietly(connection):
+        try:
+            connection.close()
+        except Exception:
+            pass
+
+    def _prefill(self):
+        """首次使用时预建 min_size 个连接（在锁外调用）"""
+        for _ in range(self.min_size):
+            with self._cond:
+                if self._size >= self.min_size:
+                    return
+                self._size += 1
+            try:
+                connection = self._create_connection()
+            except Exception as e:
+                with self._cond:
+                    self._size -= 1
+                print(f"连接池预热失败: {e}")
+                return
+            with self._cond:
+                self._idle.append((connection, time.monotonic()))
+                self._cond.notify()
+
+    def _is_usable(self, connection, idle_for: float) -> bool:
+        """借出前检查连接：已关闭、空闲过久或 ping 失败的连接不可用"""
+        if not connection.open:
+            return False
+        if self.recycle and idle_for > self.recycle:
+            with self._cond:
+                self._recycled += 1
+            return False
+        if idle_for > self.ping_interval:
+            try:
+                connection.ping(reconnect=False)
+            except Exception:
+                return False
+        return True
+
+    def acquire(self):
+        """借出一个可用连接，池满时最多等待 acquire_timeout 秒"""
+        with self._cond:
+            prefill = not self._prefilled
+            self._prefilled = True
+        if prefill:
+            self._prefill()
+
+        deadline = time.monotonic() + self.acquire_timeout
+        while True:
+            with self._cond:
+                while not self._idle and self._size >= self.max_size:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise TimeoutError(f"获取数据库连接超时（连接池已满: {self.max_size}）")
+                    self._cond.wait(remaining)
+
+                if self._idle:
+                    # 后进先出，优先复用最近使用的热连接
+                    connection, released_at = self._idle.pop()
+                    create_new = False
+                else:
+                    self._size += 1
+                    create_new = True
+
+            if create_new:
+                try:
+                    return self._create_connection()
+                except Exception:
+                    self._discard()
+                    raise
+
+            if self._is_usable(connection, time.monotonic() - released_at):
+                with self._cond:
+                    self._reused += 1
+                return connection
+
+            # 连接失效：关闭后继续循环获取/新建
+            self._close_quietly(connection)
+            self._discard()
+
+    def _discard(self):
+        """物理连接数减一，并唤醒等待者"""
+        with self._cond:
+            self._size -= 1
+            self._cond.notify()
+
+    def release(self, connection, broken: bool = False):
+        """归还连接；未结束的事务会被回滚，保证下个使用者拿到干净的会话"""
+        if not broken and connection.open:
+            try:
+                if connection.server_status & SERVER_STATUS.SERVER_STATUS_IN_TRANS:
+                    connection.rollback()
+            except Exception:
+                broken = True
+        else:
+            broken = True
+
+        if broken:
+            self._close_quietly(connection)
+            self._discard()
+            return
+
+        with self._cond:
+            self._idle.append((connection, time.monotonic()))
+            self._cond.notify()
+
+    def close(self):
+        """关闭所有空闲连接（借出中的连接归还时仍会正常处理）"""
+        with self._cond:
+            idle = list(self._idle)
+            self._idle.clear()
+            self._size -= len(idle)
+            self._prefilled = False
+            self._cond.notify_all()
+        for connection, _ in idle:
+            self._close_quietly(connection)
+
+    def status(self) -> dict:
+        """连接池状态"""
+        with self._cond:
+            return {
+                "min_size": self.min_size,
+                "max_size": self.max_size,
+                "size": self._size,
+                "idle": len(self._idle),
+                "in_use": self._size - len(self._idle),
+                "created": self._created,
+                "reused": self._reused,
+                "recycled": self._recycled,
+            }
+
+
+def pool_budget() -> dict:
+    """
+    每个进程的 MySQL 连接预算
+
+    DB_POOL_MAX_SIZE 是每个 worker 进程的连接总数上限，由同步连接池（pymysql）和
+    异步连接池（aiomysql）共同分配：异步池占 DB_ASYNC_POOL_MAX_SIZE（默认一半），
+    其余给同步池，两者各至少 1 个。整个服务的连接数上限为 worker 数 × DB_POOL_MAX_SIZE。
+    """
+    total = max(2, int(os.getenv("DB_POOL_MAX_SIZE", 10)))
+    async_max = int(os.getenv("DB_ASYNC_POOL_MAX_SIZE", 0)) or (total + 1) // 2
+    async_max = min(max(1, async_max), total - 1)
+    sync_max = total - async_max
+    min_size = int(os.getenv("DB_POOL_MIN_SIZE", 1))
+    return {
+        "total": total,
+        "sync_max": sync_max,
+        "sync_min": min(min_size, sync_max),
+        "async_max": async_max,
+        "async_min": min(min_size, async_max),
+    }
+
+
+# 全局连接池实例（延迟创建）
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool() -> ConnectionPool:
+    """获取全局连接池实例"""
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                budget = pool_budget()
+                _pool = ConnectionPool(
+                    min_size=budget["sync_min"],
+                    max_size=budget["sync_max"],
+                    recycle=int(os.getenv("DB_POOL_RECYCLE", 3600)),
+                    ping_interval=int(os.getenv("DB_POOL_PING_INTERVAL", 30)),
+                    acquire_timeout=int(os.getenv("DB_POOL_TIMEOUT", 30)),
+                )
+    return _pool
+
+
+def close_pool():
+    """关闭全局连接池（进程退出时调用）"""
+    if _pool is not None:
+        _pool.close()
+
+
+# 获取数据库连接,使用上下文管理器（连接来自连接池，用完归还）
 @contextmanager
 def get_db_connection():
+    pool = get_pool()
     connection = None
     max_retries = 3
     retry_count = 0
-    
-    while retry_count < max_retries:
+
+    while connection is None:
+        try:
+            connection = pool.acquire()
+        except Exception as e:
+            retry_count += 1
+            print(f"数据库连接错误 (尝试 {retry_count}/{max_retries}): {e}")
+            if retry_count >= max_retries:
+                print(f"数据库连接失败，已重试 {max_retries} 次")
+                raise
+            time.sleep(1)  # 等待1秒后重试
+
+    broken = False
+    try:
+        yield connection
+    except Exception as e:
+        # 出错时回滚；连接层面的错误说明连接已不可复用
+        broken = isinstance(e, (pymysql.err.OperationalError, pymysql.err.InterfaceError))
         try:
-            connection = pymysql.connect(
+            connection.rollback()
+        except Exception:
+            broken = True
+        raise
+    finally:
+        pool.release(connection, broken=broken)
+
+
+# ---------------------------------------------------------------------------
+# 异步数据库层（aiomysql），供 async 路由使用，避免阻塞事件循环
+# ---------------------------------------------------------------------------
+_async_pool = None
+_async_pool_lock = None
+
+
+async def get_async_pool():
+    """获取全局异步连接池（首次调用时创建）"""
+    global _async_pool, _async_pool_lock
+    if _async_pool is not None:
+        return _async_pool
+
+    import asyncio
+    if _async_pool_lock is None:
+        _async_pool_lock = asyncio.Lock()
+    async with _async_pool_lock:
+        if _async_pool is None:
+            import aiomysql  # 按需导入，同步代码路径不依赖 aiomysql
+            budget = pool_budget()
+            _async_pool = await aiomysql.create_pool(
                 host=os.getenv("DB_HOST", "localhost"),
                 user=os.getenv("DB_USER"),
                 port=int(os.getenv("DB_PORT", 3306)),
                 password=os.getenv("DB_PASSWORD"),
-                database=os.getenv("DB_NAME"),
+                db=os.getenv("DB_NAME"),
                 charset="utf8mb4",
-                cursorclass=pymysql.cursors.DictCursor,
+                cursorclass=aiomysql.DictCursor,
                 autocommit=False,
-                connect_timeout=30,  # 增加连接超时时间
-                read_timeout=30,     # 增加读取超时时间
-                write_timeout=30,    # 增加写入超时时间
-                # 移除不兼容的参数
+                connect_timeout=30,
+                init_command=_SESSION_INIT_SQL,
+                minsize=budget["async_min"],
+                maxsize=budget["async_max"],
+                pool_recycle=int(os.getenv("DB_POOL_RECYCLE", 3600)),
             )
-            # 强制设置本次连接使用 utf8mb4，避免 1366 错误
+            print("异步MySQL连接池已创建")
+    return _async_pool
+
+
+async def close_async_pool():
+    """关闭全局异步连接池"""
+    global _async_pool
+    if _async_pool is not None:
+        _async_pool.close()
+        await _async_pool.wait_closed()
+        _async_pool = None
+
+
+_table_columns = {}
+
+
+async def get_table_columns(table: str) -> set:
+    """表的列名（每个表只查询一次，执行迁移后需重启服务），用于兼容尚未执行迁移的数据库"""
+    columns = _table_columns.get(table)
+    if columns is None:
+        async with get_async_db_connection() as conn:
+            async with conn.cursor() as cursor:
+                await cursor.execute(
+                    "SELECT COLUMN_NAME FROM information_schema.COLUMNS "
+                    "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s",
+                    (table,)
+                )
+                rows = await cursor.fetchall()
+        columns = _table_columns[table] = {row["COLUMN_NAME"] for row in rows}
+    return columns
+
+
+# 迁移文件 → 它添加的列；缺少这些列的数据库按旧表结构运行（相关功能退化）
+SCHEMA_MIGRATIONS = {
+    "002_stream_checkpoints.sql": ("chatcontent", {"status", "stream_id", "updated_at"}),
+    "003_message_wal_id.sql": ("chatcontent", {"wal_id"}),
+}
+
+
+async def has_columns(migration: str) -> bool:
+    """数据库是否已执行该迁移（按它添加的列判断）"""
+    table, columns = SCHEMA_MIGRATIONS[migration]
+    return columns <= await get_table_columns(table)
+
+
+async def check_schema() -> list:
+    """返回尚未执行的迁移文件名，启动时调用"""
+    return [name for name in SCHEMA_MIGRATIONS if not await has_columns(name)]
+
+
+# 获取异步数据库连接,使用异步上下文管理器
+@asynccontextmanager
+async def get_async_db_connection():
+    pool = await get_async_pool()
+    connection = await pool.acquire()
+    try:
+        yield connection
+    except Exception:
+        try:
+            await connection.rollback()
+        except Exception:
+            connection.close()
+        raise
+    finally:
+        # 未结束的事务回滚后再归还，避免下个使用者读到旧快照
+        if not connection.closed and connection.get_transaction_status():
             try:
-                with connection.cursor() as _c:
-                    _c.execute("SET NAMES utf8mb4")
-                    _c.execute("SET character_set_connection = utf8mb4")
-                    _c.execute("SET collation_connection = utf8mb4_unicode_ci")
-                    # 设置会话超时
-                    _c.execute("SET SESSION wait_timeout = 28800")
-                    _c.execute("SET SESSION interactive_timeout = 28800")
-            except Exception as _:
-                pass
-            print("成功连接到MySQL数据库")
-            yield connection
-            break  # 成功连接，跳出重试循环
-            
-        except Exception as e:
-            retry_count += 1
-            print(f"数据库连接错误 (尝试 {retry_count}/{max_retries}): {e}")
-            if connection:
-                try:
-                    connection.rollback()
-                    connection.close()
-                except:
-                    pass
-                connection = None
-            
-            if retry_count >= max_retries:
-                print(f"数据库连接失败，已重试 {max_retries} 次")
-                raise
-            else:
-                import time
-                time.sleep(1)  # 等待1秒后重试
+                await connection.rollback()
+            except Exception:
+                connection.close()
+        pool.release(connection)
 
 
 # 测试连接
@@ -72,5 +408,6 @@ if __name__ == "__main__":
             with conn.cursor() as cursor:
                 cursor.execute("SELECT 1")
                 print("数据库可访问:", cursor.fetchone())
+        print("连接池状态:", get_pool().status())
     except Exception as e:
-        print("测试失败:", e)
\ No newline at end of file
+        print("测试失败:", e)
@@ -0,0 +1,449 @@
+"""
+共享嵌入服务：单独进程持有嵌入模型，通过 UNIX socket 为各 uvicorn worker 计算向量
+
+EMBED_SERVER 开启时，RAGService 不再在每个 worker 中加载模型，而是使用 EmbedServerClient
+（接口与 HuggingFaceEmbeddings 相同）。服务端把各 worker 并发的查询向量请求放入队列，
+在 EMBED_SERVER_MAX_WAIT_MS 的等待窗口内凑成一批（最多 EMBED_SERVER_MAX_BATCH 条）一次推理；
+推理进行时到达的请求自动进入下一批。批量向量化（构建索引）的请求不经过队列，拆成每块
+EMBED_SERVER_MAX_BATCH 条依次提交到同一个推理线程，查询批次可以插在两块之间，不必等整个请求算完。
+
+服务未运行时，第一个 worker 自动启动它（EMBED_SERVER_AUTOSTART，文件锁保证只启动一个），
+也可以手动运行：
+    python embed_server.py [--socket /tmp/rag-embed.sock]
+
+协议：每帧为 4 字节长度（网络字节序）+ 内容。请求为 JSON（op: info / embed / stats），
+响应为 JSON 头部；embed 成功时再跟一帧 float32 向量数据（本机字节序）。
+"""
+import os
+import sys
+import json
+import time
+import socket
+import struct
+import tempfile
+import threading
+from array import array
+from typing import List
+
+from dotenv import load_dotenv
+
+try:
+    from langchain_core.embeddings import Embeddings
+except ImportError:  # 旧版 langchain
+    try:
+        from langchain.embeddings.base import Embeddings
+    except ImportError:
+        Embeddings = object
+
+load_dotenv()
+
+EMBED_SERVER = os.getenv("EMBED_SERVER", "false").lower() in ("1", "true", "yes")
+EMBED_SERVER_SOCKET = os.getenv("EMBED_SERVER_SOCKET") or os.path.join(tempfile.gettempdir(), "rag-embed.sock")
+EMBED_SERVER_AUTOSTART = os.getenv("EMBED_SERVER_AUTOSTART", "true").lower() in ("1", "true", "yes")
+EMBED_SERVER_MAX_BATCH = int(os.getenv("EMBED_SERVER_MAX_BATCH", 32))            # 每批最多的查询数
+EMBED_SERVER_MAX_WAIT_MS = float(os.getenv("EMBED_SERVER_MAX_WAIT_MS", 5))       # 凑批的最长等待（毫秒）
+EMBED_SERVER_TIMEOUT = float(os.getenv("EMBED_SERVER_TIMEOUT", 30))              # 客户端单次请求超时（秒）
+EMBED_SERVER_START_TIMEOUT = float(os.getenv("EMBED_SERVER_START_TIMEOUT", 180))  # 等待服务启动（加载模型）的秒数
+
+_HEADER = struct.Struct("!I")
+
+
+def _send_frame(sock, data: bytes):
+    sock.sendall(_HEADER.pack(len(data)) + data)
+
+
+def _recv_exact(sock, size: int) -> bytes:
+    buf = bytearray()
+    while len(buf) < size:
+        chunk = sock.recv(size - len(buf))
+        if not chunk:
+            raise ConnectionError("嵌入服务连接已关闭")
+        buf.extend(chunk)
+    return bytes(buf)
+
+
+def _recv_frame(sock) -> bytes:
+    (size,) = _HEADER.unpack(_recv_exact(sock, _HEADER.size))
+    return _recv_exact(sock, size)
+
+
+async def _read_frame(reader):
+    """读取一帧，连接关闭时返回 None"""
+    import asyncio
+
+    try:
+        (size,) = _HEADER.unpack(await reader.readexactly(_HEADER.size))
+        return await reader.readexactly(size)
+    except asyncio.IncompleteReadError:
+        return None
+
+
+class EmbedServer:
+    """服务端：查询请求跨连接合并成批，模型推理在单个线程中串行执行"""
+
+    def __init__(self, model, model_name: str, backend: str):
+        import asyncio
+        from concurrent.futures import ThreadPoolExecutor
+
+        self.model = model
+        self.model_name = model_name
+        self.backend = backend
+        self.dim = len(model.embed_query("测试文本"))
+        self.queue = asyncio.Queue()
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="embed")
+        self.started_at = time.time()
+        self.connections = 0
+        self.requests = 0
+        self.queries = 0
+        self.batches = 0
+        self.batched_queries = 0
+        self.max_batch = 0
+        self.wait_seconds = 0.0
+        self.infer_seconds = 0.0
+        self.document_texts = 0
+        self.document_chunks = 0
+
+    async def embed_queries(self, texts: List[str]) -> List[List[float]]:
+        """查询向量：放入队列等待合并成批"""
+        import asyncio
+
+        loop = asyncio.get_running_loop()
+        futures = []
+        for text in texts:
+            future = loop.create_future()
+            self.queue.put_nowait((text, future, time.perf_counter()))
+            futures.append(future)
+        self.queries += len(texts)
+        return list(await asyncio.gather(*futures))
+
+    async def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        """
+        批量向量化（构建索引）：按长度排序后分块提交，一块算完再提交下一块
+
+        推理线程按提交顺序执行，分块之间到达的查询批次排在下一块之前，查询最多等待一块的推理时间。
+        """
+        import asyncio
+
+        loop = asyncio.get_running_loop()
+        order = sorted(range(len(texts)), key=lambda i: len(texts[i]))  # 长度相近的文本同块，减少填充
+        vectors = [None] * len(texts)
+        for offset in range(0, len(order), EMBED_SERVER_MAX_BATCH):
+            chunk = order[offset:offset + EMBED_SERVER_MAX_BATCH]
+            start = time.perf_counter()
+            chunk_vectors = await loop.run_in_executor(self.executor, self.model.embed_documents,
+                                                       [texts[i] for i in chunk])
+            self.infer_seconds += time.perf_counter() - start
+            self.document_chunks += 1
+            for i, vector in zip(chunk, chunk_vectors):
+                vectors[i] = vector
+        self.document_texts += len(texts)
+        return vectors
+
+    async def batch_loop(self):
+        """取出第一条请求后在等待窗口内继续收集，凑满或超时即推理；相同文本只计算一次"""
+        import asyncio
+
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + EMBED_SERVER_MAX_WAIT_MS / 1000
+            while len(batch) < EMBED_SERVER_MAX_BATCH:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            now = time.perf_counter()
+            texts = list(dict.fromkeys(text for text, _, _ in batch))
+            try:
+                vectors = await loop.run_in_executor(self.executor, self.model.embed_documents, texts)
+                by_text = dict(zip(texts, vectors))
+                for text, future, _ in batch:
+                    if not future.done():
+                        future.set_result(by_text[text])
+            except Exception as e:
+                for _, future, _ in batch:
+                    if not future.done():
+                        future.set_exception(e)
+            self.infer_seconds += time.perf_counter() - now
+            self.batches += 1
+            self.batched_queries += len(batch)
+            self.max_batch = max(self.max_batch, len(batch))
+            self.wait_seconds += sum(now - queued_at for _, _, queued_at in batch)
+
+    async def handle(self, reader, writer):
+        """一个连接上的请求按顺序处理（客户端每个线程一个连接）"""
+        self.connections += 1
+        try:
+            while True:
+                frame = await _read_frame(reader)
+                if frame is None:
+                    break
+                payload = None
+                try:
+                    request = json.loads(frame)
+                    op = request.get("op")
+                    if op == "embed":
+                        texts = request["texts"]
+                        if request.get("query"):
+                            vectors = await self.embed_queries(texts)
+                        else:
+                            vectors = await self.embed_documents(texts)
+                        flat = array('f')
+                        for vector in vectors:
+                            flat.extend(vector)
+                        header = {"ok": True, "n": len(vectors), "dim": self.dim}
+                        payload = flat.tobytes()
+                    elif op == "info":
+                        header = {"ok": True, "model_name": self.model_name, "backend": self.backend,
+                                  "dim": self.dim, "pid": os.getpid()}
+                    elif op == "stats":
+                        header = {"ok": True, "stats": self.get_stats()}
+                    else:
+                        raise ValueError(f"未知操作: {op}")
+                    self.requests += 1
+                except Exception as e:
+                    header = {"ok": False, "error": str(e)}
+                    payload = None
+                data = json.dumps(header, ensure_ascii=False).encode("utf-8")
+                writer.write(_HEADER.pack(len(data)) + data)
+                if payload is not None:
+                    writer.write(_HEADER.pack(len(payload)) + payload)
+                await writer.drain()
+        except (ConnectionError, OSError):
+            pass
+        finally:
+            self.connections -= 1
+            writer.close()
+
+    def get_stats(self) -> dict:
+        return {
+            "model": os.path.basename(os.path.normpath(self.model_name)),
+            "backend": self.backend,
+            "pid": os.getpid(),
+            "uptime_seconds": round(time.time() - self.started_at, 1),
+            "connections": self.connections,
+            "requests": self.requests,
+            "queries": self.queries,
+            "batches": self.batches,
+            "avg_batch": round(self.batched_queries / self.batches, 2) if self.batches else None,
+            "max_batch": self.max_batch,
+            "avg_wait_ms": round(self.wait_seconds / self.batched_queries * 1000, 2) if self.batched_queries else None,
+            "infer_seconds": round(self.infer_seconds, 2),
+            "document_texts": self.document_texts,
+            "document_chunks": self.document_chunks,
+            "max_wait_ms": EMBED_SERVER_MAX_WAIT_MS,
+            "max_batch_size": EMBED_SERVER_MAX_BATCH,
+        }
+
+
+def _server_alive(socket_path: str) -> bool:
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.settimeout(1)
+        sock.connect(socket_path)
+        return True
+    except OSError:
+        return False
+    finally:
+        sock.close()
+
+
+async def _serve(socket_path: str):
+    import asyncio
+    import signal
+    from rag_service import RAGService
+
+    if _server_alive(socket_path):
+        print(f"嵌入服务已在运行: {socket_path}")
+        return
+    service = RAGService()
+    if not service.initialize_models():
+        raise SystemExit("嵌入模型加载失败")
+    server_impl = EmbedServer(service.embed_model, getattr(service.embed_model, "model_name", ""),
+                              service.embed_backend)
+
+    if os.path.exists(socket_path):
+        os.unlink(socket_path)  # 上次异常退出留下的 socket 文件
+    server = await asyncio.start_unix_server(server_impl.handle, path=socket_path)
+    os.chmod(socket_path, 0o660)
+    batcher = asyncio.create_task(server_impl.batch_loop())
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, stop.set)
+    print(f"嵌入服务已启动: {socket_path}（{service.embed_model_name}，{service.embed_backend}，"
+          f"每批最多 {EMBED_SERVER_MAX_BATCH} 条，等待窗口 {EMBED_SERVER_MAX_WAIT_MS} ms）")
+    try:
+        await stop.wait()
+    finally:
+        batcher.cancel()
+        server.close()
+        await server.wait_closed()
+        server_impl.executor.shutdown(wait=False)
+        try:
+            os.unlink(socket_path)
+        except OSError:
+            pass
+        print("嵌入服务已停止")
+
+
+def start_server(socket_path: str = None, timeout: float = None) -> bool:
+    """服务未运行时在后台启动（多个 worker 同时调用时由文件锁保证只启动一个），返回是否可用"""
+    import fcntl
+    import subprocess
+
+    socket_path = socket_path or EMBED_SERVER_SOCKET
+    timeout = EMBED_SERVER_START_TIMEOUT if timeout is None else timeout
+    if _server_alive(socket_path):
+        return True
+    with open(f"{socket_path}.lock", "w") as lock:
+        # 其他 worker 正在启动服务时在此等待，拿到锁后服务通常已可用
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        if _server_alive(socket_path):
+            return True
+        print(f"正在启动共享嵌入服务: {socket_path}")
+        with open(f"{socket_path}.log", "ab") as log:
+            proc = subprocess.Popen(
+                [sys.executable, os.path.abspath(__file__), "--socket", socket_path],
+                cwd=os.path.dirname(os.path.abspath(__file__)),
+                stdout=log, stderr=subprocess.STDOUT, start_new_session=True
+            )
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            if _server_alive(socket_path):
+                return True
+            if proc.poll() is not None:
+                print(f"嵌入服务启动失败，详见 {socket_path}.log")
+                return False
+            time.sleep(0.2)
+        print("等待嵌入服务启动超时")
+        return False
+
+
+class EmbedServerClient(Embeddings):
+    """共享嵌入服务的客户端，接口与 HuggingFaceEmbeddings 相同；每个线程使用独立连接"""
+
+    def __init__(self, socket_path: str = None, timeout: float = None):
+        self.socket_path = socket_path or EMBED_SERVER_SOCKET
+        self.timeout = EMBED_SERVER_TIMEOUT if timeout is None else timeout
+        self._local = threading.local()
+        self.calls = 0
+        self.seconds = 0.0
+        self.reconnects = 0
+        info = self._request({"op": "info"})[0]
+        self.model_name = info["model_name"]
+        self.backend = info["backend"]
+        self.dim = info["dim"]
+
+    def _connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        sock.connect(self.socket_path)
+        return sock
+
+    def _close(self):
+        sock = getattr(self._local, "sock", None)
+        self._local.sock = None
+        if sock is not None:
+            try:
+                sock.close()
+            except OSError:
+                pass
+
+    def _request(self, request: dict, binary: bool = False):
+        """发送请求并读取响应（连接断开时重连一次，如服务重启）"""
+        data = json.dumps(request, ensure_ascii=False).encode("utf-8")
+        for attempt in range(2):
+            try:
+                sock = getattr(self._local, "sock", None)
+                if sock is None:
+                    sock = self._local.sock = self._connect()
+                _send_frame(sock, data)
+                header = json.loads(_recv_frame(sock))
+                payload = _recv_frame(sock) if binary and header.get("ok") else None
+                break
+            except (OSError, ValueError):
+                # 超时或连接异常后连接上可能残留未读的响应，不能复用
+                self._close()
+                if attempt:
+                    raise
+                self.reconnects += 1
+        if not header.get("ok"):
+            raise RuntimeError(f"嵌入服务错误: {header.get('error')}")
+        return header, payload
+
+    def _embed(self, texts: List[str], query: bool) -> List[List[float]]:
+        if not texts:
+            return []
+        start = time.perf_counter()
+        header, payload = self._request({"op": "embed", "texts": texts, "query": query}, binary=True)
+        flat = array('f')
+        flat.frombytes(payload)
+        dim = header["dim"]
+        self.calls += 1
+        self.seconds += time.perf_counter() - start
+        return [flat[i * dim:(i + 1) * dim].tolist() for i in range(header["n"])]
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self._embed(texts, query=False)
+
+    def embed_query(self, text: str) -> List[float]:
+        return self._embed([text], query=True)[0]
+
+    def get_stats(self) -> dict:
+        stats = {
+            "enabled": True,
+            "socket": self.socket_path,
+            "calls": self.calls,
+            "avg_ms": round(self.seconds / self.calls * 1000, 2) if self.calls else None,
+            "reconnects": self.reconnects,
+        }
+        try:
+            stats["server"] = self._request({"op": "stats"})[0]["stats"]
+        except Exception as e:
+            stats["server"] = {"error": str(e)}
+        return stats
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def connect_embed_server():
+    """连接共享嵌入服务（需要时自动启动），不可用时返回 None（调用方在本进程加载模型）"""
+    global _client
+    with _client_lock:
+        if _client is not None:
+            return _client
+        try:
+            if EMBED_SERVER_AUTOSTART and not start_server():
+                return None
+            _client = EmbedServerClient()
+            print(f"已连接共享嵌入服务: {EMBED_SERVER_SOCKET}（{_client.backend}）")
+        except Exception as e:
+            print(f"连接共享嵌入服务失败，在本进程加载嵌入模型: {e}")
+            _client = None
+        return _client
+
+
+def get_embed_server_stats() -> dict:
+    if _client is None:
+        return {"enabled": EMBED_SERVER, "connected": False}
+    return {"connected": True, **_client.get_stats()}
+
+
+if __name__ == "__main__":
+    import argparse
+    import asyncio
+
+    parser = argparse.ArgumentParser(description="共享嵌入服务（UNIX socket，跨请求合并批量推理）")
+    parser.add_argument("--socket", default=EMBED_SERVER_SOCKET, help="UNIX socket 路径")
+    args = parser.parse_args()
+    # 服务进程自己加载模型，不能再连接嵌入服务
+    os.environ["EMBED_SERVER"] = "false"
+    asyncio.run(_serve(args.socket))
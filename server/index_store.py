@@ -0,0 +1,285 @@
+"""
+FAISS 索引存储：索引类型/量化配置、mmap 加载和磁盘文本块存储
+
+索引目录格式：
+    index.faiss      FAISS 索引
+    index.pkl        pickle((docstore 或 None, index_to_docstore_id))
+    docstore.sqlite  RAG_DOCSTORE=sqlite 时的文本块存储（index.pkl 中 docstore 为 None）
+    lexical.pkl      BM25 关键词索引（混合检索用，只含倒排表，原文从文本块存储读取）
+    manifest.json    文件清单（由 rag_service 写入）
+
+加载时按目录中实际存在的文件识别格式，与当前配置无关；配置只影响新构建的索引。
+langchain 在函数内按需导入，读取配置不会加载 ML 依赖。
+"""
+from __future__ import annotations
+
+import os
+import json
+import pickle
+import sqlite3
+import threading
+from typing import Dict, List, TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from langchain.schema import Document
+    from langchain_community.docstore.in_memory import InMemoryDocstore
+    from langchain_community.vectorstores import FAISS
+
+# 索引类型：flat（精确检索）/ ivf（倒排）/ hnsw（图索引）
+RAG_INDEX_TYPE = os.getenv("RAG_INDEX_TYPE", "flat").lower()
+# 向量量化：none / sq8（8 位标量量化，约 1/4 内存）/ pq（乘积量化）
+RAG_INDEX_QUANT = os.getenv("RAG_INDEX_QUANT", "none").lower()
+# IVF 聚类中心数，0 表示按向量数自动选择（约 4*sqrt(n)）
+RAG_IVF_NLIST = int(os.getenv("RAG_IVF_NLIST", 0))
+RAG_IVF_NPROBE = int(os.getenv("RAG_IVF_NPROBE", 16))
+RAG_HNSW_M = int(os.getenv("RAG_HNSW_M", 32))
+RAG_HNSW_EF_SEARCH = int(os.getenv("RAG_HNSW_EF_SEARCH", 64))
+# PQ 子向量数，需要整除向量维度
+RAG_PQ_M = int(os.getenv("RAG_PQ_M", 16))
+# 只读加载时使用 mmap，多个 worker 共享页缓存（对 IVF 倒排表生效）
+RAG_INDEX_MMAP = os.getenv("RAG_INDEX_MMAP", "true").lower() in ("1", "true", "yes")
+# 文本块存储：pickle（全部载入内存）/ sqlite（按ID从磁盘读取）
+RAG_DOCSTORE = os.getenv("RAG_DOCSTORE", "pickle").lower()
+
+INDEX_FILE = "index.faiss"
+PKL_FILE = "index.pkl"
+DOCSTORE_FILE = "docstore.sqlite"
+LEXICAL_FILE = "lexical.pkl"
+
+# 量化/聚类训练至少需要的向量数，不足时退回精确索引
+_MIN_TRAIN_PER_LIST = 39
+_MIN_TRAIN_PQ = 256
+
+
+def index_config() -> dict:
+    """当前索引配置，写入清单；配置变化时增量更新改为完全重建"""
+    return {"type": RAG_INDEX_TYPE, "quantization": RAG_INDEX_QUANT, "docstore": RAG_DOCSTORE}
+
+
+def factory_string(dim: int, n: int, index_type: str = None, quantization: str = None) -> str:
+    """
+    根据配置和向量数生成 faiss.index_factory 描述串
+
+    训练数据不足（IVF 每个聚类少于 39 个向量、PQ 少于 256 个向量）时降级，
+    保证小知识库也能构建。
+    """
+    index_type = index_type or RAG_INDEX_TYPE
+    quantization = quantization or RAG_INDEX_QUANT
+
+    if quantization == "pq" and (n < _MIN_TRAIN_PQ or dim % RAG_PQ_M != 0):
+        print(f"向量数 {n} 或维度 {dim} 不满足 PQ{RAG_PQ_M} 训练要求，改用 SQ8")
+        quantization = "sq8"
+    codec = {"none": "Flat", "sq8": "SQ8", "pq": f"PQ{RAG_PQ_M}"}.get(quantization)
+    if codec is None:
+        raise ValueError(f"不支持的量化方式: {quantization}")
+
+    if index_type == "flat":
+        return codec
+    if index_type == "ivf":
+        nlist = RAG_IVF_NLIST or int(4 * n ** 0.5)
+        nlist = min(nlist, n // _MIN_TRAIN_PER_LIST)
+        if nlist < 2:
+            print(f"向量数 {n} 过少，IVF 改用精确索引")
+            return codec
+        return f"IVF{nlist},{codec}"
+    if index_type == "hnsw":
+        if codec == "Flat":
+            return f"HNSW{RAG_HNSW_M}"
+        return f"HNSW{RAG_HNSW_M}_{codec}"
+    raise ValueError(f"不支持的索引类型: {index_type}")
+
+
+def create_index(vectors, description: str = None):
+    """
+    按配置创建索引，需要训练时先用全部向量训练，再写入向量
+
+    Args:
+        vectors: float32 矩阵 (n, dim)
+        description: 可选的 index_factory 描述串，默认由配置生成
+    """
+    import faiss
+
+    n, dim = vectors.shape
+    description = description or factory_string(dim, n)
+    index = faiss.index_factory(dim, description)
+    if not index.is_trained:
+        print(f"训练索引 {description}（{n} 个向量）...")
+        index.train(vectors)
+    index.add(vectors)
+    apply_search_params(index)
+    print(f"索引类型: {description}")
+    return index
+
+
+def apply_search_params(index):
+    """设置检索参数（IVF 的 nprobe、HNSW 的 efSearch），不适用的参数忽略"""
+    import faiss
+
+    params = faiss.ParameterSpace()
+    for name, value in (("nprobe", RAG_IVF_NPROBE), ("efSearch", RAG_HNSW_EF_SEARCH)):
+        try:
+            params.set_index_parameter(index, name, value)
+        except RuntimeError:
+            pass
+
+
+def supports_remove(index) -> bool:
+    """
+    能否按 langchain FAISS.delete 的方式删除向量
+
+    FAISS.delete 假设删除后剩余向量的序号依次前移（并据此重新编号 index_to_docstore_id），
+    只有顺序存储编码的平坦索引（Flat / SQ8 / PQ）的 remove_ids 是这样；IVF 删除后剩余向量的
+    序号不变，HNSW 不支持删除。这些索引的增量更新需要改为完全重建。
+    """
+    import faiss
+
+    flat_types = getattr(faiss, "IndexFlatCodes", None) or (faiss.IndexFlat, faiss.IndexScalarQuantizer, faiss.IndexPQ)
+    return isinstance(faiss.downcast_index(index), flat_types)
+
+
+class SqliteDocstore:
+    """
+    只读的 SQLite 文本块存储，按ID读取（实现 langchain Docstore 的 search 接口）
+
+    检索只需要 top-k 个文本块，不必把全部文本反序列化到每个 worker 进程的内存中。
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True, check_same_thread=False)
+        self._lock = threading.Lock()
+
+    def search(self, search: str):
+        from langchain.schema import Document
+
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT content, metadata FROM chunks WHERE id = ?", (search,)
+            ).fetchone()
+        if row is None:
+            return f"ID {search} not found."
+        return Document(page_content=row[0], metadata=json.loads(row[1]))
+
+    def to_memory(self) -> InMemoryDocstore:
+        """全部读入内存，供增量更新修改副本"""
+        from langchain.schema import Document
+        from langchain_community.docstore.in_memory import InMemoryDocstore
+
+        with self._lock:
+            rows = self._conn.execute("SELECT id, content, metadata FROM chunks").fetchall()
+        return InMemoryDocstore({
+            chunk_id: Document(page_content=content, metadata=json.loads(metadata))
+            for chunk_id, content, metadata in rows
+        })
+
+    def close(self):
+        self._conn.close()
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM chunks").fetchone()[0]
+
+    @staticmethod
+    def write(path: str, documents: Dict[str, Document]):
+        """写入新的 SQLite 存储文件"""
+        conn = sqlite3.connect(path)
+        try:
+            conn.execute("CREATE TABLE chunks (id TEXT PRIMARY KEY, content TEXT NOT NULL, metadata TEXT NOT NULL)")
+            conn.executemany(
+                "INSERT INTO chunks (id, content, metadata) VALUES (?, ?, ?)",
+                (
+                    (chunk_id, doc.page_content, json.dumps(doc.metadata, ensure_ascii=False, default=str))
+                    for chunk_id, doc in documents.items()
+                )
+            )
+            conn.commit()
+        finally:
+            conn.close()
+
+
+def write_vector_store(vector_store: FAISS, path: str, lexical: bool = False):
+    """
+    把向量库写入目录（索引 + 文本块存储）
+
+    Args:
+        lexical: 同时根据全部文本块构建并写入 BM25 关键词索引
+    """
+    import faiss
+
+    os.makedirs(path, exist_ok=True)
+    faiss.write_index(vector_store.index, os.path.join(path, INDEX_FILE))
+
+    docstore = vector_store.docstore
+    if RAG_DOCSTORE == "sqlite":
+        ids = list(vector_store.index_to_docstore_id.values())
+        SqliteDocstore.write(os.path.join(path, DOCSTORE_FILE), _collect_documents(docstore, ids))
+        docstore = None
+    elif isinstance(docstore, SqliteDocstore):
+        docstore = docstore.to_memory()
+
+    with open(os.path.join(path, PKL_FILE), "wb") as f:
+        pickle.dump((docstore, vector_store.index_to_docstore_id), f)
+
+    if lexical:
+        build_lexical_index(vector_store).save(os.path.join(path, LEXICAL_FILE))
+
+
+def build_lexical_index(vector_store: FAISS):
+    """根据向量库的全部文本块构建 BM25 索引（块ID为文本块存储中的ID，不保存原文）"""
+    from simple_rag import BM25Index
+
+    ids = list(vector_store.index_to_docstore_id.values())
+    documents = _collect_documents(vector_store.docstore, ids)
+    return BM25Index.build([(chunk_id, doc.page_content) for chunk_id, doc in documents.items()],
+                           keep_texts=False)
+
+
+def read_lexical_index(path: str):
+    """读取目录中的 BM25 索引，不存在或格式不一致时返回 None"""
+    from simple_rag import BM25Index
+
+    return BM25Index.load(os.path.join(path, LEXICAL_FILE))
+
+
+def _collect_documents(docstore, ids: List[str]) -> Dict[str, Document]:
+    from langchain_community.docstore.in_memory import InMemoryDocstore
+
+    if isinstance(docstore, InMemoryDocstore):
+        return {chunk_id: docstore._dict[chunk_id] for chunk_id in ids}
+    return {chunk_id: docstore.search(chunk_id) for chunk_id in ids}
+
+
+def read_vector_store(path: str, embeddings, writable: bool = False) -> FAISS:
+    """
+    从目录加载向量库
+
+    Args:
+        path: 索引目录
+        embeddings: 嵌入模型
+        writable: True 时完整读入内存（增量更新修改副本用）；
+                  False 时按配置 mmap 索引并按需读取文本块
+    """
+    import faiss
+    from langchain_community.vectorstores import FAISS
+
+    index_path = os.path.join(path, INDEX_FILE)
+    index = None
+    if RAG_INDEX_MMAP and not writable:
+        try:
+            index = faiss.read_index(index_path, faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY)
+        except RuntimeError as e:
+            print(f"mmap 加载索引失败，改为完整读入内存: {e}")
+    if index is None:
+        index = faiss.read_index(index_path)
+    apply_search_params(index)
+
+    with open(os.path.join(path, PKL_FILE), "rb") as f:
+        docstore, index_to_docstore_id = pickle.load(f)
+    if docstore is None:
+        docstore = SqliteDocstore(os.path.join(path, DOCSTORE_FILE))
+        if writable:
+            memory_docstore = docstore.to_memory()
+            docstore.close()
+            docstore = memory_docstore
+
+    return FAISS(embeddings, index, docstore, index_to_docstore_id)
@@ -1,6 +1,14 @@
-from database import get_db_connection  # 假设你已定义好 get_db_connection
-from rag_service import enhance_query_with_rag  # 导入 RAG 增强功能
+from database import get_db_connection, get_async_db_connection
+from rag_service import enhance_query_with_rag, prepare_rag_query  # 导入 RAG 增强功能
+from cache_utils import SemanticCache
+from token_budget import (count_tokens, count_static_tokens, output_budget, check_prompt_fits,
+                          user_message_budget, PromptTooLongError, MESSAGE_OVERHEAD_TOKENS)
+from conversation_memory import build_conversation_context, history_budget
+from prompt_builder import build_messages, rag_system_prompt, cache_hint_fields
 import os
+import time
+import asyncio
+import threading
 import requests
 import json
 from dotenv import load_dotenv
@@ -37,68 +45,278 @@ MILITARY_ANALYST_SYSTEM_PROMPT = """你是一位专业的军事冲突与地缘
 
 请以专业、客观、深入的方式回应用户的军事和地缘政治相关问题。"""
 
-def calculate_max_tokens(input_text: str, max_context: int = 3000) -> int:
+# RAG 请求使用的系统提示词（前缀布局下包含固定的回答要求，所有请求共享同一前缀）
+RAG_SYSTEM_PROMPT = rag_system_prompt(MILITARY_ANALYST_SYSTEM_PROMPT)
+
+def calculate_max_tokens(input_text: str, max_context: int = None) -> int:
     """
-    根据输入文本长度动态计算max_tokens
-    保守估计：输入token数约为字符数的1/3
+    根据输入文本的 token 数动态计算max_tokens
+    使用模型分词器计数（不可用时按字符类别估算），预留安全余量
     """
-    # 估算输入token数（保守估计）
-    estimated_input_tokens = len(input_text) // 3
-    
-    # 预留一些buffer，确保不超过上下文限制
-    available_tokens = max_context - estimated_input_tokens - 200  # 200作为安全buffer
-    
-    # 确保max_tokens在合理范围内
-    return max(100, min(available_tokens, 1000))
+    return output_budget(count_tokens(input_text), max_context)
 
 
-def llm(text: str, identity_id: str = None):
+def _user_message_budget(text: str, system_prompt: str = RAG_SYSTEM_PROMPT) -> int:
     """
-    同步调用本地部署的 LLM 获取回复（带 RAG 增强和身份认知）
+    检查用户输入能否放进模型上下文（超出时抛出 PromptTooLongError，不再请求推理服务），
+    返回 RAG 增强后的用户消息可用的 token 数
     """
-    # 使用 RAG 增强查询
-    enhanced_text = enhance_query_with_rag(text)
-    
-    # 使用军事冲突与地缘态势智能分析助手身份认知
-    system_prompt = MILITARY_ANALYST_SYSTEM_PROMPT
-    
-    # 本地模型服务配置
+    system_tokens = count_static_tokens(system_prompt) if system_prompt else 0
+    check_prompt_fits(system_tokens + count_tokens(text) + 2 * MESSAGE_OVERHEAD_TOKENS)
+    return user_message_budget(system_tokens)
+
+
+def _history_budget(enhanced_text: str) -> int:
+    """本轮提示词（系统提示词 + RAG 增强后的用户消息）之外留给对话历史的 token 数"""
+    prompt_tokens = count_static_tokens(RAG_SYSTEM_PROMPT) + count_tokens(enhanced_text) + 2 * MESSAGE_OVERHEAD_TOKENS
+    return history_budget(prompt_tokens)
+
+
+def _get_model_config():
+    """读取本地模型服务配置"""
     local_model_url = os.getenv("LOCAL_MODEL_URL")
     model_name = os.getenv("LOCAL_MODEL_NAME")
-    
     if not local_model_url:
         raise ValueError("缺少环境变量 LOCAL_MODEL_URL")
     if not model_name:
         raise ValueError("缺少环境变量 LOCAL_MODEL_NAME")
-    
-    # 构建请求数据
-    # 动态计算max_tokens（考虑系统提示词长度）
-    full_text = f"{system_prompt}\n\n{enhanced_text}" if system_prompt else enhanced_text
-    max_tokens = calculate_max_tokens(full_text)
-    
-    # 构建消息列表
-    messages = []
-    if system_prompt:
-        messages.append({"role": "system", "content": system_prompt})
-    messages.append({"role": "user", "content": enhanced_text})
-    
+    return local_model_url, model_name
+
+
+def _build_payload(model_name: str, enhanced_text: str, stream: bool,
+                   system_prompt: str = MILITARY_ANALYST_SYSTEM_PROMPT,
+                   max_tokens: int = None, history: list = None, summary: str = None) -> dict:
+    """
+    构建 OpenAI 兼容的请求数据（默认带军事分析助手身份认知）
+
+    Args:
+        history: 同一主题最近的对话消息 [{"role", "content"}]，放在本轮用户消息之前
+        summary: 更早对话的摘要，附在系统提示词之后
+    """
+    messages, prompt_tokens = build_messages(system_prompt, enhanced_text, history, summary)
+
+    # 动态计算max_tokens（按完整消息列表的 token 数）
+    if max_tokens is None:
+        max_tokens = output_budget(prompt_tokens)
+
     payload = {
         "model": model_name,
         "messages": messages,
         "temperature": 0.7,
         "max_tokens": max_tokens,
-        "stream": False,
+        "stream": stream,
         "top_p": 0.9,
         "frequency_penalty": 0.0,
         "presence_penalty": 0.0
     }
-    
+    payload.update(cache_hint_fields(messages))
+    return payload
+
+
+def _parse_sse_line(line: str):
+    """
+    解析一行 SSE 数据
+
+    Returns:
+        (done, content): done 表示收到 [DONE]；content 为本行增量文本（可能为 None）
+    """
+    if not line.startswith('data: '):
+        return False, None
+    data = line[6:]  # 去掉 'data: ' 前缀
+    if data.strip() == '[DONE]':
+        return True, None
     try:
-        response = requests.post(
+        chunk_data = json.loads(data)
+    except json.JSONDecodeError:
+        return False, None
+    if 'choices' in chunk_data and len(chunk_data['choices']) > 0:
+        delta = chunk_data['choices'][0].get('delta', {})
+        if 'content' in delta:
+            return False, delta['content']
+    return False, None
+
+
+# ---------------------------------------------------------------------------
+# 共享 HTTP 客户端层：所有 LLM 调用复用 keep-alive 连接池
+# ---------------------------------------------------------------------------
+HTTP_POOL_SIZE = int(os.getenv("LLM_HTTP_POOL_SIZE", 20))               # 每个客户端的最大连接数
+HTTP_KEEPALIVE = os.getenv("LLM_HTTP_KEEPALIVE", "1") != "0"            # 是否启用 keep-alive
+HTTP_KEEPALIVE_EXPIRY = float(os.getenv("LLM_HTTP_KEEPALIVE_EXPIRY", 60))  # 空闲连接保留秒数
+CONNECT_TIMEOUT = float(os.getenv("LLM_CONNECT_TIMEOUT", 5))
+READ_TIMEOUT = float(os.getenv("LLM_READ_TIMEOUT", 60))
+CONNECT_RETRIES = int(os.getenv("LLM_CONNECT_RETRIES", 2))             # 仅对连接错误重试
+RETRY_BACKOFF = float(os.getenv("LLM_RETRY_BACKOFF", 0.5))              # 退避基数（秒），按 2^n 递增
+
+_http_lock = threading.Lock()
+_http_session = None
+_http_last_used = 0.0
+_async_client = None
+# 请求计数可能来自多个线程（同步调用在线程池中执行），统一通过 _count_http 在锁内更新
+_http_stats_lock = threading.Lock()
+_http_stats = {
+    "sync_requests": 0,
+    "sync_connect_retries": 0,
+    "async_requests": 0,
+    "async_new_connections": 0,
+    "async_connect_retries": 0,
+}
+
+
+def _count_http(key: str, n: int = 1):
+    with _http_stats_lock:
+        _http_stats[key] += n
+
+
+def _on_sync_response(response, *args, **kwargs):
+    """requests 响应钩子：统计同步请求数和连接重试次数（urllib3 Retry.history）"""
+    _count_http("sync_requests")
+    retries = getattr(response.raw, "retries", None)
+    if retries is not None and retries.history:
+        _count_http("sync_connect_retries", len(retries.history))
+
+
+def _default_headers() -> dict:
+    headers = {"Content-Type": "application/json"}
+    if not HTTP_KEEPALIVE:
+        headers["Connection"] = "close"
+    return headers
+
+
+def get_http_session() -> requests.Session:
+    """
+    获取共享的同步 HTTP 会话（线程安全）
+
+    连接池大小由 LLM_HTTP_POOL_SIZE 控制；连接错误按指数退避重试，
+    读超时和 HTTP 错误不重试（避免重复触发生成）。
+    空闲超过 LLM_HTTP_KEEPALIVE_EXPIRY 秒的连接在下次使用前丢弃。
+    """
+    global _http_session, _http_last_used
+    with _http_lock:
+        now = time.monotonic()
+        if _http_session is None:
+            from requests.adapters import HTTPAdapter
+            from urllib3.util.retry import Retry
+
+            retry = Retry(
+                total=CONNECT_RETRIES,
+                connect=CONNECT_RETRIES,
+                read=0,
+                status=0,
+                other=0,
+                redirect=0,
+                backoff_factor=RETRY_BACKOFF,
+                raise_on_status=False,
+            )
+            adapter = HTTPAdapter(pool_connections=4, pool_maxsize=HTTP_POOL_SIZE, max_retries=retry)
+            session = requests.Session()
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            session.headers.update(_default_headers())
+            session.hooks["response"].append(_on_sync_response)
+            _http_session = session
+        elif HTTP_KEEPALIVE_EXPIRY and now - _http_last_used > HTTP_KEEPALIVE_EXPIRY:
+            # 服务端可能已关闭长时间空闲的连接，直接清空连接池
+            for adapter in _http_session.adapters.values():
+                adapter.poolmanager.clear()
+        _http_last_used = now
+        return _http_session
+
+
+def get_async_http_client():
+    """获取共享的异步 HTTP 客户端（首次调用时创建，连接保持复用）"""
+    global _async_client
+    if _async_client is None:
+        import httpx  # 按需导入，同步代码路径不依赖 httpx
+        _async_client = httpx.AsyncClient(
+            timeout=httpx.Timeout(READ_TIMEOUT, connect=CONNECT_TIMEOUT),
+            limits=httpx.Limits(
+                max_connections=HTTP_POOL_SIZE,
+                max_keepalive_connections=HTTP_POOL_SIZE if HTTP_KEEPALIVE else 0,
+                keepalive_expiry=HTTP_KEEPALIVE_EXPIRY,
+            ),
+            headers=_default_headers(),
+        )
+    return _async_client
+
+
+async def close_async_http_client():
+    """关闭共享的异步 HTTP 客户端"""
+    global _async_client
+    if _async_client is not None:
+        await _async_client.aclose()
+        _async_client = None
+
+
+async def _trace_connection(event_name: str, info: dict):
+    """httpx trace 回调：统计新建连接次数（未命中连接池）"""
+    if event_name == "connection.connect_tcp.started":
+        _count_http("async_new_connections")
+
+
+async def _async_send(method: str, url: str, payload: dict, stream: bool = False):
+    """发送异步请求；仅在连接阶段失败时按指数退避重试"""
+    import httpx
+
+    client = get_async_http_client()
+    attempt = 0
+    while True:
+        request = client.build_request(method, url, json=payload,
+                                       extensions={"trace": _trace_connection})
+        try:
+            _count_http("async_requests")
+            return await client.send(request, stream=stream)
+        except (httpx.ConnectError, httpx.ConnectTimeout):
+            if attempt >= CONNECT_RETRIES:
+                raise
+            _count_http("async_connect_retries")
+            await asyncio.sleep(RETRY_BACKOFF * (2 ** attempt))
+            attempt += 1
+
+
+def get_http_client_stats() -> dict:
+    """HTTP 请求与连接池统计（同步客户端只统计请求数和连接重试，异步客户端另统计新建连接）"""
+    with _http_stats_lock:
+        stats = dict(_http_stats)
+    async_requests = stats["async_requests"]
+    async_new_connections = stats["async_new_connections"]
+    return {
+        "pool_size": HTTP_POOL_SIZE,
+        "keepalive": HTTP_KEEPALIVE,
+        "keepalive_expiry": HTTP_KEEPALIVE_EXPIRY,
+        "connect_timeout": CONNECT_TIMEOUT,
+        "read_timeout": READ_TIMEOUT,
+        "connect_retries": CONNECT_RETRIES,
+        "sync": {
+            "requests": stats["sync_requests"],
+            "connect_retries": stats["sync_connect_retries"],
+        },
+        "async": {
+            "requests": async_requests,
+            "pool_hits": max(0, async_requests - async_new_connections),
+            "pool_misses": async_new_connections,
+            "connect_retries": stats["async_connect_retries"],
+        },
+    }
+
+
+def llm(text: str, identity_id: str = None):
+    """
+    同步调用本地部署的 LLM 获取回复（带 RAG 增强和身份认知）
+    """
+    # 使用 RAG 增强查询（知识库文本按剩余上下文裁剪）
+    enhanced_text = enhance_query_with_rag(text, _user_message_budget(text))
+
+    # 本地模型服务配置
+    local_model_url, model_name = _get_model_config()
+
+    # 构建请求数据
+    payload = _build_payload(model_name, enhanced_text, stream=False, system_prompt=RAG_SYSTEM_PROMPT)
+
+    try:
+        response = get_http_session().post(
             local_model_url,
             json=payload,
-            headers={"Content-Type": "application/json"},
-            timeout=60
+            timeout=(CONNECT_TIMEOUT, READ_TIMEOUT)
         )
         response.raise_for_status()
         
@@ -118,102 +336,82 @@ def llm_stream(text: str, subjectid: int, identity_id: str = None):
     支持身份认知功能。
     """
     content = ""
+    chunks = 0
+    upstream_open = False
+    _count_generation("started")
     
     try:
         # 1) 先把 subjectid 作为首段发给前端
         yield str(subjectid)
 
+        # 输入超出模型上下文时直接返回错误，不占用推理服务
+        try:
+            rag_budget = _user_message_budget(text)
+        except PromptTooLongError as too_long:
+            print(too_long)
+            yield f"错误: {too_long}"
+            return
+
         # 使用 RAG 增强查询（添加异常处理）
         try:
-            enhanced_text = enhance_query_with_rag(text)
+            enhanced_text = enhance_query_with_rag(text, rag_budget)
         except Exception as rag_error:
             print(f"RAG 增强失败，使用原始查询: {rag_error}")
             enhanced_text = text
         
-        # 使用军事冲突与地缘态势智能分析助手身份认知
-        system_prompt = MILITARY_ANALYST_SYSTEM_PROMPT
-        
         # 本地模型服务配置
-        local_model_url = os.getenv("LOCAL_MODEL_URL")
-        model_name = os.getenv("LOCAL_MODEL_NAME")
-        
-        if not local_model_url:
-            error_msg = "缺少环境变量 LOCAL_MODEL_URL"
-            print(error_msg)
-            yield f"错误: {error_msg}"
-            return
-        if not model_name:
-            error_msg = "缺少环境变量 LOCAL_MODEL_NAME"
+        try:
+            local_model_url, model_name = _get_model_config()
+        except ValueError as config_error:
+            error_msg = str(config_error)
             print(error_msg)
             yield f"错误: {error_msg}"
             return
         
         # 构建流式请求数据
-        # 动态计算max_tokens（考虑系统提示词长度）
-        full_text = f"{system_prompt}\n\n{enhanced_text}" if system_prompt else enhanced_text
-        max_tokens = calculate_max_tokens(full_text)
-        
-        # 构建消息列表
-        messages = []
-        if system_prompt:
-            messages.append({"role": "system", "content": system_prompt})
-        messages.append({"role": "user", "content": enhanced_text})
-        
-        payload = {
-            "model": model_name,
-            "messages": messages,
-            "temperature": 0.7,
-            "max_tokens": max_tokens,
-            "stream": True,
-            "top_p": 0.9,
-            "frequency_penalty": 0.0,
-            "presence_penalty": 0.0
-        }
+        payload = _build_payload(model_name, enhanced_text, stream=True, system_prompt=RAG_SYSTEM_PROMPT)
         
         # 2) 调用流式模型
         print(f"发送请求到: {local_model_url}")
         print(f"请求数据: {payload}")
         
-        response = requests.post(
+        # 流式响应用 with 包裹，结束后连接归还连接池
+        with get_http_session().post(
             local_model_url,
             json=payload,
-            headers={"Content-Type": "application/json"},
-            timeout=60,
+            timeout=(CONNECT_TIMEOUT, READ_TIMEOUT),
             stream=True
-        )
-        
-        print(f"响应状态码: {response.status_code}")
-        if response.status_code != 200:
-            print(f"响应内容: {response.text}")
-            raise requests.exceptions.HTTPError(f"HTTP {response.status_code}: {response.text}")
-        
-        response.raise_for_status()
-        
-        # 3) 边生成边返回给前端
-        for line in response.iter_lines():
-            if line:
-                line = line.decode('utf-8')
-                if line.startswith('data: '):
-                    data = line[6:]  # 去掉 'data: ' 前缀
-                    if data.strip() == '[DONE]':
+        ) as response:
+            print(f"响应状态码: {response.status_code}")
+            if response.status_code != 200:
+                print(f"响应内容: {response.text}")
+                raise requests.exceptions.HTTPError(f"HTTP {response.status_code}: {response.text}")
+
+            # 3) 边生成边返回给前端；生成器被关闭（客户端断开）时 with 立即关闭连接，推理服务随之中止生成
+            upstream_open = True
+            for line in response.iter_lines():
+                if line:
+                    done, chunk_content = _parse_sse_line(line.decode('utf-8'))
+                    if done:
                         break
-                    try:
-                        chunk_data = json.loads(data)
-                        if 'choices' in chunk_data and len(chunk_data['choices']) > 0:
-                            delta = chunk_data['choices'][0].get('delta', {})
-                            if 'content' in delta:
-                                chunk_content = delta['content']
-                                content += chunk_content
-                                yield chunk_content
-                    except json.JSONDecodeError:
-                        continue
-                        
+                    if chunk_content:
+                        content += chunk_content
+                        chunks += 1
+                        yield chunk_content
+            upstream_open = False
+        _count_generation("completed")
+
+    except GeneratorExit:
+        _record_abort(subjectid, chunks, upstream_open)
+        raise
     except requests.exceptions.RequestException as e:
+        _count_generation("failed")
         error_msg = f"调用本地模型失败: {e}"
         print(error_msg)
         yield f"错误: {error_msg}"
         return
     except Exception as e:
+        _count_generation("failed")
         error_msg = f"流式调用异常: {e}"
         print(error_msg)
         yield f"错误: {error_msg}"
@@ -221,44 +419,356 @@ def llm_stream(text: str, subjectid: int, identity_id: str = None):
     finally:
         # 4) 将 AI 回复保存到数据库（使用 finally 确保执行）
         if content:  # 只有在有内容时才保存
-            try:
-                with get_db_connection() as conn:
-                    with conn.cursor() as cursor:
-                        # 验证subjectid是否存在
-                        cursor.execute("SELECT id FROM subject WHERE id = %s", (subjectid,))
-                        if not cursor.fetchone():
-                            print(f"主题ID {subjectid} 不存在，创建默认主题")
-                            cursor.execute("INSERT INTO subject (title) VALUES (%s)", ("默认对话",))
-                            new_subjectid = cursor.lastrowid
-                            if new_subjectid:
-                                subjectid = new_subjectid
-                            else:
-                                # 如果还是失败，使用ID=1
-                                subjectid = 1
-                        
-                        insert_sql = (
-                            "INSERT INTO chatcontent (subjectid, content, role) VALUES (%s, %s, %s)"
-                        )
-                        cursor.execute(insert_sql, (subjectid, content, "assistant"))
-                        conn.commit()
-                        print(f"AI 回复已保存：subjectid={subjectid}, length={len(content)}")
-            except Exception as e:
-                # 出现字符集等问题时记录日志，但不再向上抛出，避免前端体验受影响
-                print(f"保存 AI 回复失败: {e}")
-                # 尝试使用默认主题ID
-                try:
-                    with get_db_connection() as conn:
-                        with conn.cursor() as cursor:
-                            # 确保存在ID=1的主题
-                            cursor.execute("SELECT id FROM subject WHERE id = 1")
-                            if not cursor.fetchone():
-                                cursor.execute("INSERT INTO subject (id, title) VALUES (1, %s)", ("默认对话",))
-                            
-                            insert_sql = (
-                                "INSERT INTO chatcontent (subjectid, content, role) VALUES (1, %s, %s)"
-                            )
-                            cursor.execute(insert_sql, (content, "assistant"))
-                            conn.commit()
-                            print(f"AI 回复已保存到默认主题：length={len(content)}")
-                except Exception as e2:
-                    print(f"保存到默认主题也失败: {e2}")
+            _save_assistant_reply(subjectid, content)
+
+
+def _save_assistant_reply(subjectid: int, content: str):
+    """保存 AI 回复；主题不存在时创建默认主题，失败时回退到默认主题"""
+    try:
+        with get_db_connection() as conn:
+            with conn.cursor() as cursor:
+                # 验证subjectid是否存在
+                cursor.execute("SELECT id FROM subject WHERE id = %s", (subjectid,))
+                if not cursor.fetchone():
+                    print(f"主题ID {subjectid} 不存在，创建默认主题")
+                    cursor.execute("INSERT INTO subject (title) VALUES (%s)", ("默认对话",))
+                    new_subjectid = cursor.lastrowid
+                    if new_subjectid:
+                        subjectid = new_subjectid
+                    else:
+                        # 如果还是失败，使用ID=1
+                        subjectid = 1
+                
+                insert_sql = (
+                    "INSERT INTO chatcontent (subjectid, content, role) VALUES (%s, %s, %s)"
+                )
+                cursor.execute(insert_sql, (subjectid, content, "assistant"))
+                conn.commit()
+                print(f"AI 回复已保存：subjectid={subjectid}, length={len(content)}")
+    except Exception as e:
+        # 出现字符集等问题时记录日志，但不再向上抛出，避免前端体验受影响
+        print(f"保存 AI 回复失败: {e}")
+        # 尝试使用默认主题ID
+        try:
+            with get_db_connection() as conn:
+                with conn.cursor() as cursor:
+                    # 确保存在ID=1的主题
+                    cursor.execute("SELECT id FROM subject WHERE id = 1")
+                    if not cursor.fetchone():
+                        cursor.execute("INSERT INTO subject (id, title) VALUES (1, %s)", ("默认对话",))
+                    
+                    insert_sql = (
+                        "INSERT INTO chatcontent (subjectid, content, role) VALUES (1, %s, %s)"
+                    )
+                    cursor.execute(insert_sql, (content, "assistant"))
+                    conn.commit()
+                    print(f"AI 回复已保存到默认主题：length={len(content)}")
+        except Exception as e2:
+            print(f"保存到默认主题也失败: {e2}")
+
+
+# ---------------------------------------------------------------------------
+# 流式生成统计：客户端断开后中止的生成
+# 同步 llm_stream 在线程池中运行，与事件循环同时更新计数，统一在锁内进行
+# ---------------------------------------------------------------------------
+_generation_stats_lock = threading.Lock()
+_generation_stats = {
+    "started": 0,
+    "completed": 0,
+    "failed": 0,
+    "aborted": 0,                      # 客户端断开，生成被中止
+    "aborted_upstream": 0,             # 其中推理服务请求仍在进行、被立即关闭的次数（节省的 GPU 时间）
+    "aborted_before_first_chunk": 0,   # 其中还没有输出任何分片（排队或预填充阶段）
+    "aborted_chunks": 0,               # 中止前已生成的分片总数
+}
+
+
+def _count_generation(key: str):
+    with _generation_stats_lock:
+        _generation_stats[key] += 1
+
+
+def _record_abort(subjectid: int, chunks: int, upstream_open: bool):
+    with _generation_stats_lock:
+        _generation_stats["aborted"] += 1
+        _generation_stats["aborted_chunks"] += chunks
+        if upstream_open:
+            _generation_stats["aborted_upstream"] += 1
+        if not chunks:
+            _generation_stats["aborted_before_first_chunk"] += 1
+    print(f"客户端已断开，中止生成：subjectid={subjectid}, 已生成 {chunks} 个分片"
+          + ("，已关闭推理服务连接" if upstream_open else ""))
+
+
+def get_generation_stats() -> dict:
+    with _generation_stats_lock:
+        stats = dict(_generation_stats)
+    stats["abort_rate"] = round(stats["aborted"] / stats["started"], 4) if stats["started"] else 0.0
+    return stats
+
+
+# ---------------------------------------------------------------------------
+# 异步调用路径：共享 httpx.AsyncClient（keep-alive），不占用线程池
+# ---------------------------------------------------------------------------
+_background_tasks = set()
+
+
+def spawn_background_task(coro):
+    """在后台运行协程，不受当前请求取消的影响"""
+    task = asyncio.get_running_loop().create_task(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    return task
+
+
+async def wait_background_tasks(timeout: float) -> int:
+    """等待后台任务（保存回复、写缓存等）完成，超时仍未完成的任务被取消，返回取消的数量"""
+    if not _background_tasks:
+        return 0
+    _, pending = await asyncio.wait(set(_background_tasks), timeout=timeout)
+    for task in pending:
+        task.cancel()
+    if pending:
+        print(f"关闭时仍有 {len(pending)} 个后台任务未完成，已取消")
+    return len(pending)
+
+
+# ---------------------------------------------------------------------------
+# 语义答案缓存：检索到的块ID、模型和索引版本相同，且查询向量足够相似的问题直接复用答案
+# 只用于不带对话历史的 RAG 请求（带历史时答案依赖上下文）
+# ---------------------------------------------------------------------------
+SEMANTIC_CACHE = os.getenv("SEMANTIC_CACHE", "false").lower() in ("1", "true", "yes")
+SEMANTIC_CACHE_THRESHOLD = float(os.getenv("SEMANTIC_CACHE_THRESHOLD", 0.95))  # 查询向量余弦相似度阈值
+SEMANTIC_CACHE_SIZE = int(os.getenv("SEMANTIC_CACHE_SIZE", 500))
+SEMANTIC_CACHE_TTL = float(os.getenv("SEMANTIC_CACHE_TTL", 3600))              # 0 表示不过期
+SEMANTIC_CACHE_REPLAY_CHARS = 8  # 回放缓存答案时每个分片的字符数
+
+_answer_cache = SemanticCache(max_size=SEMANTIC_CACHE_SIZE, ttl=SEMANTIC_CACHE_TTL,
+                              threshold=SEMANTIC_CACHE_THRESHOLD)
+_answer_cache_version = None
+
+
+def _answer_cache_key(rag: dict, model_name: str):
+    """可以使用语义缓存时返回分组键，否则返回 None；索引版本变化时清除旧版本的答案"""
+    global _answer_cache_version
+    if not SEMANTIC_CACHE or rag.get("embedding") is None:
+        return None
+    index_version = rag["index_version"]
+    if index_version != _answer_cache_version:
+        if _answer_cache_version is not None:
+            removed = _answer_cache.purge(lambda key: key[2] != index_version)
+            print(f"索引版本已变化，清除 {removed} 条缓存答案")
+        _answer_cache_version = index_version
+    return (rag["chunk_ids"], model_name, index_version)
+
+
+async def _replay_answer(answer: str):
+    """把缓存的答案按小分片逐段返回，前端按正常流式输出处理"""
+    for start in range(0, len(answer), SEMANTIC_CACHE_REPLAY_CHARS):
+        yield answer[start:start + SEMANTIC_CACHE_REPLAY_CHARS]
+        await asyncio.sleep(0)
+
+
+def get_answer_cache_stats() -> dict:
+    return dict(_answer_cache.stats(), enabled=SEMANTIC_CACHE, index_version=_answer_cache_version)
+
+
+async def async_llm(text: str, identity_id: str = None, use_rag: bool = True,
+                    system_prompt: str = MILITARY_ANALYST_SYSTEM_PROMPT, max_tokens: int = None):
+    """
+    异步调用本地部署的 LLM 获取回复（默认带 RAG 增强和身份认知）
+
+    Args:
+        use_rag: 是否使用 RAG 增强；主题生成等辅助调用应关闭
+        system_prompt: 系统提示词，传 None 表示不带系统提示词
+        max_tokens: 生成长度上限，默认按输入长度动态计算
+    """
+    import httpx
+
+    # 只有默认身份的 RAG 问答才使用语义缓存（主题生成、摘要等辅助调用不缓存）
+    cacheable = use_rag and system_prompt == MILITARY_ANALYST_SYSTEM_PROMPT and max_tokens is None
+    if use_rag:
+        system_prompt = rag_system_prompt(system_prompt)
+    # 分词计数是 CPU 计算，放到线程中执行，避免阻塞事件循环
+    rag_budget = await asyncio.to_thread(_user_message_budget, text, system_prompt)
+    if use_rag:
+        # RAG 增强包含 CPU 计算，放到线程中执行，避免阻塞事件循环
+        rag = await asyncio.to_thread(prepare_rag_query, text, rag_budget)
+        enhanced_text = rag["text"]
+    else:
+        rag = None
+        enhanced_text = text
+
+    local_model_url, model_name = _get_model_config()
+    cache_key = _answer_cache_key(rag, model_name) if cacheable else None
+    if cache_key is not None:
+        cached = _answer_cache.get(rag["embedding"], cache_key)
+        if cached is not None:
+            print("语义缓存命中，返回缓存的回答")
+            return cached
+
+    payload = await asyncio.to_thread(_build_payload, model_name, enhanced_text, stream=False,
+                                      system_prompt=system_prompt, max_tokens=max_tokens)
+
+    try:
+        response = await _async_send("POST", local_model_url, payload)
+        response.raise_for_status()
+        result = response.json()
+        choice = result["choices"][0]
+        answer = choice["message"]["content"]
+        # 因长度截断的回答不缓存
+        if cache_key is not None and answer and choice.get("finish_reason") != "length":
+            _answer_cache.set(rag["embedding"], cache_key, answer)
+        return answer
+    except httpx.HTTPError as e:
+        raise ValueError(f"调用本地模型失败: {e}")
+    except (KeyError, IndexError) as e:
+        raise ValueError(f"解析模型响应失败: {e}")
+
+
+async def async_llm_stream(text: str, subjectid: int, identity_id: str = None, stream_id: str = None):
+    """
+    llm_stream 的异步生成器版本，逐块返回模型输出，生成过程中定期保存检查点，结束后标记回复完成。
+    注意：用户消息已在路由中入库，这里不再重复写入。
+
+    Args:
+        stream_id: 流ID（响应头 X-Stream-Id），客户端断线后据此续传
+    """
+    import httpx
+    from reply_stream import ReplyStream
+
+    reply = ReplyStream(stream_id, subjectid)
+    complete = False
+    chunks = 0
+    upstream_open = False
+    _count_generation("started")
+
+    try:
+        # 1) 先把 subjectid 作为首段发给前端
+        yield str(subjectid)
+
+        # 输入超出模型上下文时直接返回错误，不占用推理服务
+        try:
+            rag_budget = await asyncio.to_thread(_user_message_budget, text)
+        except PromptTooLongError as too_long:
+            print(too_long)
+            yield f"错误: {too_long}"
+            return
+
+        # 使用 RAG 增强查询（添加异常处理）
+        try:
+            rag = await asyncio.to_thread(prepare_rag_query, text, rag_budget)
+        except Exception as rag_error:
+            print(f"RAG 增强失败，使用原始查询: {rag_error}")
+            rag = {"text": text, "embedding": None, "chunk_ids": (), "index_version": None}
+        enhanced_text = rag["text"]
+
+        # 本地模型服务配置
+        try:
+            local_model_url, model_name = _get_model_config()
+        except ValueError as config_error:
+            error_msg = str(config_error)
+            print(error_msg)
+            yield f"错误: {error_msg}"
+            return
+
+        # 同一主题的对话记忆：在 token 预算内带上最近的轮次和更早轮次的摘要
+        history = {"summary": None, "messages": []}
+        try:
+            budget = await asyncio.to_thread(_history_budget, enhanced_text)
+            history = await build_conversation_context(subjectid, text, budget)
+        except Exception as memory_error:
+            print(f"读取对话记忆失败，仅使用本轮消息: {memory_error}")
+
+        # 语义缓存命中时回放缓存的答案（同样在 finally 中入库），不调用模型
+        cache_key = None
+        if not history["messages"] and not history["summary"]:
+            cache_key = _answer_cache_key(rag, model_name)
+        if cache_key is not None:
+            cached = _answer_cache.get(rag["embedding"], cache_key)
+            if cached is not None:
+                print("语义缓存命中，回放缓存的回答")
+                async for piece in _replay_answer(cached):
+                    reply.append(piece)
+                    chunks += 1
+                    yield piece
+                complete = True
+                _count_generation("completed")
+                return
+
+        payload = await asyncio.to_thread(
+            _build_payload, model_name, enhanced_text, stream=True, system_prompt=RAG_SYSTEM_PROMPT,
+            history=history["messages"], summary=history["summary"]
+        )
+
+        # 2) 调用流式模型
+        print(f"发送请求到: {local_model_url}")
+
+        response = await _async_send("POST", local_model_url, payload, stream=True)
+        upstream_open = True
+        try:
+            print(f"响应状态码: {response.status_code}")
+            if response.status_code != 200:
+                body = (await response.aread()).decode("utf-8", errors="ignore")
+                print(f"响应内容: {body}")
+                raise httpx.HTTPStatusError(
+                    f"HTTP {response.status_code}: {body}",
+                    request=response.request, response=response
+                )
+
+            # 3) 边生成边返回给前端
+            completed = False
+            async for line in response.aiter_lines():
+                if not line:
+                    continue
+                done, chunk_content = _parse_sse_line(line)
+                if done:
+                    completed = True
+                    break
+                if chunk_content:
+                    reply.append(chunk_content)
+                    chunks += 1
+                    yield chunk_content
+        finally:
+            # 未读完就关闭时断开到推理服务的连接，推理服务据此中止该请求（客户端断开时不再继续生成）
+            await response.aclose()
+        upstream_open = False
+        complete = True
+        _count_generation("completed")
+
+        # 只缓存完整生成（收到 [DONE]）的回答
+        if completed and cache_key is not None and reply.length:
+            _answer_cache.set(rag["embedding"], cache_key, reply.text())
+
+    except (asyncio.CancelledError, GeneratorExit):
+        # 客户端断开：请求任务被取消，或响应结束后关闭了生成器
+        _record_abort(subjectid, chunks, upstream_open)
+        raise
+    except httpx.HTTPError as e:
+        _count_generation("failed")
+        error_msg = f"调用本地模型失败: {e}"
+        print(error_msg)
+        yield f"错误: {error_msg}"
+        return
+    except Exception as e:
+        _count_generation("failed")
+        error_msg = f"流式调用异常: {e}"
+        print(error_msg)
+        yield f"错误: {error_msg}"
+        return
+    finally:
+        # 4) 保存最终内容并标记完成/中断：在后台任务中执行，客户端断开导致的取消不影响入库
+        reply.finish(complete)
+
+
+async def _async_save_assistant_reply(subjectid: int, content: str):
+    """_save_assistant_reply 的异步版本：写入消息存储（WAL + 后台批量入库）"""
+    from message_store import get_message_store
+
+    try:
+        await get_message_store().add(subjectid, "assistant", content)
+        print(f"AI 回复已提交保存：subjectid={subjectid}, length={len(content)}")
+    except Exception as e:
+        print(f"保存 AI 回复失败: {e}")
+        # 异步路径失败时回退到同步实现（含默认主题兜底），在线程中执行
+        await asyncio.to_thread(_save_assistant_reply, subjectid, content)
@@ -1,13 +1,56 @@
+from contextlib import asynccontextmanager
+import asyncio
 from fastapi import FastAPI
+import os
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
-import uvicorn
 from pathlib import Path
 
 from routes import router  # 导入路由
 
+
+# 启动时在后台预热 RAG（嵌入模型 + 向量库），不阻塞服务启动
+RAG_WARMUP = os.getenv("RAG_WARMUP", "true").lower() in ("1", "true", "yes")
+SCHEMA_CHECK_TIMEOUT = 10  # 启动时检查表结构的最长等待（秒），MySQL 不可用时不阻塞启动
+SHUTDOWN_TASK_TIMEOUT = float(os.getenv("SHUTDOWN_TASK_TIMEOUT", 10))  # 关闭时等待后台任务的最长时间（秒）
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """应用生命周期：启动时后台预热 RAG，退出时释放连接池和 HTTP 客户端"""
+    if RAG_WARMUP:
+        from rag_service import start_rag_warmup
+        start_rag_warmup()
+    # 分词器和上下文长度在后台加载，加载完成前请求使用估算计数，不阻塞事件循环
+    import token_budget
+    token_budget.start_warmup()
+    # 检查数据库是否已执行全部迁移；缺少的迁移对应的功能退回旧表结构的行为
+    from database import check_schema
+    try:
+        missing = await asyncio.wait_for(check_schema(), timeout=SCHEMA_CHECK_TIMEOUT)
+    except Exception as e:
+        print(f"数据库表结构检查失败（将在首次使用时重新检查）: {e!r}")
+    else:
+        for name in missing:
+            print(f"警告：数据库尚未执行迁移 server/tool/migrations/{name}，相关功能已降级；"
+                  f"执行迁移后重启服务生效")
+    # 消息写后持久化：回放上次未入库的 WAL 并启动后台批量写入
+    from message_store import get_message_store
+    await get_message_store().start()
+    yield
+    # 后台任务（保存回复、写语义缓存）还会写入消息存储，先等它们结束
+    from llm_utils import wait_background_tasks, close_async_http_client
+    await wait_background_tasks(SHUTDOWN_TASK_TIMEOUT)
+    # 再写完队列中的消息，最后关闭连接池
+    await get_message_store().close()
+    from database import close_pool, close_async_pool
+    await close_async_http_client()
+    await close_async_pool()
+    close_pool()
+
+
 # FastAPI 应用
-app = FastAPI(title="My API", version="1.0.0")
+app = FastAPI(title="My API", version="1.0.0", lifespan=lifespan)
 
 # CORS，允许所有源
 app.add_middleware(
@@ -16,6 +59,7 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Stream-Id"],  # 前端读取流ID用于断线续传
 )
 
 # 静态资源（使用绝对路径，若不存在则创建）
@@ -44,20 +88,11 @@ if __name__ == "__main__":
         print("请检查数据库配置和环境变量")
         exit(1)
     
-    # 2. 数据库连接正常后，再检查RAG
-    print("检查RAG向量数据库...")
-    try:
-        from rag_service import check_and_initialize_vector_db
-        vector_db_success = check_and_initialize_vector_db()
-        
-        if vector_db_success:
-            print("✅ 向量数据库准备就绪，RAG 功能可用")
-        else:
-            print("⚠️  向量数据库初始化失败，将使用基础 LLM 功能")
-    except Exception as e:
-        print(f"⚠️  向量数据库检查异常: {e}")
-        print("系统将使用基础 LLM 功能继续运行")
+    # 2. RAG 向量数据库在应用启动后由 lifespan 在后台预热，
+    #    预热完成前对话使用基础 LLM 功能，可通过 /readyz 查看状态
+    print("RAG 向量数据库将在后台预热")
 
-    # 3. 启动服务器
+    # 3. 启动服务器（uvicorn 只在直接运行时需要，被 uvicorn main:app 导入时不加载）
+    import uvicorn
     print("🌐 启动 FastAPI 服务器...")
     uvicorn.run(app, host="0.0.0.0", port=8000)
@@ -0,0 +1,401 @@
+"""
+后台维护任务（向量数据库重建、刷新等）
+
+同一时间只运行一个维护任务；任务运行期间再次提交会合并到正在运行的任务。
+任务函数接收 MaintenanceJob 参数，通过 job.reporter(stage) 上报进度，
+并在上报时检查取消请求。
+
+多 worker 部署时任务状态保存在 JOBS_DIR（vector_db/versions/jobs）下，所有 worker 共享：
+- active.lock   运行任务的 worker 持有的文件锁（单任务保证，进程退出时自动释放）
+- ACTIVE        正在运行的任务ID，其他 worker 提交时据此合并
+- <任务ID>.json 任务状态和进度（原子写入），任意 worker 都能查询
+- <任务ID>.cancel 取消标记，由运行任务的 worker 在上报进度时检查
+"""
+import os
+import json
+import time
+import threading
+import traceback
+from uuid import uuid4
+
+try:
+    import fcntl
+except ImportError:  # Windows 没有 fcntl，任务状态只在本进程内有效（仅适用于单 worker）
+    fcntl = None
+
+FINISHED_STATUSES = ("succeeded", "failed", "cancelled")
+JOBS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "vector_db", "versions", "jobs")
+JOB_SAVE_INTERVAL = 0.5  # 进度写入文件的最短间隔（秒），状态变化时立即写入
+LOCK_FILE = "active.lock"
+ACTIVE_FILE = "ACTIVE"
+
+
+class JobCancelled(Exception):
+    """任务被取消，由进度回调抛出"""
+
+
+class MaintenanceJob:
+    """单个后台任务的状态"""
+
+    def __init__(self, kind: str, manager: "JobManager" = None):
+        self.id = uuid4().hex
+        self.kind = kind
+        self.status = "pending"  # pending / running / succeeded / failed / cancelled
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.result = None
+        self.error = None
+        self.progress = {"stage": None, "done": 0, "total": 0, "eta_seconds": None}
+        self._stage_started_at = None
+        self._cancel_event = threading.Event()
+        self._manager = manager  # 共享状态目录（None 时只在本进程内）
+        self._saved_at = 0.0
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "MaintenanceJob":
+        """由其他 worker 写入的状态文件还原（只读快照）"""
+        job = cls(data["kind"])
+        job.id = data["job_id"]
+        for key in ("status", "created_at", "started_at", "finished_at", "result", "error", "progress"):
+            setattr(job, key, data.get(key))
+        if data.get("cancel_requested"):
+            job._cancel_event.set()
+        return job
+
+    @property
+    def finished(self) -> bool:
+        return self.status in FINISHED_STATUSES
+
+    @property
+    def cancel_requested(self) -> bool:
+        if not self._cancel_event.is_set() and self._manager is not None and self._manager.cancel_marked(self.id):
+            self._cancel_event.set()
+        return self._cancel_event.is_set()
+
+    def cancel(self):
+        """请求取消，任务在下一次上报进度时停止"""
+        self._cancel_event.set()
+
+    def check_cancelled(self):
+        if self.cancel_requested:
+            raise JobCancelled(f"任务 {self.id} 已取消")
+
+    def save(self, force: bool = False):
+        """写入共享状态文件（进度更新按 JOB_SAVE_INTERVAL 节流）"""
+        if self._manager is None:
+            return
+        now = time.monotonic()
+        if force or now - self._saved_at >= JOB_SAVE_INTERVAL:
+            self._saved_at = now
+            self._manager.save_job(self)
+
+    def update(self, stage: str, done: int = 0, total: int = 0, **extra):
+        """
+        更新进度，并根据当前阶段的处理速度估算剩余时间
+
+        Args:
+            stage: 阶段名，例如 "loading"、"embedding"
+            done: 已完成数量
+            total: 总数量
+            extra: 额外字段，例如 files_loaded、chunks_embedded
+        """
+        now = time.time()
+        stage_changed = stage != self.progress.get("stage")
+        if stage_changed:
+            self._stage_started_at = now
+        eta = None
+        elapsed = now - (self._stage_started_at or now)
+        if total and 0 < done < total and elapsed > 0:
+            eta = round((total - done) * elapsed / done, 1)
+        elif total and done >= total:
+            eta = 0
+        progress = dict(self.progress)
+        progress.update(extra)
+        progress.update({"stage": stage, "done": done, "total": total, "eta_seconds": eta})
+        self.progress = progress
+        self.save(force=stage_changed)
+        self.check_cancelled()
+
+    def reporter(self, stage: str, done_key: str = None, total_key: str = None):
+        """返回 progress(done, total) 回调，供 load_and_split / _embed_texts 使用"""
+        def _report(done, total):
+            extra = {}
+            if done_key:
+                extra[done_key] = done
+            if total_key:
+                extra[total_key] = total
+            self.update(stage, done, total, **extra)
+        return _report
+
+    def to_dict(self) -> dict:
+        elapsed = None
+        if self.started_at:
+            elapsed = round((self.finished_at or time.time()) - self.started_at, 2)
+        return {
+            "job_id": self.id,
+            "kind": self.kind,
+            "status": self.status,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+            "elapsed_time": elapsed,
+            "progress": self.progress,
+            "cancel_requested": self.cancel_requested,
+            "result": self.result,
+            "error": self.error,
+        }
+
+
+class JobManager:
+    """
+    在后台线程中运行维护任务（同一时间最多一个），并保留最近的任务记录供查询
+
+    state_dir 不为 None 时（默认 JOBS_DIR），单任务保证和任务记录跨 worker 进程共享；
+    为 None 时只在本进程内有效。
+    """
+
+    def __init__(self, max_history: int = 50, state_dir: str = None):
+        self.max_history = max_history
+        self.state_dir = state_dir if fcntl is not None else None
+        self._jobs = {}
+        self._active = None
+        self._lock = threading.Lock()
+        self._slot = None  # 持有 active.lock 的文件对象
+
+    # ------------------------------------------------------------------
+    # 共享状态文件
+    # ------------------------------------------------------------------
+    def _path(self, name: str) -> str:
+        return os.path.join(self.state_dir, name)
+
+    def save_job(self, job: MaintenanceJob):
+        if self.state_dir is None:
+            return
+        path = self._path(f"{job.id}.json")
+        tmp_path = f"{path}.tmp-{os.getpid()}-{threading.get_ident()}"
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(job.to_dict(), f, ensure_ascii=False, default=str)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            print(f"保存任务状态失败 {job.id}: {e}")
+
+    def _load_job(self, job_id: str):
+        try:
+            with open(self._path(f"{job_id}.json"), "r", encoding="utf-8") as f:
+                job = MaintenanceJob.from_dict(json.load(f))
+        except (OSError, ValueError, KeyError):
+            return None
+        if not job.finished and self.cancel_marked(job_id):
+            job._cancel_event.set()
+        if not job.finished and (self._active_id() != job_id or self._slot_free()):
+            # 状态未结束，但文件锁已释放或已有其他任务在运行：运行该任务的 worker 已退出
+            job.status = "failed"
+            job.error = "运行任务的 worker 已退出"
+            job.finished_at = job.finished_at or time.time()
+            self.save_job(job)
+        return job
+
+    def _active_id(self):
+        try:
+            with open(self._path(ACTIVE_FILE), "r", encoding="utf-8") as f:
+                return f.read().strip()
+        except OSError:
+            return None
+
+    def cancel_marked(self, job_id: str) -> bool:
+        return self.state_dir is not None and os.path.exists(self._path(f"{job_id}.cancel"))
+
+    def _try_lock(self):
+        """非阻塞获取 active.lock，成功时返回持有锁的文件对象"""
+        os.makedirs(self.state_dir, exist_ok=True)
+        lock = open(self._path(LOCK_FILE), "a")
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock.close()
+            return None
+        return lock
+
+    def _slot_free(self) -> bool:
+        if self._slot is not None:
+            return False
+        lock = self._try_lock()
+        if lock is None:
+            return False
+        fcntl.flock(lock, fcntl.LOCK_UN)
+        lock.close()
+        return True
+
+    def _claim_or_join(self):
+        """
+        获取单任务文件锁，返回 (True, None)；其他 worker 正在运行任务时返回 (False, 该任务)
+
+        对方刚拿到锁还没写入 ACTIVE、或已写入最终状态还没释放锁时，稍等片刻后重试。
+        """
+        deadline = time.monotonic() + 1.0
+        while True:
+            self._slot = self._try_lock()
+            if self._slot is not None:
+                return True, None
+            job_id = self._active_id()
+            job = self._load_job(job_id) if job_id else None
+            if job is not None and not job.finished:
+                return False, job
+            if time.monotonic() >= deadline:
+                raise RuntimeError("其他 worker 正在启动维护任务，请稍后重试")
+            time.sleep(0.05)
+
+    # ------------------------------------------------------------------
+    # 任务
+    # ------------------------------------------------------------------
+    def submit(self, kind: str, func):
+        """
+        提交任务，立即返回 (job, merged)
+
+        已有任务（本进程或其他 worker）在运行时不启动新任务，直接返回正在运行的任务，merged 为 True。
+
+        Args:
+            kind: 任务类型，例如 "rebuild"、"refresh"
+            func: func(job)，返回值作为任务结果；返回 False、{"success": False}
+                  或抛出异常视为失败
+        """
+        with self._lock:
+            if self._active is not None and not self._active.finished:
+                return self._active, True
+            if self.state_dir is not None:
+                claimed, other = self._claim_or_join()
+                if not claimed:
+                    return other, True
+            job = MaintenanceJob(kind, manager=self if self.state_dir is not None else None)
+            self._jobs[job.id] = job
+            self._active = job
+            if self.state_dir is not None:
+                # 先写 ACTIVE 再写状态文件：其他 worker 读到状态文件时 ACTIVE 已指向该任务
+                with open(self._path(ACTIVE_FILE), "w", encoding="utf-8") as f:
+                    f.write(job.id)
+                job.save(force=True)
+            self._trim()
+        thread = threading.Thread(target=self._run, args=(job, func),
+                                  name=f"maintenance-{kind}-{job.id[:8]}", daemon=True)
+        thread.start()
+        return job, False
+
+    def _run(self, job: MaintenanceJob, func):
+        job.status = "running"
+        job.started_at = time.time()
+        job.save(force=True)
+        status, error = "failed", None
+        try:
+            job.check_cancelled()
+            result = func(job)
+            job.result = result
+            failed = result is False or (isinstance(result, dict) and result.get("success") is False)
+            if job.cancel_requested and failed:
+                status = "cancelled"
+            else:
+                status = "failed" if failed else "succeeded"
+        except JobCancelled:
+            status = "cancelled"
+            print(f"后台任务已取消 {job.kind}/{job.id}")
+        except Exception as e:
+            error = str(e)
+            print(f"后台任务失败 {job.kind}/{job.id}: {e}")
+            print(f"详细错误: {traceback.format_exc()}")
+        finally:
+            # 先写入最终状态再释放文件锁，其他 worker 不会把结束中的任务误判为已退出
+            with self._lock:
+                job.error = error
+                job.status = status
+                job.finished_at = time.time()
+                job.save(force=True)
+                self._release_slot(job)
+
+    def _release_slot(self, job: MaintenanceJob):
+        if self._slot is None:
+            return
+        try:
+            os.remove(self._path(f"{job.id}.cancel"))
+        except OSError:
+            pass
+        fcntl.flock(self._slot, fcntl.LOCK_UN)
+        self._slot.close()
+        self._slot = None
+
+    def _trim(self):
+        """只保留最近 max_history 个已结束的任务"""
+        finished = [j for j in self._jobs.values() if j.finished]
+        overflow = len(self._jobs) - self.max_history
+        for job in sorted(finished, key=lambda j: j.created_at)[:max(0, overflow)]:
+            del self._jobs[job.id]
+        if self.state_dir is None:
+            return
+        stored = [job for job in self._stored_jobs() if job.finished]
+        overflow = len(stored) - self.max_history
+        for job in sorted(stored, key=lambda j: j.created_at)[:max(0, overflow)]:
+            for name in (f"{job.id}.json", f"{job.id}.cancel"):
+                try:
+                    os.remove(self._path(name))
+                except OSError:
+                    pass
+
+    def _stored_jobs(self) -> list:
+        if not os.path.isdir(self.state_dir):
+            return []
+        jobs = []
+        for name in os.listdir(self.state_dir):
+            if name.endswith(".json"):
+                job = self._jobs.get(name[:-5]) or self._load_job(name[:-5])
+                if job is not None:
+                    jobs.append(job)
+        return jobs
+
+    def get(self, job_id: str):
+        """查询任务：本进程运行的任务返回实时对象，其他 worker 的任务从状态文件读取"""
+        with self._lock:
+            job = self._jobs.get(job_id)
+        if job is None and self.state_dir is not None and len(job_id) == 32 and job_id.isalnum():
+            job = self._load_job(job_id)
+        return job
+
+    def active(self):
+        """正在运行的任务，没有时返回 None"""
+        with self._lock:
+            if self._active is not None and not self._active.finished:
+                return self._active
+        if self.state_dir is not None and not self._slot_free():
+            job_id = self._active_id()
+            job = self._load_job(job_id) if job_id else None
+            if job is not None and not job.finished:
+                return job
+        return None
+
+    def cancel(self, job_id: str):
+        """请求取消任务（可以是其他 worker 运行的任务），任务不存在时返回 None"""
+        job = self.get(job_id)
+        if job is not None and not job.finished:
+            if self.state_dir is not None:
+                open(self._path(f"{job_id}.cancel"), "w").close()
+            job.cancel()
+        return job
+
+    def list(self):
+        with self._lock:
+            jobs = {job.id: job for job in self._jobs.values()}
+        if self.state_dir is not None:
+            for job in self._stored_jobs():
+                jobs.setdefault(job.id, job)
+        return [job.to_dict() for job in sorted(jobs.values(), key=lambda j: j.created_at, reverse=True)]
+
+
+# 全局任务管理器
+_job_manager = None
+
+
+def get_job_manager() -> JobManager:
+    """获取任务管理器实例（状态保存在 JOBS_DIR，多个 worker 共享）"""
+    global _job_manager
+    if _job_manager is None:
+        _job_manager = JobManager(state_dir=JOBS_DIR)
+    return _job_manager
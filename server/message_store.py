@@ -0,0 +1,431 @@
+"""
+聊天消息写后持久化（write-behind）
+
+消息先追加到本地 WAL 文件并进入内存队列，立即返回；后台任务按数量（MESSAGE_BATCH_SIZE）
+或时间（MESSAGE_FLUSH_INTERVAL）触发，把队列中的消息用多行 INSERT 批量写入 chatcontent。
+
+持久性保证：
+- add() 返回时消息已写入 WAL（MESSAGE_WAL_FSYNC=true 时已 fsync），进程崩溃或 MySQL 暂时不可用都不会丢失；
+  fsync 在线程中执行不阻塞事件循环，等待期间其他 add() 追加的记录由下一次 fsync 一并落盘（组提交）；
+  MySQL 不可用期间消息留在队列和 WAL 中，按指数退避重试
+- 一批消息提交成功后，WAL 中对应的记录才会删除（段文件删除或清空）
+- 每条 WAL 记录带唯一ID（wid），写入 chatcontent.wal_id；启动时回放上次未写入的 WAL 段，
+  回放的消息按该ID去重，因此提交成功后、删除 WAL 前崩溃也不会产生重复消息
+  （未执行迁移 003 的数据库没有 wal_id 列，退回按 (主题, 角色, 时间, 内容) 去重）
+- 外键失败（主题已被删除）时逐条重试，失败的消息追加到 WAL 目录下的死信文件，同批其他消息照常写入
+- 正常退出时（lifespan 结束）会写完全部队列
+
+同一进程内消息按入队顺序写入，自增ID与对话顺序一致。多个 worker 各自使用独立的 WAL 段文件，
+段文件持有文件锁，启动回放时只接管没有被其他进程锁定的段。
+"""
+import os
+import json
+import time
+import uuid
+import asyncio
+from collections import deque
+
+from database import get_async_db_connection, has_columns
+from cache_utils import LRUCache
+
+try:
+    import fcntl
+except ImportError:  # Windows 没有 fcntl，回放时不检查文件锁（仅适用于单 worker）
+    fcntl = None
+
+MESSAGE_WRITE_BEHIND = os.getenv("MESSAGE_WRITE_BEHIND", "true").lower() in ("1", "true", "yes")
+MESSAGE_BATCH_SIZE = int(os.getenv("MESSAGE_BATCH_SIZE", 50))            # 每批最多写入的消息数，达到即触发写入
+MESSAGE_FLUSH_INTERVAL = float(os.getenv("MESSAGE_FLUSH_INTERVAL", 0.2))  # 最长写入间隔（秒）
+# 相对路径基于本模块所在目录，与启动时的工作目录无关
+MESSAGE_WAL_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.getenv("MESSAGE_WAL_DIR", "message_wal"))
+MESSAGE_WAL_FSYNC = os.getenv("MESSAGE_WAL_FSYNC", "false").lower() in ("1", "true", "yes")  # 每条消息 fsync
+MESSAGE_RETRY_MAX = float(os.getenv("MESSAGE_RETRY_MAX", 30))            # 写入失败后的最大重试间隔（秒）
+WAL_SEGMENT_MAX_BYTES = 16 * 1024 * 1024  # 段文件超过该大小时切换新段（MySQL 长时间不可用时）
+DEAD_LETTER_FILE = "dead_letter.jsonl"    # 外键失败、无法写入的消息
+
+INSERT_PREFIX = "INSERT INTO chatcontent (subjectid, content, role, created_at) VALUES "
+INSERT_ROW = "(%s, %s, %s, FROM_UNIXTIME(%s))"
+# 已执行迁移 003（有 wal_id 列）时使用
+INSERT_PREFIX_WAL = "INSERT INTO chatcontent (subjectid, content, role, created_at, wal_id) VALUES "
+INSERT_ROW_WAL = "(%s, %s, %s, FROM_UNIXTIME(%s), %s)"
+FK_ERROR = 1452  # 外键约束失败：主题不存在
+
+
+class _Segment:
+    """WAL 段文件（每行一条 JSON 记录），打开期间持有排他文件锁"""
+
+    def __init__(self, path: str, mode: str = "a"):
+        self.path = path
+        self.file = open(path, mode, encoding="utf-8")
+        self.pending = 0    # 尚未写入数据库的记录数
+        self.appended = 0   # 本进程追加的记录数（只增不减，清空段文件后也不重置）
+        self.synced = 0     # 其中已 fsync 的记录数
+        self.syncing = False
+        if fcntl is not None:
+            try:
+                fcntl.flock(self.file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                self.file.close()
+                raise
+
+    def append(self, record: dict):
+        self.file.write(json.dumps(record, ensure_ascii=False) + "\n")
+        self.file.flush()
+        self.appended += 1
+        self.pending += 1
+
+    def size(self) -> int:
+        return self.file.tell()
+
+    def truncate(self):
+        self.file.seek(0)
+        self.file.truncate()
+
+    def remove(self):
+        self.file.close()
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+
+class MessageStore:
+    def __init__(self):
+        self._queue = deque()  # (记录, 段)
+        self._segments = []    # 全部未删除的段，最后一个为当前写入段
+        self._seq = 0
+        self._flush_lock = None
+        self._wakeup = None
+        self._task = None
+        self._sync_task = None  # 正在线程中执行的 fsync（同一时刻只有一个）
+        self._closed = False
+        self._retry_delay = 0.0
+        # 已确认存在的主题，跳过每轮的 SELECT
+        self._known_subjects = LRUCache(max_size=10000)
+        self.stats_counters = {"written": 0, "batches": 0, "dead_lettered": 0, "recovered": 0, "failures": 0}
+
+    # ---------------------------------------------------------------------
+    # 生命周期
+    # ---------------------------------------------------------------------
+    async def start(self):
+        """打开 WAL、接管遗留段并启动后台写入任务"""
+        if not MESSAGE_WRITE_BEHIND or self._task is not None:
+            return
+        self._flush_lock = asyncio.Lock()
+        self._wakeup = asyncio.Event()
+        os.makedirs(MESSAGE_WAL_DIR, exist_ok=True)
+        self._recover()
+        self._new_segment()
+        self._task = asyncio.get_running_loop().create_task(self._run())
+        if self._queue:
+            self._wakeup.set()
+
+    async def close(self):
+        """写完队列中的全部消息后停止（MySQL 不可用时消息留在 WAL 中，下次启动回放）"""
+        if self._task is None:
+            return
+        self._closed = True
+        self._wakeup.set()
+        await self._task
+        self._task = None
+        await self.flush()
+        if self._sync_task is not None:
+            await asyncio.shield(self._sync_task)
+        for segment in self._segments:
+            if segment.pending == 0:
+                segment.remove()
+            else:
+                segment.file.close()
+                print(f"{segment.pending} 条消息未写入数据库，保留在 {segment.path}")
+        self._segments = []
+
+    # ---------------------------------------------------------------------
+    # 写入
+    # ---------------------------------------------------------------------
+    async def add(self, subjectid: int, role: str, content: str):
+        """保存一条消息：写后模式下写入 WAL 并入队后立即返回，否则直接写入数据库"""
+        record = {"subjectid": subjectid, "role": role, "content": content, "ts": int(time.time()),
+                  "wid": uuid.uuid4().hex}
+        if self._task is None:
+            await self._insert([record])
+            return
+        segment = self._segments[-1]
+        if segment.size() > WAL_SEGMENT_MAX_BYTES:
+            segment = self._new_segment()
+        segment.append(record)
+        self._queue.append((record, segment))
+        # 重试退避期间不因数量触发，等待退避结束
+        if len(self._queue) >= MESSAGE_BATCH_SIZE and not self._retry_delay:
+            self._wakeup.set()
+        if MESSAGE_WAL_FSYNC:
+            await self._sync(segment, segment.appended)
+
+    def pending_rows(self, subjectid: int) -> list:
+        """主题下尚未写入数据库的消息（按入队顺序）"""
+        return [record for record, _ in self._queue if record["subjectid"] == subjectid]
+
+    async def sync_subject(self, subjectid: int, current_user_text: str = None):
+        """
+        确保主题的消息已写入数据库，供读取历史前调用
+
+        Args:
+            current_user_text: 本轮刚入队的用户消息，读取方会自行排除它，只有它待写入时不必等待
+        """
+        pending = self.pending_rows(subjectid)
+        if not pending:
+            return
+        last = pending[-1]
+        if len(pending) == 1 and last["role"] == "user" and last["content"] == current_user_text:
+            return
+        await self.flush()
+
+    def forget_subject(self, subjectid: int):
+        """删除主题前调用：丢弃该主题待写入的消息"""
+        self._known_subjects.delete(subjectid)
+        kept = deque()
+        for record, segment in self._queue:
+            if record["subjectid"] == subjectid:
+                segment.pending -= 1
+            else:
+                kept.append((record, segment))
+        self._queue = kept
+
+    async def flush(self) -> bool:
+        """立即写入队列中的全部消息，返回是否全部写入成功"""
+        if self._flush_lock is None:
+            return True
+        async with self._flush_lock:
+            while self._queue:
+                batch = [self._queue[i] for i in range(min(MESSAGE_BATCH_SIZE, len(self._queue)))]
+                try:
+                    await self._insert([record for record, _ in batch])
+                except Exception as e:
+                    self.stats_counters["failures"] += 1
+                    print(f"消息批量写入失败，{len(self._queue)} 条消息保留在队列和 WAL 中: {e}")
+                    return False
+                # 提交成功后出队并释放 WAL 记录；写入期间 forget_subject 可能已移除其中的消息
+                written = {id(record) for record, _ in batch}
+                remaining = deque()
+                for record, segment in self._queue:
+                    if id(record) in written:
+                        segment.pending -= 1
+                    else:
+                        remaining.append((record, segment))
+                self._queue = remaining
+                self._release_segments()
+                self.stats_counters["batches"] += 1
+            return True
+
+    async def _insert(self, records: list):
+        """多行 INSERT 写入一批消息；外键失败时逐条重试，主题已删除的消息移入死信文件"""
+        with_wal_id = await has_columns("003_message_wal_id.sql")
+        async with get_async_db_connection() as conn:
+            async with conn.cursor() as cursor:
+                rows = await self._skip_written(cursor, records, with_wal_id)
+                inserted = len(rows)
+                if rows:
+                    prefix, row_sql = (INSERT_PREFIX_WAL, INSERT_ROW_WAL) if with_wal_id else (INSERT_PREFIX, INSERT_ROW)
+                    try:
+                        await cursor.execute(
+                            prefix + ", ".join([row_sql] * len(rows)),
+                            [value for record in rows for value in self._values(record, with_wal_id)]
+                        )
+                    except Exception as e:
+                        if not e.args or e.args[0] != FK_ERROR:
+                            raise
+                        failed = []
+                        for record in rows:
+                            try:
+                                await cursor.execute(prefix + row_sql, self._values(record, with_wal_id))
+                            except Exception as row_error:
+                                if not row_error.args or row_error.args[0] != FK_ERROR:
+                                    raise
+                                failed.append(record)
+                        inserted -= len(failed)
+                        self._dead_letter(failed, str(e))
+                await conn.commit()
+        self.stats_counters["written"] += inserted
+
+    @staticmethod
+    def _values(record: dict, with_wal_id: bool):
+        values = (record["subjectid"], record["content"], record["role"], record["ts"])
+        return values + (record.get("wid"),) if with_wal_id else values
+
+    async def _skip_written(self, cursor, records: list, with_wal_id: bool) -> list:
+        """去掉回放消息中已经写入过的（提交后、删除 WAL 前崩溃的情况）"""
+        recovered = [record for record in records if record.get("recovered")]
+        if not recovered:
+            return records
+        written = set()
+        if with_wal_id:
+            wids = [record["wid"] for record in recovered if record.get("wid")]
+            if wids:
+                await cursor.execute(
+                    "SELECT wal_id FROM chatcontent WHERE wal_id IN (" + ", ".join(["%s"] * len(wids)) + ")",
+                    wids
+                )
+                written = {row["wal_id"] for row in await cursor.fetchall()}
+        rows = []
+        for record in records:
+            if record.get("recovered"):
+                if record.get("wid") and with_wal_id:
+                    if record["wid"] in written:
+                        continue
+                elif await self._exists(cursor, record):
+                    continue  # 旧版本写入的 WAL 记录没有 wid
+            rows.append(record)
+        return rows
+
+    @staticmethod
+    async def _exists(cursor, record: dict) -> bool:
+        """按 (主题, 角色, 时间, 内容) 判断消息是否已写入（没有 wal_id 时的退路，精确到秒）"""
+        await cursor.execute(
+            "SELECT 1 FROM chatcontent WHERE subjectid = %s AND role = %s "
+            "AND created_at = FROM_UNIXTIME(%s) AND content = %s LIMIT 1",
+            (record["subjectid"], record["role"], record["ts"], record["content"])
+        )
+        return await cursor.fetchone() is not None
+
+    def _dead_letter(self, records: list, reason: str):
+        """外键失败的消息追加到死信文件（fsync 后才算从 WAL 移出），并让主题缓存失效"""
+        if not records:
+            return
+        os.makedirs(MESSAGE_WAL_DIR, exist_ok=True)
+        path = os.path.join(MESSAGE_WAL_DIR, DEAD_LETTER_FILE)
+        with open(path, "a", encoding="utf-8") as f:
+            for record in records:
+                entry = {key: value for key, value in record.items() if key != "recovered"}
+                entry.update(error=reason, failed_at=int(time.time()))
+                f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        for record in records:
+            self._known_subjects.delete(record["subjectid"])
+        self.stats_counters["dead_lettered"] += len(records)
+        subjects = sorted({record["subjectid"] for record in records})
+        print(f"主题 {subjects} 不存在，{len(records)} 条消息移入死信文件 {path}")
+
+    async def _run(self):
+        """后台写入循环：数量或时间触发，失败时指数退避"""
+        while not self._closed:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=max(MESSAGE_FLUSH_INTERVAL, self._retry_delay))
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            if not self._queue:
+                continue
+            if await self.flush():
+                self._retry_delay = 0.0
+            else:
+                self._retry_delay = min(MESSAGE_RETRY_MAX, max(1.0, self._retry_delay * 2))
+
+    # ---------------------------------------------------------------------
+    # WAL 段
+    # ---------------------------------------------------------------------
+    def _new_segment(self) -> "_Segment":
+        self._seq += 1
+        # 随机后缀：同一毫秒内新建的段不会与刚接管的遗留段（PID 可能被复用）重名
+        name = f"wal-{os.getpid()}-{int(time.time() * 1000)}-{self._seq}-{uuid.uuid4().hex[:8]}.jsonl"
+        segment = _Segment(os.path.join(MESSAGE_WAL_DIR, name))
+        self._segments.append(segment)
+        return segment
+
+    async def _sync(self, segment: "_Segment", count: int):
+        """等待段中前 count 条记录 fsync 完成；已有 fsync 在执行时等它结束，再为之后追加的记录发起下一次"""
+        while segment.synced < count:
+            if self._sync_task is None:
+                self._sync_task = asyncio.get_running_loop().create_task(self._fsync(segment))
+            # 调用方被取消时不取消共享的 fsync，其他等待者仍需要它
+            await asyncio.shield(self._sync_task)
+
+    async def _fsync(self, segment: "_Segment"):
+        count = segment.appended
+        segment.syncing = True
+        try:
+            await asyncio.to_thread(os.fsync, segment.file.fileno())
+            segment.synced = max(segment.synced, count)
+        finally:
+            segment.syncing = False
+            self._sync_task = None
+
+    def _release_segments(self):
+        """删除已全部写入的旧段，清空已全部写入的当前段"""
+        active = self._segments[-1]
+        for segment in list(self._segments):
+            if segment.pending > 0 or segment.syncing:
+                continue  # fsync 线程仍在使用文件描述符时不关闭
+            if segment is active:
+                if segment.size():
+                    segment.truncate()
+            else:
+                segment.remove()
+                self._segments.remove(segment)
+
+    def _recover(self):
+        """接管 WAL 目录中其他（已退出的）进程遗留的段，记录重新入队"""
+        for name in sorted(os.listdir(MESSAGE_WAL_DIR)):
+            if not (name.startswith("wal-") and name.endswith(".jsonl")):
+                continue  # 死信文件等不参与回放
+            path = os.path.join(MESSAGE_WAL_DIR, name)
+            try:
+                segment = _Segment(path, mode="r+")
+            except BlockingIOError:
+                continue  # 其他 worker 正在使用
+            count = 0
+            for line in segment.file:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue  # 崩溃时写了一半的最后一行
+                record["recovered"] = True
+                self._queue.append((record, segment))
+                count += 1
+            segment.pending = count
+            if count:
+                self._segments.append(segment)
+                self.stats_counters["recovered"] += count
+                print(f"从 {name} 回放 {count} 条未写入的消息")
+            else:
+                segment.remove()
+
+    # ---------------------------------------------------------------------
+    # 主题
+    # ---------------------------------------------------------------------
+    async def ensure_subject(self, subjectid: int, title: str):
+        """
+        确认主题存在，不存在（或 subjectid 为 0）时用 title 创建
+
+        Returns:
+            (subjectid, created)
+        """
+        if subjectid and self._known_subjects.get(subjectid):
+            return subjectid, False
+        async with get_async_db_connection() as conn:
+            async with conn.cursor() as cursor:
+                if subjectid:
+                    await cursor.execute("SELECT id FROM subject WHERE id = %s", (subjectid,))
+                    if await cursor.fetchone():
+                        self._known_subjects.set(subjectid, True)
+                        return subjectid, False
+                    print(f"主题ID {subjectid} 不存在，创建新主题")
+                await cursor.execute("INSERT INTO subject (title) VALUES (%s)", (title,))
+                new_id = cursor.lastrowid
+                await conn.commit()
+        self._known_subjects.set(new_id, True)
+        return new_id, True
+
+    def stats(self) -> dict:
+        return dict(
+            self.stats_counters,
+            enabled=self._task is not None,
+            queued=len(self._queue),
+            wal_segments=len(self._segments),
+        )
+
+
+_store = MessageStore()
+
+
+def get_message_store() -> MessageStore:
+    return _store
@@ -0,0 +1,104 @@
+"""
+提示词组装：按推理服务前缀缓存（vLLM --enable-prefix-caching、SGLang RadixAttention 等）友好的顺序排列消息
+
+前缀缓存只复用逐 token 完全相同的开头部分，因此把不变的内容放在前面、每轮变化的内容放在最后：
+    system     身份提示词 + 固定的回答要求（所有 RAG 请求相同）
+               + 此前对话摘要（同一主题内稳定）
+    history    同一主题最近的对话轮次
+    user       知识库文本（按块ID排序）+ 用户问题
+
+知识库文本按块ID而不是相关度排序：同一批文本块无论检索名次如何，拼出的文本都相同。
+PROMPT_LAYOUT=legacy 时使用原来的布局（回答要求和知识库文本都在用户消息中），便于对比。
+"""
+import os
+import hashlib
+from functools import lru_cache
+from typing import List, Tuple
+
+from token_budget import count_tokens, count_static_tokens, MESSAGE_OVERHEAD_TOKENS
+
+# prefix（前缀缓存友好）/ legacy（原布局）
+PROMPT_LAYOUT = os.getenv("PROMPT_LAYOUT", "prefix").lower()
+# 请求中附带 prompt_cache_key（OpenAI 兼容字段），供支持的推理服务/网关把相同前缀的请求路由到同一实例
+LLM_CACHE_HINTS = os.getenv("LLM_CACHE_HINTS", "false").lower() in ("1", "true", "yes")
+
+RAG_INSTRUCTIONS = """回答要求：
+1. 如果用户消息中提供了专业知识库信息，首先参考其中相关的内容
+2. 结合您的通用知识进行补充和扩展
+3. 如果专业知识库信息不足或不够准确，请优先使用您的通用知识
+4. 确保回答准确、详细、有用"""
+
+
+def prefix_layout() -> bool:
+    return PROMPT_LAYOUT != "legacy"
+
+
+@lru_cache(maxsize=16)
+def rag_system_prompt(system_prompt: str) -> str:
+    """RAG 请求的系统提示词：前缀布局下把固定的回答要求放进系统提示词，成为所有请求共享的前缀"""
+    if not system_prompt or not prefix_layout():
+        return system_prompt
+    return f"{system_prompt}\n\n{RAG_INSTRUCTIONS}"
+
+
+def sort_chunks(chunks: List[Tuple[str, str]]) -> List[Tuple[str, str]]:
+    """(块ID, 文本) 按块ID排序；旧布局保持检索名次"""
+    if not prefix_layout():
+        return list(chunks)
+    return sorted(chunks, key=lambda chunk: chunk[0] or "")
+
+
+def rag_user_message(chunks: List[Tuple[str, str]], user_query: str) -> str:
+    """带知识库文本的用户消息，chunks 为 (块ID, 文本)"""
+    context = "\n\n".join(text for _, text in sort_chunks(chunks))
+    if prefix_layout():
+        return f"""专业知识库信息：
+{context}
+
+用户问题：{user_query}"""
+    return f"""请回答用户的问题。在回答时，请按以下优先级：
+
+1. 首先参考以下专业知识库信息（如果相关）：
+{context}
+
+2. 结合您的通用知识库进行补充和扩展
+3. 如果专业知识库信息不足或不够准确，请优先使用您的通用知识
+4. 确保回答准确、详细、有用
+
+用户问题：{user_query}
+
+请基于以上信息给出完整的回答。"""
+
+
+def build_messages(system_prompt: str, user_content: str, history: list = None, summary: str = None):
+    """
+    按前缀稳定的顺序组装消息列表，同时累计 token 数（固定的系统提示词使用缓存的计数）
+
+    Returns:
+        (messages, prompt_tokens)
+    """
+    messages = []
+    prompt_tokens = 0
+    if system_prompt:
+        prompt_tokens += count_static_tokens(system_prompt) + MESSAGE_OVERHEAD_TOKENS
+    if summary:
+        # 摘要接在系统提示词之后，不影响前面共享前缀的缓存命中
+        summary_block = f"此前对话摘要：\n{summary}"
+        prompt_tokens += count_tokens(summary_block) + (0 if system_prompt else MESSAGE_OVERHEAD_TOKENS)
+        system_prompt = f"{system_prompt}\n\n{summary_block}" if system_prompt else summary_block
+    if system_prompt:
+        messages.append({"role": "system", "content": system_prompt})
+    for message in history or []:
+        messages.append(message)
+        prompt_tokens += count_tokens(message["content"]) + MESSAGE_OVERHEAD_TOKENS
+    messages.append({"role": "user", "content": user_content})
+    prompt_tokens += count_tokens(user_content) + MESSAGE_OVERHEAD_TOKENS
+    return messages, prompt_tokens
+
+
+def cache_hint_fields(messages: list) -> dict:
+    """推理服务的缓存提示字段：按系统消息（固定前缀 + 主题摘要）生成 prompt_cache_key"""
+    if not LLM_CACHE_HINTS or not messages or messages[0]["role"] != "system":
+        return {}
+    digest = hashlib.sha1(messages[0]["content"].encode("utf-8")).hexdigest()[:16]
+    return {"prompt_cache_key": digest}
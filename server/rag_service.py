@@ -1,13 +1,163 @@
 """
 RAG 增强服务
+
+langchain / FAISS / sentence-transformers 的导入需要数秒，模块加载时不导入，
+只在首次构建或加载索引（通常是启动后的后台预热）时按需导入。
 """
+from __future__ import annotations
+
 import os
-from typing import List
-from langchain_community.vectorstores import FAISS
-from langchain_community.embeddings import HuggingFaceEmbeddings
-from langchain_community.document_loaders import TextLoader, PyPDFLoader
-from langchain.text_splitter import RecursiveCharacterTextSplitter
-from langchain.schema import Document
+import re
+import json
+import time
+import shutil
+import hashlib
+import threading
+from uuid import uuid4
+from typing import List, Dict, TYPE_CHECKING
+
+from cache_utils import LRUCache, normalize_query
+from token_budget import count_tokens, truncate_to_tokens
+from prompt_builder import rag_user_message
+from maintenance_jobs import JobCancelled
+from reranker import RERANK_CANDIDATES, get_reranker, get_rerank_stats
+import index_store
+
+if TYPE_CHECKING:
+    from langchain.schema import Document
+
+# 查询向量 / 检索结果缓存配置
+RAG_CACHE_SIZE = int(os.getenv("RAG_CACHE_SIZE", 1024))
+RAG_CACHE_TTL = float(os.getenv("RAG_CACHE_TTL", 0))  # 0 表示不过期
+
+# 知识库支持的文件类型
+SUPPORTED_EXTENSIONS = ['.txt', '.md', '.pdf']
+
+# 索引清单格式版本
+MANIFEST_VERSION = 1
+
+# 检查其他进程是否发布了新索引的间隔（秒）
+RAG_INDEX_CHECK_INTERVAL = float(os.getenv("RAG_INDEX_CHECK_INTERVAL", 30))
+
+# 索引构建配置
+RAG_LOAD_WORKERS = int(os.getenv("RAG_LOAD_WORKERS", max(1, (os.cpu_count() or 2) // 2)))  # 文档加载/分割进程数
+EMBED_BATCH_SIZE = int(os.getenv("EMBED_BATCH_SIZE", 64))   # 每批向量化的文本块数
+EMBED_THREADS = int(os.getenv("EMBED_THREADS", 0))          # 向量化线程数，0 表示使用 torch 默认值
+EMBED_BACKEND = os.getenv("EMBED_BACKEND", "torch").lower()  # torch / onnx（见 onnx_embeddings.py）
+
+# 按 token 预算裁剪检索结果时，截断后剩余不足该长度的文本块直接丢弃
+RAG_MIN_CHUNK_TOKENS = 50
+# 版本目录（index-<时间>-<随机串>）及其构建中的临时目录
+_VERSION_DIR_RE = re.compile(r"^(index-|\.tmp-)\d{8}-\d{6}-[0-9a-f]{6}$")
+
+# 混合检索：向量检索 + BM25 关键词检索，按倒数排名融合（RRF）
+RAG_HYBRID = os.getenv("RAG_HYBRID", "true").lower() in ("1", "true", "yes")
+RAG_HYBRID_CANDIDATES = int(os.getenv("RAG_HYBRID_CANDIDATES", 10))  # 每一路的候选数
+RAG_RRF_K = int(os.getenv("RAG_RRF_K", 60))                          # RRF 平滑常数
+
+_hybrid_pool = None
+_hybrid_pool_lock = threading.Lock()
+
+
+def _split_documents(documents: List[Document]) -> List[Document]:
+    """文本分割"""
+    from langchain.text_splitter import RecursiveCharacterTextSplitter
+
+    text_splitter = RecursiveCharacterTextSplitter(
+        chunk_size=500,  # 增大块大小以保持上下文
+        chunk_overlap=50,  # 增加重叠以保持连贯性
+        separators=["\n\n", "\n", "。", "！", "？", "；", " ", ""]
+    )
+    return text_splitter.split_documents(documents)
+
+
+def _load_file(file_path: str) -> List[Document]:
+    """根据文件类型选择加载器加载单个文件"""
+    from langchain_community.document_loaders import TextLoader, PyPDFLoader
+
+    if file_path.endswith('.pdf'):
+        loader = PyPDFLoader(file_path)
+    else:
+        loader = TextLoader(file_path, encoding="utf-8")
+    return loader.load()
+
+
+def _load_and_split_file(file_path: str):
+    """加载并分割单个文件（在进程池中执行，必须是模块级函数）"""
+    try:
+        return file_path, _split_documents(_load_file(file_path)), None
+    except Exception as e:
+        return file_path, [], str(e)
+
+
+def _get_hybrid_pool():
+    """关键词检索线程池（与向量检索并行执行）"""
+    global _hybrid_pool
+    if _hybrid_pool is None:
+        with _hybrid_pool_lock:
+            if _hybrid_pool is None:
+                from concurrent.futures import ThreadPoolExecutor
+                _hybrid_pool = ThreadPoolExecutor(max_workers=4, thread_name_prefix="rag-lexical")
+    return _hybrid_pool
+
+
+def reciprocal_rank_fusion(result_lists: List[List[Document]], limit: int, rrf_k: int = RAG_RRF_K) -> List[Document]:
+    """
+    倒数排名融合：每个文本块得分为各路结果中 1 / (rrf_k + 名次) 之和
+
+    按块ID去重（旧索引没有块ID时按文本），得分相同时先出现的（向量检索）在前。
+    """
+    scores = {}
+    docs = {}
+    for results in result_lists:
+        for rank, doc in enumerate(results, start=1):
+            key = doc.metadata.get("chunk_id") or doc.page_content
+            scores[key] = scores.get(key, 0.0) + 1.0 / (rrf_k + rank)
+            docs.setdefault(key, doc)
+    ranked = sorted(scores, key=scores.get, reverse=True)[:limit]
+    return [docs[key] for key in ranked]
+
+
+class _LatencyStats:
+    """单路检索的次数和耗时统计（检索在线程池中并发执行，读写都在锁内）"""
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self._lock = threading.Lock()
+
+    def add(self, seconds: float):
+        with self._lock:
+            self.count += 1
+            self.total += seconds
+            self.max = max(self.max, seconds)
+
+    def stats(self) -> dict:
+        with self._lock:
+            count, total, longest = self.count, self.total, self.max
+        return {
+            "count": count,
+            "avg_ms": round(total / count * 1000, 3) if count else None,
+            "max_ms": round(longest * 1000, 3),
+        }
+
+
+def fit_chunks(chunks: list, max_tokens: int) -> list:
+    """按顺序（相关度从高到低）选取 (块ID, 文本)，直到用完 token 预算；放不下的块截断或丢弃"""
+    selected = []
+    used = 0
+    for chunk_id, text in chunks:
+        tokens = count_tokens(text) + 1  # 1 为分隔换行
+        if used + tokens > max_tokens:
+            remaining = max_tokens - used - 1
+            if remaining >= RAG_MIN_CHUNK_TOKENS:
+                selected.append((chunk_id, truncate_to_tokens(text, remaining)))
+            print(f"知识库文本超出预算 {max_tokens} tokens，使用 {len(selected)}/{len(chunks)} 个文本块")
+            break
+        selected.append((chunk_id, text))
+        used += tokens
+    return selected
 
 class RAGService:
     """RAG 增强服务类"""
@@ -25,40 +175,148 @@ class RAGService:
         self.embed_model = None
         self.initialized = False
         
-        # 向量数据库存储路径
+        # 向量数据库存储路径：每次构建写入 versions 下独立的版本目录（index-<版本>），
+        # versions/CURRENT 记录当前生效的版本；随仓库提供的 faiss_index 目录只读取、不修改
         self.vector_db_path = os.path.join(os.path.dirname(__file__), "vector_db")
-        self.vector_index_path = os.path.join(self.vector_db_path, "faiss_index")
+        self.legacy_index_path = os.path.join(self.vector_db_path, "faiss_index")
+        self.versions_path = os.path.join(self.vector_db_path, "versions")
+        self.current_pointer_path = os.path.join(self.versions_path, "CURRENT")
         self.vector_pkl_path = os.path.join(self.vector_db_path, "faiss_index.pkl")
-        
+
+        # 当前索引的文件清单（路径、大小、修改时间、内容哈希、块ID）
+        self.manifest = None
+        # 最近一次构建的耗时与吞吐
+        self.last_build_stats = None
+        self.embed_model_name = None
+        self.embed_backend = None
+        # 重建/增量更新互斥
+        self._maintenance_lock = threading.Lock()
+        # 热切换：(向量库, 索引版本号, BM25 关键词索引) 作为一个整体替换
+        self._swap_lock = threading.Lock()
+        self._index_state = (None, 0, None)
+        self.loaded_index_dir = None
+        self._last_stale_check = 0.0
+
+        # 索引版本号：每次替换向量库时递增，作为缓存键的一部分
+        self.index_version = 0
+        self.embedding_cache = LRUCache(RAG_CACHE_SIZE, RAG_CACHE_TTL)
+        self.retrieval_cache = LRUCache(RAG_CACHE_SIZE, RAG_CACHE_TTL)
+        # 各路检索耗时；fused_lexical_only 为融合后的结果中只被关键词检索召回的文本块数
+        self.latency = {"vector": _LatencyStats(), "lexical": _LatencyStats(), "hybrid": _LatencyStats()}
+        self.fused_lexical_only = 0
+
+    def _load_lexical_index(self, vector_store, index_dir: str = None):
+        """读取索引目录中的 BM25 索引；旧索引没有时根据文本块在内存中构建"""
+        if not RAG_HYBRID:
+            return None
+        try:
+            lexical = index_store.read_lexical_index(index_dir) if index_dir else None
+            if lexical is None:
+                start = time.time()
+                lexical = index_store.build_lexical_index(vector_store)
+                print(f"索引目录中没有关键词索引，已在内存中构建（{len(lexical)} 个文本块，"
+                      f"{time.time() - start:.2f}秒），刷新或重建后写入磁盘")
+            return lexical
+        except Exception as e:
+            print(f"关键词索引不可用，只使用向量检索: {e}")
+            return None
+
+    def _set_vector_store(self, vector_store, index_dir: str = None):
+        """
+        热切换当前向量库并使缓存失效
+
+        新索引在切换前已完整构建/加载；检索方通过 _index_state 一次性读取
+        (向量库, 版本号, 关键词索引)，不会看到新旧混合的状态。
+        """
+        retriever = vector_store.as_retriever(
+            search_type="similarity",
+            search_kwargs={"k": 3}  # 返回最相关的3个文档块
+        )
+        lexical = self._load_lexical_index(vector_store, index_dir)
+        with self._swap_lock:
+            version = self.index_version + 1
+            self._index_state = (vector_store, version, lexical)
+            self.vector_store = vector_store
+            self.retriever = retriever
+            self.index_version = version
+            if index_dir:
+                self.loaded_index_dir = os.path.basename(os.path.normpath(index_dir))
+        self.retrieval_cache.clear()
+        self.embedding_cache.clear()
+
+    @property
+    def vector_index_path(self) -> str:
+        """当前生效的索引目录（CURRENT 指向的版本，没有则为旧版 faiss_index 目录）"""
+        try:
+            with open(self.current_pointer_path, 'r', encoding='utf-8') as f:
+                version_dir = f.read().strip()
+            if version_dir:
+                return os.path.join(self.versions_path, version_dir)
+        except FileNotFoundError:
+            pass
+        return self.legacy_index_path
         
     def initialize_models(self):
         """初始化嵌入模型和聊天模型"""
         try:
+            def _create_torch(model_name):
+                if EMBED_THREADS > 0:
+                    try:
+                        import torch
+                        torch.set_num_threads(EMBED_THREADS)
+                    except ImportError:
+                        pass
+
+                from langchain_community.embeddings import HuggingFaceEmbeddings
+                self.embed_backend = "torch"
+                return HuggingFaceEmbeddings(
+                    model_name=model_name,
+                    model_kwargs={'device': 'cpu'},  # 使用 CPU
+                    encode_kwargs={'batch_size': EMBED_BATCH_SIZE}
+                )
+
+            def _create(model_name):
+                # ONNX 后端与 torch 输出一致（导出时校验），不可用时回退到 torch
+                if EMBED_BACKEND == "onnx":
+                    try:
+                        from onnx_embeddings import create_onnx_embeddings
+                        model = create_onnx_embeddings(model_name, batch_size=EMBED_BATCH_SIZE)
+                        self.embed_backend = f"onnx-{model.quantize}" if model.quantize == "int8" else "onnx"
+                        print(f"使用 ONNX Runtime 嵌入后端（{self.embed_backend}）")
+                        return model
+                    except Exception as e:
+                        print(f"ONNX 嵌入后端不可用，使用 torch: {e}")
+                return _create_torch(model_name)
+
             # 检查本地 FlagEmbedding 模型
             local_model_path = os.path.join(os.path.dirname(__file__), "..", "FlagEmbedding")
-            if os.path.exists(local_model_path):
+            # 共享嵌入服务可用时不在本进程加载模型
+            from embed_server import EMBED_SERVER, connect_embed_server
+            client = connect_embed_server() if EMBED_SERVER else None
+            if client is not None:
+                self.embed_model = client
+                self.embed_backend = f"server-{client.backend}"
+            elif os.path.exists(local_model_path):
                 print(f"使用本地 FlagEmbedding 模型: {local_model_path}")
                 try:
-                    self.embed_model = HuggingFaceEmbeddings(
-                        model_name=local_model_path,
-                        model_kwargs={'device': 'cpu'}  # 使用 CPU
-                    )
+                    self.embed_model = _create(local_model_path)
                     print("本地模型加载成功")
                 except Exception as e:
                     print(f"本地模型加载失败: {e}")
                     print("回退到默认模型")
-                    self.embed_model = HuggingFaceEmbeddings(
-                        model_name="sentence-transformers/all-MiniLM-L6-v2",
-                        model_kwargs={'device': 'cpu'}
-                    )
+                    self.embed_model = _create("sentence-transformers/all-MiniLM-L6-v2")
             else:
                 print("未找到本地 FlagEmbedding 模型，使用默认模型")
-                # 初始化嵌入模型（使用默认模型）
-                self.embed_model = HuggingFaceEmbeddings(
-                    model_name="sentence-transformers/all-MiniLM-L6-v2",  # 轻量级模型
-                    model_kwargs={'device': 'cpu'}  # 使用 CPU
-                )
+                # 初始化嵌入模型（使用默认模型，轻量级）
+                self.embed_model = _create("sentence-transformers/all-MiniLM-L6-v2")
             
+            model_name = getattr(self.embed_model, "model_name", "") or ""
+            self.embed_model_name = os.path.basename(os.path.normpath(model_name))
+
+            # 模型已更换，旧的查询向量不再可用
+            self.embedding_cache.clear()
+            self.retrieval_cache.clear()
+
             # 测试模型是否正常工作
             test_text = "测试文本"
             test_embedding = self.embed_model.embed_query(test_text)
@@ -69,119 +327,429 @@ class RAGService:
             print(f"模型初始化失败: {e}")
             return False
     
-    def load_knowledge_base(self, file_extensions: List[str] = None):
+    def _scan_knowledge_files(self, file_extensions: List[str] = None) -> Dict[str, str]:
+        """扫描知识库目录，返回 {相对路径: 绝对路径}"""
+        if file_extensions is None:
+            file_extensions = SUPPORTED_EXTENSIONS
+        files = {}
+        for root, dirs, names in os.walk(self.knowledge_base_path):
+            for name in names:
+                if any(name.endswith(ext) for ext in file_extensions):
+                    file_path = os.path.join(root, name)
+                    files[self._file_key(file_path)] = file_path
+        return files
+
+    def _file_key(self, file_path: str) -> str:
+        """文件在清单中的键：相对知识库目录的路径（统一使用 /）"""
+        rel = os.path.relpath(file_path, self.knowledge_base_path)
+        return rel.replace(os.sep, "/")
+
+    _load_file = staticmethod(_load_file)
+
+    def load_knowledge_base(self, file_extensions: List[str] = None, files: Dict[str, str] = None):
         """
         加载知识库文档
-        
+
         Args:
             file_extensions: 支持的文件扩展名，默认为 ['.txt', '.md', '.pdf']
+            files: 只加载指定文件 {相对路径: 绝对路径}，默认加载整个知识库
         """
-        if file_extensions is None:
-            file_extensions = ['.txt', '.md', '.pdf']
-            
         documents = []
-        
+
         try:
-            # 遍历知识库目录
-            for root, dirs, files in os.walk(self.knowledge_base_path):
-                for file in files:
-                    if any(file.endswith(ext) for ext in file_extensions):
-                        file_path = os.path.join(root, file)
-                        try:
-                            # 根据文件类型选择加载器
-                            if file.endswith('.pdf'):
-                                loader = PyPDFLoader(file_path)
-                            else:
-                                loader = TextLoader(file_path, encoding="utf-8")
-                            
-                            docs = loader.load()
-                            documents.extend(docs)
-                            print(f"已加载: {file_path}")
-                        except Exception as e:
-                            print(f"加载文件失败 {file_path}: {e}")
-                            
+            if files is None:
+                files = self._scan_knowledge_files(file_extensions)
+            for file_path in sorted(files.values()):
+                try:
+                    docs = self._load_file(file_path)
+                    documents.extend(docs)
+                    print(f"已加载: {file_path}")
+                except Exception as e:
+                    print(f"加载文件失败 {file_path}: {e}")
+
         except Exception as e:
             print(f"知识库加载失败: {e}")
             return []
-            
+
         return documents
-    
-    def create_vector_store(self, documents: List[Document]):
+
+    _split_documents = staticmethod(_split_documents)
+
+    def load_and_split(self, files: Dict[str, str], progress=None) -> List[Document]:
+        """
+        并行加载并分割文件（进程池，RAG_LOAD_WORKERS 个进程）
+
+        结果按文件相对路径排序，保证块ID稳定。
+
+        Args:
+            files: {相对路径: 绝对路径}
+            progress: 可选回调 progress(已加载文件数, 文件总数)
+        """
+        ordered = [files[key] for key in sorted(files)]
+        results = {}
+        workers = min(RAG_LOAD_WORKERS, len(ordered))
+
+        if workers > 1:
+            try:
+                from concurrent.futures import ProcessPoolExecutor, as_completed
+                with ProcessPoolExecutor(max_workers=workers) as executor:
+                    futures = [executor.submit(_load_and_split_file, path) for path in ordered]
+                    try:
+                        for future in as_completed(futures):
+                            file_path, chunks, error = future.result()
+                            results[file_path] = (chunks, error)
+                            if progress:
+                                progress(len(results), len(ordered))
+                    except JobCancelled:
+                        for future in futures:
+                            future.cancel()
+                        raise
+            except JobCancelled:
+                raise
+            except Exception as e:
+                print(f"并行加载失败，改为顺序加载: {e}")
+                results = {}
+
+        for file_path in ordered:
+            if file_path not in results:
+                _, chunks, error = _load_and_split_file(file_path)
+                results[file_path] = (chunks, error)
+                if progress:
+                    progress(len(results), len(ordered))
+
+        all_chunks = []
+        for file_path in ordered:
+            chunks, error = results[file_path]
+            if error:
+                print(f"加载文件失败 {file_path}: {error}")
+            else:
+                print(f"已加载: {file_path}（{len(chunks)} 个文本块）")
+            all_chunks.extend(chunks)
+        return all_chunks
+
+    def _embed_texts(self, texts: List[str], progress=None):
+        """
+        分批向量化文本，返回 float32 矩阵
+
+        Args:
+            progress: 可选回调 progress(已向量化块数, 总块数)
+        """
+        import numpy as np
+
+        vectors = None
+        for start in range(0, len(texts), EMBED_BATCH_SIZE):
+            batch = np.asarray(
+                self.embed_model.embed_documents(texts[start:start + EMBED_BATCH_SIZE]),
+                dtype="float32"
+            )
+            if vectors is None:
+                # 第一批确定维度后一次性预分配
+                vectors = np.empty((len(texts), batch.shape[1]), dtype="float32")
+            vectors[start:start + len(batch)] = batch
+            if progress:
+                progress(start + len(batch), len(texts))
+        return vectors
+
+    def _build_faiss_store(self, chunks: List[Document], ids: List[str], progress=None):
+        """
+        构建 FAISS 向量库：逐批向量化后写入同一个 FAISS 索引，
+        不再为每批创建临时索引再合并
+
+        IVF/HNSW/量化索引需要先训练，改为全部向量化后按 RAG_INDEX_TYPE /
+        RAG_INDEX_QUANT 创建索引。
+
+        Args:
+            progress: 可选回调 progress(已向量化块数, 总块数)
+        """
+        import faiss
+        from langchain_community.docstore.in_memory import InMemoryDocstore
+        from langchain_community.vectorstores import FAISS
+
+        import numpy as np
+
+        if not chunks:
+            raise ValueError("没有可索引的文本块")
+
+        docstore = InMemoryDocstore({chunk_id: chunk for chunk_id, chunk in zip(ids, chunks)})
+        index_to_docstore_id = {i: chunk_id for i, chunk_id in enumerate(ids)}
+
+        config = index_store.index_config()
+        if config["type"] != "flat" or config["quantization"] != "none":
+            vectors = self._embed_texts([chunk.page_content for chunk in chunks], progress=progress)
+            index = index_store.create_index(vectors)
+            return FAISS(self.embed_model, index, docstore, index_to_docstore_id)
+
+        index = None
+        total = len(chunks)
+        embed_start = time.time()
+        for start in range(0, total, EMBED_BATCH_SIZE):
+            batch = chunks[start:start + EMBED_BATCH_SIZE]
+            vectors = np.asarray(
+                self.embed_model.embed_documents([chunk.page_content for chunk in batch]),
+                dtype="float32"
+            )
+            if index is None:
+                index = faiss.IndexFlatL2(vectors.shape[1])
+            index.add(vectors)
+
+            done = start + len(batch)
+            elapsed = time.time() - embed_start
+            print(f"向量化进度 {done}/{total}，{done / elapsed if elapsed else 0:.1f} 块/秒")
+            if progress:
+                progress(done, total)
+
+        return FAISS(self.embed_model, index, docstore, index_to_docstore_id)
+
+    @staticmethod
+    def _chunk_id(file_key: str, n: int) -> str:
+        """块ID：文件路径哈希 + 块序号，同一文件的块ID按顺序排列"""
+        path_digest = hashlib.sha1(file_key.encode("utf-8")).hexdigest()[:16]
+        return f"{path_digest}-{n:05d}"
+
+    def _assign_chunk_ids(self, chunks: List[Document]):
+        """为文本块分配稳定ID，返回 (ids, {相对路径: [块ID]})"""
+        ids = []
+        ids_by_file = {}
+        for chunk in chunks:
+            source = chunk.metadata.get("source", "")
+            file_key = self._file_key(source) if source else ""
+            file_ids = ids_by_file.setdefault(file_key, [])
+            chunk_id = self._chunk_id(file_key, len(file_ids))
+            file_ids.append(chunk_id)
+            chunk.metadata["chunk_id"] = chunk_id
+            ids.append(chunk_id)
+        return ids, ids_by_file
+
+    @staticmethod
+    def _file_fingerprint(file_path: str, with_hash: bool = True) -> dict:
+        """文件指纹：大小、修改时间、内容哈希"""
+        stat = os.stat(file_path)
+        info = {"size": stat.st_size, "mtime": stat.st_mtime}
+        if with_hash:
+            digest = hashlib.sha256()
+            with open(file_path, 'rb') as f:
+                for block in iter(lambda: f.read(1024 * 1024), b""):
+                    digest.update(block)
+            info["sha256"] = digest.hexdigest()
+        return info
+
+    def _build_manifest(self, files: Dict[str, str], ids_by_file: Dict[str, List[str]]) -> dict:
+        """根据文件列表和块ID生成清单；未产生文本块的文件也记录，避免被反复当作新文件"""
+        entries = {}
+        for file_key, file_path in files.items():
+            try:
+                entry = self._file_fingerprint(file_path)
+            except OSError as e:
+                print(f"读取文件信息失败 {file_path}: {e}")
+                continue
+            entry["chunk_ids"] = ids_by_file.get(file_key, [])
+            entries[file_key] = entry
+        return {
+            "version": MANIFEST_VERSION,
+            "embed_model": self.embed_model_name,
+            "index": index_store.index_config(),
+            "updated_at": time.time(),
+            "files": entries,
+        }
+
+    def load_manifest(self, index_dir: str = None):
+        """读取索引目录下的清单，不存在时返回 None"""
+        manifest_path = os.path.join(index_dir or self.vector_index_path, "manifest.json")
+        try:
+            with open(manifest_path, 'r', encoding='utf-8') as f:
+                manifest = json.load(f)
+            if manifest.get("version") != MANIFEST_VERSION:
+                return None
+            return manifest
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            print(f"读取索引清单失败: {e}")
+            return None
+
+    def diff_knowledge_base(self, manifest: dict = None) -> dict:
+        """
+        对比知识库与清单，找出新增、修改和删除的文件
+
+        大小和修改时间都未变化的文件视为未修改；否则比较内容哈希。
+        """
+        if manifest is None:
+            manifest = self.manifest or self.load_manifest() or {"files": {}}
+        recorded = manifest.get("files", {})
+        current = self._scan_knowledge_files()
+
+        added, changed, unchanged = {}, {}, {}
+        for file_key, file_path in current.items():
+            entry = recorded.get(file_key)
+            if entry is None:
+                added[file_key] = file_path
+                continue
+            try:
+                quick = self._file_fingerprint(file_path, with_hash=False)
+                if quick["size"] == entry.get("size") and quick["mtime"] == entry.get("mtime"):
+                    unchanged[file_key] = file_path
+                elif self._file_fingerprint(file_path)["sha256"] == entry.get("sha256"):
+                    unchanged[file_key] = file_path
+                else:
+                    changed[file_key] = file_path
+            except OSError:
+                changed[file_key] = file_path
+
+        removed = {k: v for k, v in recorded.items() if k not in current}
+        return {
+            "current": current,
+            "added": added,
+            "changed": changed,
+            "removed": removed,
+            "unchanged": unchanged,
+        }
+
+    def create_vector_store(self, documents: List[Document], files: Dict[str, str] = None,
+                            chunks: List[Document] = None, progress=None):
         """
         创建向量存储（优化版）
-        
+
         Args:
             documents: 文档列表
+            files: 文档来源文件 {相对路径: 绝对路径}，用于生成索引清单，默认扫描整个知识库
+            chunks: 已分割好的文本块（传入时忽略 documents）
+            progress: 可选回调 progress(已向量化块数, 总块数)
         """
         try:
-            print(f"开始处理 {len(documents)} 个文档...")
-            
             # 文本分割
-            text_splitter = RecursiveCharacterTextSplitter(
-                chunk_size=500,  # 增大块大小以保持上下文
-                chunk_overlap=50,  # 增加重叠以保持连贯性
-                separators=["\n\n", "\n", "。", "！", "？", "；", " ", ""]
-            )
-            chunks = text_splitter.split_documents(documents)
+            split_start = time.time()
+            if chunks is None:
+                print(f"开始处理 {len(documents)} 个文档...")
+                chunks = self._split_documents(documents)
             print(f"文档分割完成，生成 {len(chunks)} 个文本块")
-            
-            # 分批处理大量文档，避免内存溢出
-            batch_size = 100  # 每批处理100个文档块
-            all_chunks = []
-            
-            for i in range(0, len(chunks), batch_size):
-                batch = chunks[i:i + batch_size]
-                print(f"处理批次 {i//batch_size + 1}/{(len(chunks)-1)//batch_size + 1} ({len(batch)} 个文档块)")
-                
-                if i == 0:
-                    # 第一批，创建初始向量存储
-                    self.vector_store = FAISS.from_documents(batch, self.embed_model)
-                else:
-                    # 后续批次，添加到现有存储
-                    batch_store = FAISS.from_documents(batch, self.embed_model)
-                    self.vector_store.merge_from(batch_store)
-                
-                # 强制垃圾回收，释放内存
-                import gc
-                gc.collect()
-            
-            # 创建检索器
-            self.retriever = self.vector_store.as_retriever(
-                search_type="similarity",
-                search_kwargs={"k": 3}  # 返回最相关的3个文档块
-            )
-            
-            # 保存向量数据库到磁盘
+            ids, ids_by_file = self._assign_chunk_ids(chunks)
+
+            # 向量化并写入单个 FAISS 索引
+            embed_start = time.time()
+            vector_store = self._build_faiss_store(chunks, ids, progress=progress)
+            embed_seconds = time.time() - embed_start
+
+            # 保存向量数据库到磁盘（连同文件清单，原子发布）
             print("保存向量数据库到磁盘...")
-            self.save_vector_store()
-            
-            print(f"向量存储创建成功，包含 {len(chunks)} 个文档块")
+            if files is None:
+                files = self._scan_knowledge_files()
+            manifest = self._build_manifest(files, ids_by_file)
+            index_dir = self._publish_vector_store(vector_store, manifest)
+            if not index_dir:
+                return False
+
+            # 热切换向量库并创建检索器
+            self._set_vector_store(self._open_published(vector_store, index_dir), index_dir)
+            self.manifest = manifest
+
+            self.last_build_stats = {
+                "chunks": len(chunks),
+                "split_seconds": round(embed_start - split_start, 2),
+                "embed_seconds": round(embed_seconds, 2),
+                "chunks_per_second": round(len(chunks) / embed_seconds, 2) if embed_seconds else None,
+                "batch_size": EMBED_BATCH_SIZE,
+                "load_workers": RAG_LOAD_WORKERS,
+                "embed_backend": self.embed_backend,
+            }
+            print(f"向量存储创建成功，包含 {len(chunks)} 个文档块，"
+                  f"向量化 {self.last_build_stats['chunks_per_second']} 块/秒")
             return True
-            
+
+        except JobCancelled:
+            raise
         except Exception as e:
             print(f"向量存储创建失败: {e}")
             import traceback
             print(f"详细错误: {traceback.format_exc()}")
             return False
-    
+
     def save_vector_store(self):
         """保存向量存储到磁盘"""
+        if self.vector_store is None:
+            return False
+        manifest = self.manifest or self._build_manifest({}, {})
+        return bool(self._publish_vector_store(self.vector_store, manifest))
+
+    def _publish_vector_store(self, vector_store, manifest: dict):
+        """
+        原子发布向量库，成功返回新版本目录，失败返回 None
+
+        先完整写入临时目录，再重命名为新的版本目录，最后用 os.replace 原子更新
+        CURRENT 指针；任何时刻读取方看到的要么是旧版本，要么是完整的新版本。
+        """
+        tmp_dir = None
         try:
-            if self.vector_store is None:
-                return False
-                
-            # 确保目录存在
-            os.makedirs(self.vector_db_path, exist_ok=True)
-            
-            # 保存FAISS索引
-            self.vector_store.save_local(self.vector_index_path)
-            print(f"向量数据库已保存到: {self.vector_index_path}")
-            return True
-            
+            os.makedirs(self.versions_path, exist_ok=True)
+            version = f"{time.strftime('%Y%m%d-%H%M%S')}-{uuid4().hex[:6]}"
+            tmp_dir = os.path.join(self.versions_path, f".tmp-{version}")
+            version_dir = f"index-{version}"
+
+            # 1. 写入临时目录
+            index_store.write_vector_store(vector_store, tmp_dir, lexical=RAG_HYBRID)
+            manifest_path = os.path.join(tmp_dir, "manifest.json")
+            with open(manifest_path, 'w', encoding='utf-8') as f:
+                json.dump(manifest, f, ensure_ascii=False)
+                f.flush()
+                os.fsync(f.fileno())
+
+            # 2. 重命名为版本目录（同一文件系统内原子完成）
+            os.rename(tmp_dir, os.path.join(self.versions_path, version_dir))
+            tmp_dir = None
+
+            # 3. 原子切换 CURRENT 指针
+            pointer_tmp = self.current_pointer_path + ".tmp"
+            with open(pointer_tmp, 'w', encoding='utf-8') as f:
+                f.write(version_dir)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(pointer_tmp, self.current_pointer_path)
+            print(f"向量数据库已保存到: {os.path.join(self.versions_path, version_dir)}")
+
+            # 4. 清理旧版本
+            self._cleanup_old_versions(keep=version_dir)
+            return os.path.join(self.versions_path, version_dir)
+
         except Exception as e:
             print(f"保存向量数据库失败: {e}")
-            return False
-    
+            if tmp_dir and os.path.exists(tmp_dir):
+                shutil.rmtree(tmp_dir, ignore_errors=True)
+            return None
+
+    def _open_published(self, vector_store, index_dir: str):
+        """
+        启用 mmap 或 SQLite 文本块存储时，从刚发布的目录重新打开只读向量库，
+        释放构建时的内存副本；失败时继续使用内存中的向量库
+        """
+        if not (index_store.RAG_INDEX_MMAP or index_store.RAG_DOCSTORE == "sqlite"):
+            return vector_store
+        try:
+            return index_store.read_vector_store(index_dir, self.embed_model)
+        except Exception as e:
+            print(f"重新打开已发布的向量库失败，使用内存副本: {e}")
+            return vector_store
+
+    def _cleanup_old_versions(self, keep: str):
+        """
+        删除 versions 下旧的版本目录和残留临时目录（只处理符合版本命名的目录）
+
+        额外保留上一个版本，供正在切换的其他 worker 进程加载；
+        一小时内的临时目录可能属于其他进程正在进行的构建，不删除。
+        """
+        versions = sorted(name for name in os.listdir(self.versions_path) if name.startswith("index-"))
+        previous = [name for name in versions if name < keep][-1:]
+        for name in os.listdir(self.versions_path):
+            match = _VERSION_DIR_RE.match(name)
+            if not match or name == keep or name in previous:
+                continue
+            path = os.path.join(self.versions_path, name)
+            if match.group(1) == ".tmp-":
+                try:
+                    if time.time() - os.path.getmtime(path) < 3600:
+                        continue
+                except OSError:
+                    continue
+            shutil.rmtree(path, ignore_errors=True)
+
     def load_vector_store(self):
         """从磁盘加载向量存储（改进版）"""
         try:
@@ -190,10 +758,13 @@ class RAGService:
                 print(f"向量数据库目录不存在: {self.vector_db_path}")
                 return False
             
+            # 读取一次 CURRENT，避免加载过程中版本切换
+            index_dir = self.vector_index_path
+
             # 检查FAISS索引文件
             index_files = [
-                os.path.join(self.vector_index_path, "index.faiss"),
-                os.path.join(self.vector_index_path, "index.pkl")
+                os.path.join(index_dir, "index.faiss"),
+                os.path.join(index_dir, "index.pkl")
             ]
             
             for file_path in index_files:
@@ -207,26 +778,19 @@ class RAGService:
                     print(f"向量数据库文件为空: {file_path}")
                     return False
             
-            print(f"正在加载向量数据库: {self.vector_index_path}")
-            
-            # 加载FAISS索引
-            self.vector_store = FAISS.load_local(
-                self.vector_index_path, 
-                self.embed_model,
-                allow_dangerous_deserialization=True
-            )
+            print(f"正在加载向量数据库: {index_dir}")
             
-            self.retriever = self.vector_store.as_retriever(
-                search_type="similarity",
-                search_kwargs={"k": 3}
-            )
+            # 加载FAISS索引（按配置 mmap 索引、按需读取文本块）
+            vector_store = index_store.read_vector_store(index_dir, self.embed_model)
+            self._set_vector_store(vector_store, index_dir)
+            self.manifest = self.load_manifest(index_dir)
             
             # 验证加载是否成功
             if self.vector_store is None or self.retriever is None:
                 print("向量数据库加载后为空")
                 return False
             
-            print(f"✅ 向量数据库加载成功: {self.vector_index_path}")
+            print(f"✅ 向量数据库加载成功: {index_dir}")
             return True
             
         except Exception as e:
@@ -252,10 +816,14 @@ class RAGService:
         print("正在初始化 RAG 服务...")
         
         try:
-            # 1. 初始化模型
+            # 1. 初始化模型；失败时启用 BM25 词法检索作为后备，向量检索按退避继续重试
             if not self.initialize_models():
-                print("模型初始化失败，RAG 功能将不可用")
+                print("模型初始化失败，向量检索不可用")
+                self._start_lexical_fallback()
                 return False
+
+            # 开启重排序时在预热中加载交叉编码器（失败时跳过重排序，不影响检索）
+            get_reranker()
             
             # 2. 尝试加载已存在的向量数据库
             if self.load_vector_store():
@@ -263,15 +831,18 @@ class RAGService:
                 self.initialized = True
                 return True
             
-            # 3. 如果加载失败，重新构建向量数据库
+            # 3. 如果加载失败，重新构建向量数据库（与重建相同：并行加载分割 + 批量向量化）
             print("向量数据库不存在或加载失败，开始重新构建...")
-            documents = self.load_knowledge_base()
-            if not documents:
+            load_start = time.time()
+            files = self._scan_knowledge_files()
+            chunks = self.load_and_split(files)
+            if not chunks:
                 print("未找到知识库文档，RAG 功能将不可用")
                 return False
-                
-            # 4. 创建向量存储
-            if not self.create_vector_store(documents):
+            print(f"加载分割完成，耗时 {time.time() - load_start:.2f}秒")
+
+            # 4. 创建向量存储（同时生成文件清单）
+            if not self.create_vector_store(None, files=files, chunks=chunks):
                 print("向量存储创建失败，RAG 功能将不可用")
                 return False
                 
@@ -288,53 +859,160 @@ class RAGService:
             print(f"RAG 服务初始化过程中发生异常: {e}")
             return False
     
+    def _start_lexical_fallback(self):
+        """加载（或构建）BM25 词法索引，在嵌入模型恢复前代替向量检索"""
+        from simple_rag import LEXICAL_FALLBACK, get_simple_rag_service
+
+        if not LEXICAL_FALLBACK:
+            return
+        lexical = get_simple_rag_service()
+        lexical.knowledge_base_path = self.knowledge_base_path
+        if lexical.initialize():
+            print("已启用 BM25 词法检索作为后备")
+        else:
+            print("BM25 词法检索也不可用，使用基础 LLM 功能")
+
+    def embed_query_cached(self, query: str) -> List[float]:
+        """获取查询向量（按归一化查询文本 + 索引版本缓存）"""
+        key = (normalize_query(query), self.index_version)
+        embedding = self.embedding_cache.get(key)
+        if embedding is None:
+            embedding = self.embed_model.embed_query(query.strip())
+            self.embedding_cache.set(key, embedding)
+        return embedding
+
     def retrieve_relevant_docs(self, query: str, k: int = 3) -> List[Document]:
-        """检索相关文档"""
-        if not self.retriever:
+        """检索相关文档（有关键词索引时混合检索；查询向量和 top-k 结果均有缓存）"""
+        vector_store, index_version, lexical = self._index_state
+        if vector_store is None:
             return []
             
         try:
-            docs = self.retriever.get_relevant_documents(query)
-            return docs[:k]
+            key = (normalize_query(query), k, index_version)
+            docs = self.retrieval_cache.get(key)
+            if docs is not None:
+                return list(docs)
+
+            if lexical is None:
+                docs = self._vector_search(vector_store, query, k)
+            else:
+                docs = self._hybrid_search(vector_store, lexical, query, k)
+            self.retrieval_cache.set(key, tuple(docs))
+            return docs
         except Exception as e:
             print(f"文档检索失败: {e}")
             return []
+
+    def _vector_search(self, vector_store, query: str, k: int) -> List[Document]:
+        start = time.perf_counter()
+        embedding = self.embed_query_cached(query)
+        docs = vector_store.similarity_search_by_vector(embedding, k=k)
+        self.latency["vector"].add(time.perf_counter() - start)
+        return docs
+
+    def _lexical_search(self, vector_store, lexical, query: str, k: int) -> List[Document]:
+        """BM25 检索，原文从向量库的文本块存储读取"""
+        start = time.perf_counter()
+        docs = []
+        for doc_id, _ in lexical.search(query, k):
+            doc = vector_store.docstore.search(lexical.chunk_ids[doc_id])
+            if not isinstance(doc, str):  # 找不到时 docstore 返回提示字符串
+                docs.append(doc)
+        self.latency["lexical"].add(time.perf_counter() - start)
+        return docs
+
+    def _hybrid_search(self, vector_store, lexical, query: str, k: int) -> List[Document]:
+        """向量检索与关键词检索并行执行，各取 RAG_HYBRID_CANDIDATES 个候选后按 RRF 融合取前 k 个"""
+        start = time.perf_counter()
+        candidates = max(k, RAG_HYBRID_CANDIDATES)
+        future = _get_hybrid_pool().submit(self._lexical_search, vector_store, lexical, query, candidates)
+        try:
+            vector_docs = self._vector_search(vector_store, query, candidates)
+        finally:
+            try:
+                lexical_docs = future.result()
+            except Exception as e:
+                print(f"关键词检索失败，只使用向量检索结果: {e}")
+                lexical_docs = []
+        docs = reciprocal_rank_fusion([vector_docs, lexical_docs], k)
+
+        vector_keys = {doc.metadata.get("chunk_id") or doc.page_content for doc in vector_docs}
+        self.fused_lexical_only += sum(1 for doc in docs
+                                       if (doc.metadata.get("chunk_id") or doc.page_content) not in vector_keys)
+        self.latency["hybrid"].add(time.perf_counter() - start)
+        return docs
+
+    def get_cache_stats(self) -> dict:
+        """查询缓存命中统计"""
+        return {
+            "index_version": self.index_version,
+            "embedding": self.embedding_cache.stats(),
+            "retrieval": self.retrieval_cache.stats(),
+        }
+
+    def get_retrieval_stats(self) -> dict:
+        """各路检索耗时（缓存命中的查询不计入）"""
+        lexical = self._index_state[2]
+        return {
+            "hybrid": lexical is not None,
+            "candidates": RAG_HYBRID_CANDIDATES,
+            "rrf_k": RAG_RRF_K,
+            "lexical_index": lexical.get_stats() if lexical is not None else None,
+            "latency": {channel: stats.stats() for channel, stats in self.latency.items()},
+            "fused_lexical_only": self.fused_lexical_only,
+        }
     
-    def enhance_query(self, user_query: str) -> str:
-        """使用 RAG 增强用户查询"""
+    def enhance_query(self, user_query: str, max_tokens: int = None) -> str:
+        """
+        使用 RAG 增强用户查询
+
+        Args:
+            max_tokens: 增强后文本的 token 上限，超出时按相关度从低到高丢弃/截断知识库文本块
+        """
+        return self.prepare_query(user_query, max_tokens)["text"]
+
+    def prepare_query(self, user_query: str, max_tokens: int = None) -> dict:
+        """
+        检索并组装增强查询，同时返回语义答案缓存需要的信息
+
+        Returns:
+            {"text": 增强后的查询, "embedding": 查询向量（不可用时为 None）,
+             "chunk_ids": 实际使用的块ID（已排序）, "index_version": 索引版本}
+        """
+        index_version = self._index_state[1]
+        result = {"text": _basic_query(user_query), "embedding": None, "chunk_ids": (), "index_version": index_version}
         if not self.is_available():
-            return f"""用户问题：{user_query}
+            return result
 
-请基于您的知识回答用户的问题。"""
-            
         try:
-            relevant_docs = self.retrieve_relevant_docs(user_query)
+            result["embedding"] = self.embed_query_cached(user_query)
+            # 开启重排序时先取更多候选，打分后只保留达到阈值的文本块
+            reranker = get_reranker()
+            relevant_docs = self.retrieve_relevant_docs(user_query, k=RERANK_CANDIDATES if reranker else 3)
+            chunks = [(doc.metadata.get("chunk_id", ""), doc.page_content) for doc in relevant_docs]
+            if reranker is not None and chunks:
+                chunks = [(chunk_id, text) for chunk_id, text, _ in reranker.rerank(user_query, chunks, index_version)]
+                if not chunks:
+                    print(f"重排序后 {len(relevant_docs)} 个候选均未达到阈值")
             
-            if not relevant_docs:
-                return f"""用户问题：{user_query}
+            if not chunks:
+                result["text"] = f"""用户问题：{user_query}
 
 注意：在专业知识库中未找到相关信息，请基于您的通用知识回答用户的问题。"""
+                return result
                 
-            context = "\n\n".join([doc.page_content for doc in relevant_docs])
-            
-            return f"""请回答用户的问题。在回答时，请按以下优先级：
-
-1. 首先参考以下专业知识库信息（如果相关）：
-{context}
-
-2. 结合您的通用知识库进行补充和扩展
-3. 如果专业知识库信息不足或不够准确，请优先使用您的通用知识
-4. 确保回答准确、详细、有用
+            if max_tokens is not None:
+                chunks = fit_chunks(chunks, max_tokens - count_tokens(rag_user_message([], user_query)))
+                if not chunks:
+                    return result
 
-用户问题：{user_query}
-
-请基于以上信息给出完整的回答。"""
+            result["text"] = rag_user_message(chunks, user_query)
+            result["chunk_ids"] = tuple(sorted(chunk_id for chunk_id, _ in chunks))
+            return result
             
         except Exception as e:
             print(f"查询增强失败: {e}")
-            return f"""用户问题：{user_query}
-
-请基于您的知识回答用户的问题。"""
+            return {"text": _basic_query(user_query), "embedding": None, "chunk_ids": (), "index_version": index_version}
     
     def is_available(self) -> bool:
         """检查 RAG 服务是否可用"""
@@ -348,7 +1026,12 @@ class RAGService:
                 "vector_db_path": self.vector_db_path,
                 "initialized": self.initialized,
                 "has_retriever": self.retriever is not None,
-                "embed_model_available": self.embed_model is not None
+                "embed_model_available": self.embed_model is not None,
+                "index_dir": self.loaded_index_dir,
+                "index_version": self.index_version,
+                "index_config": index_store.index_config(),
+                "index_size": self.vector_store.index.ntotal if self.vector_store is not None else 0,
+                "last_build": self.last_build_stats
             }
         except Exception as e:
             return {"error": str(e)}
@@ -373,34 +1056,73 @@ class RAGService:
         except Exception as e:
             return {"healthy": False, "issues": [f"健康检查失败: {e}"]}
     
-    def rebuild_vector_db(self):
-        """重建向量数据库（优化版）"""
+    def reload_if_stale(self, interval: float = None):
+        """
+        其他进程发布了新版本时在后台重新加载（最多每 interval 秒检查一次 CURRENT）
+
+        多个 uvicorn worker 共享同一个 vector_db 目录，只有执行重建的进程会
+        直接切换内存中的索引，其余进程通过这里跟进。
+        """
+        interval = RAG_INDEX_CHECK_INTERVAL if interval is None else interval
+        now = time.time()
+        if now - self._last_stale_check < interval or self.embed_model is None:
+            return
+        self._last_stale_check = now
+        current = os.path.basename(os.path.normpath(self.vector_index_path))
+        if current == self.loaded_index_dir or self._maintenance_lock.locked():
+            return
+
+        def _reload():
+            if self._maintenance_lock.acquire(blocking=False):
+                try:
+                    print(f"检测到新的索引版本 {current}，后台重新加载...")
+                    self.load_vector_store()
+                finally:
+                    self._maintenance_lock.release()
+
+        threading.Thread(target=_reload, name="rag-index-reload", daemon=True).start()
+
+    def rebuild_vector_db(self, job=None):
+        """
+        重建向量数据库（优化版）
+
+        Args:
+            job: 可选的 MaintenanceJob，用于上报进度和响应取消
+        """
+        with self._maintenance_lock:
+            return self._rebuild_locked(job)
+
+    def _rebuild_locked(self, job=None):
+        """完全重建向量数据库（调用方需持有 _maintenance_lock）"""
         try:
-            print("开始重建向量数据库...")
-            
-            # 删除旧的向量数据库
-            if os.path.exists(self.vector_db_path):
-                import shutil
-                shutil.rmtree(self.vector_db_path)
-                print("已删除旧的向量数据库")
-            
-            # 重新初始化
-            self.initialized = False
+            # 新索引在版本目录中构建，完成后原子发布并热切换；
+            # 构建期间旧索引继续提供检索，失败时保持不变
+            print("开始重建向量数据库（构建完成后热切换）...")
             
             # 分步骤初始化，添加进度反馈
             print("### 步骤1: 初始化嵌入模型...")
-            if not self.initialize_models():
+            if job:
+                job.update("initializing")
+            if self.embed_model is None and not self.initialize_models():
                 print("模型初始化失败")
                 return False
             
-            print("### 步骤2: 加载知识库文档...")
-            documents = self.load_knowledge_base()
-            if not documents:
+            print("### 步骤2: 并行加载并分割知识库文档...")
+            load_start = time.time()
+            files = self._scan_knowledge_files()
+            chunks = self.load_and_split(
+                files, progress=job.reporter("loading", "files_loaded", "files_total") if job else None
+            )
+            if not chunks:
                 print("未找到知识库文档")
                 return False
+            print(f"加载分割完成，耗时 {time.time() - load_start:.2f}秒")
             
-            print(f"### 步骤3: 处理 {len(documents)} 个文档...")
-            if not self.create_vector_store(documents):
+            print(f"### 步骤3: 向量化 {len(chunks)} 个文本块（同时生成文件清单）...")
+            if not self.create_vector_store(
+                None, files=files, chunks=chunks,
+                progress=job.reporter("embedding", "chunks_embedded", "chunks_total") if job else None
+            ):
                 print("向量存储创建失败")
                 return False
             
@@ -411,23 +1133,11 @@ class RAGService:
             
             self.initialized = True
             print("向量数据库重建完成")
-            
-            # 更新已处理文件列表
-            print("### 步骤5: 更新已处理文件列表...")
-            all_files = set()
-            for root, dirs, files in os.walk(self.knowledge_base_path):
-                for file in files:
-                    if any(file.endswith(ext) for ext in ['.txt', '.md', '.pdf']):
-                        file_path = os.path.join(root, file)
-                        all_files.add(file_path)
-            
-            if all_files:
-                self.save_processed_files_list(all_files)
-            else:
-                print("警告: 没有找到任何文件，无法更新文件列表")
-            
             return True
             
+        except JobCancelled:
+            print("向量数据库重建已取消，继续使用旧索引")
+            raise
         except Exception as e:
             print(f"重建向量数据库失败: {e}")
             import traceback
@@ -435,10 +1145,17 @@ class RAGService:
             return False
 
     def get_processed_files_list(self):
-        """获取已处理文件列表"""
+        """获取已处理文件列表（来自索引清单，没有清单时读取旧版 processed_files.txt）"""
+        manifest = self.manifest or self.load_manifest()
+        if manifest is not None:
+            return {
+                os.path.join(self.knowledge_base_path, *file_key.split("/"))
+                for file_key in manifest.get("files", {})
+            }
+
         processed_files_path = os.path.join(self.vector_db_path, "processed_files.txt")
         processed_files = set()
-        
+
         if os.path.exists(processed_files_path):
             try:
                 with open(processed_files_path, 'r', encoding='utf-8') as f:
@@ -448,102 +1165,200 @@ class RAGService:
                             processed_files.add(file_path)
             except Exception as e:
                 print(f"读取已处理文件列表失败: {e}")
-        
+
         return processed_files
-    
-    def save_processed_files_list(self, file_paths):
-        """保存已处理文件列表"""
-        try:
-            os.makedirs(self.vector_db_path, exist_ok=True)
-            processed_files_path = os.path.join(self.vector_db_path, "processed_files.txt")
-            
-            print(f"保存文件列表到: {processed_files_path}")
-            print(f"文件数量: {len(file_paths)}")
-            
-            with open(processed_files_path, 'w', encoding='utf-8') as f:
-                for file_path in sorted(file_paths):
-                    f.write(file_path + '\n')
-            
-            print(f"已保存 {len(file_paths)} 个已处理文件到列表")
-            print(f"文件路径: {processed_files_path}")
-            return True
-        except Exception as e:
-            print(f"保存已处理文件列表失败: {e}")
-            import traceback
-            print(f"详细错误: {traceback.format_exc()}")
-            return False
-    
-    def update_vector_db_with_new_files(self):
-        """真正的增量更新向量数据库（只处理新文件）"""
-        try:
-            print("开始增量更新向量数据库...")
-            
-            # 1. 获取当前知识库中的所有文件
-            current_files = set()
-            for root, dirs, files in os.walk(self.knowledge_base_path):
-                for file in files:
-                    if any(file.endswith(ext) for ext in ['.txt', '.md', '.pdf']):
-                        file_path = os.path.join(root, file)
-                        current_files.add(file_path)
-            
-            print(f"知识库中共有 {len(current_files)} 个文件")
-            
-            # 2. 获取已处理的文件列表
-            processed_files = self.get_processed_files_list()
-            print(f"已处理文件: {len(processed_files)} 个")
-            
-            # 3. 找出真正的新文件（存在但未处理过的）
-            new_files = set()
-            for file_path in current_files:
-                if file_path not in processed_files:
-                    new_files.add(file_path)
-            
-            # 4. 找出已删除的文件（已处理但不存在了）
-            deleted_files = set()
-            for file_path in processed_files:
-                if file_path not in current_files:
-                    deleted_files.add(file_path)
-            
-            print(f"发现新文件: {len(new_files)} 个")
-            print(f"发现已删除文件: {len(deleted_files)} 个")
-            
-            if not new_files and not deleted_files:
-                print("没有文件变化，无需更新")
+
+    def update_vector_db_with_new_files(self, job=None):
+        """
+        真正的增量更新向量数据库
+
+        只对新增/修改文件的文本块做向量化，并从 FAISS 索引和 docstore 中删除
+        已删除/修改文件的旧块；结果写入新的版本目录后原子发布。
+        没有清单（旧版索引）或嵌入模型变化时回退到完全重建。
+
+        Args:
+            job: 可选的 MaintenanceJob，用于上报进度和响应取消
+        """
+        with self._maintenance_lock:
+            try:
+                print("开始增量更新向量数据库...")
+                start_time = time.time()
+
+                index_dir = self.vector_index_path
+                manifest = self.load_manifest(index_dir)
+                if manifest is None:
+                    print("当前索引没有文件清单，执行完全重建以生成清单...")
+                    return self._rebuild_locked(job)
+
+                if self.embed_model is None and not self.initialize_models():
+                    print("模型初始化失败")
+                    return False
+
+                if manifest.get("embed_model") and manifest["embed_model"] != self.embed_model_name:
+                    print(f"嵌入模型已变化（{manifest['embed_model']} -> {self.embed_model_name}），执行完全重建...")
+                    return self._rebuild_locked(job)
+
+                recorded_index = manifest.get("index", {"type": "flat", "quantization": "none", "docstore": "pickle"})
+                if recorded_index != index_store.index_config():
+                    print(f"索引配置已变化（{recorded_index} -> {index_store.index_config()}），执行完全重建...")
+                    return self._rebuild_locked(job)
+
+                # 1. 对比知识库与清单
+                if job:
+                    job.update("scanning")
+                diff = self.diff_knowledge_base(manifest)
+                added, changed, removed = diff["added"], diff["changed"], diff["removed"]
+                print(f"知识库中共有 {len(diff['current'])} 个文件")
+                print(f"新增 {len(added)} 个，修改 {len(changed)} 个，删除 {len(removed)} 个")
+
+                if not added and not changed and not removed:
+                    print("没有文件变化，无需更新")
+                    return True
+
+                for file_key in added:
+                    print(f"  + {file_key}")
+                for file_key in changed:
+                    print(f"  * {file_key}")
+                for file_key in removed:
+                    print(f"  - {file_key}")
+
+                # 2. 从磁盘加载当前索引的副本进行修改，线上检索继续使用内存中的旧索引
+                vector_store = index_store.read_vector_store(index_dir, self.embed_model, writable=True)
+
+                # 3. 删除已删除/修改文件的旧文本块
+                stale_ids = []
+                for file_key in list(removed) + list(changed):
+                    stale_ids.extend(manifest["files"][file_key].get("chunk_ids", []))
+                existing_ids = set(vector_store.index_to_docstore_id.values())
+                stale_ids = [chunk_id for chunk_id in stale_ids if chunk_id in existing_ids]
+                if stale_ids and not index_store.supports_remove(vector_store.index):
+                    print("当前索引类型不支持删除向量，执行完全重建...")
+                    return self._rebuild_locked(job)
+                if stale_ids:
+                    vector_store.delete(stale_ids)
+                    print(f"已删除 {len(stale_ids)} 个旧文本块")
+
+                # 4. 只对新增/修改文件做向量化
+                files_to_index = {**added, **changed}
+                ids_by_file = {}
+                if files_to_index:
+                    chunks = self.load_and_split(
+                        files_to_index,
+                        progress=job.reporter("loading", "files_loaded", "files_total") if job else None
+                    )
+                    ids, ids_by_file = self._assign_chunk_ids(chunks)
+                    if chunks:
+                        texts = [chunk.page_content for chunk in chunks]
+                        embeddings = self._embed_texts(
+                            texts,
+                            progress=job.reporter("embedding", "chunks_embedded", "chunks_total") if job else None
+                        )
+                        vector_store.add_embeddings(
+                            text_embeddings=list(zip(texts, embeddings)),
+                            metadatas=[chunk.metadata for chunk in chunks],
+                            ids=ids
+                        )
+                    print(f"已新增 {len(chunks)} 个文本块")
+
+                # 5. 生成新清单：未变化文件沿用原记录
+                new_manifest = self._build_manifest(files_to_index, ids_by_file)
+                for file_key in diff["unchanged"]:
+                    entry = dict(manifest["files"][file_key])
+                    try:
+                        entry.update(self._file_fingerprint(diff["current"][file_key], with_hash=False))
+                    except OSError:
+                        pass
+                    new_manifest["files"][file_key] = entry
+
+                # 6. 原子发布并切换内存中的索引（发布后不再响应取消）
+                if job:
+                    job.update("publishing")
+                new_index_dir = self._publish_vector_store(vector_store, new_manifest)
+                if not new_index_dir:
+                    return False
+                self._set_vector_store(self._open_published(vector_store, new_index_dir), new_index_dir)
+                self.manifest = new_manifest
+                self.initialized = True
+
+                print(f"增量更新完成，耗时: {time.time() - start_time:.2f}秒")
                 return True
-            
-            # 5. 如果有文件变化，需要完全重建（因为FAISS不支持真正的增量更新）
-            if new_files:
-                print("新文件列表:")
-                for file_path in new_files:
-                    print(f"  + {file_path}")
-            
-            if deleted_files:
-                print("已删除文件列表:")
-                for file_path in deleted_files:
-                    print(f"  - {file_path}")
-            
-            print("由于文件变化，执行完全重建...")
-            success = self.rebuild_vector_db()
-            
-            if success:
-                # 6. 更新已处理文件列表
-                self.save_processed_files_list(current_files)
-                print("已更新文件处理记录")
-            
-            return success
-                
-        except Exception as e:
-            print(f"增量更新失败: {e}")
-            import traceback
-            print(f"详细错误: {traceback.format_exc()}")
-            print("回退到完全重建...")
-            return self.rebuild_vector_db()
 
+            except JobCancelled:
+                print("增量更新已取消，继续使用旧索引")
+                raise
+            except Exception as e:
+                print(f"增量更新失败: {e}")
+                import traceback
+                print(f"详细错误: {traceback.format_exc()}")
+                print("回退到完全重建...")
+                return self._rebuild_locked(job)
+
+    def refresh_vector_db(self, job=None) -> dict:
+        """
+        智能刷新向量数据库：健康时增量更新，失败时重新加载，再失败则完全重建
+
+        Args:
+            job: 可选的 MaintenanceJob，用于上报进度和响应取消
+
+        Returns:
+            {"message", "success", "action", "elapsed_time"[, "issues"]}
+        """
+        start_time = time.time()
+
+        def _result(message, success, action, **extra):
+            elapsed = round(time.time() - start_time, 2)
+            print(f"{message}，耗时: {elapsed:.2f}秒")
+            return {"message": message, "success": success, "action": action,
+                    "elapsed_time": elapsed, **extra}
+
+        print("=" * 50)
+        print("开始智能刷新向量数据库...")
+        print("=" * 50)
+
+        # 1. 检查当前状态
+        print("检查向量数据库健康状态...")
+        health_status = self.check_vector_db_health()
+
+        if health_status["healthy"]:
+            # 如果数据库健康，尝试增量更新新文件
+            print("向量数据库健康，尝试增量更新新文件...")
+            if self.update_vector_db_with_new_files(job):
+                return _result("向量数据库已更新新文件", True, "update")
+
+            # 增量更新失败，尝试重新加载
+            print("增量更新失败，尝试重新加载...")
+            if self.load_vector_store():
+                return _result("向量数据库状态良好，已重新加载", True, "reload")
+
+            # 加载失败，需要重建
+            print("重新加载失败，开始完全重建...")
+            if self.rebuild_vector_db(job):
+                return _result("向量数据库加载失败，已重建", True, "rebuild")
+            return _result("向量数据库重建失败", False, "rebuild_failed")
+
+        # 数据库不健康，需要重建
+        print("向量数据库不健康，开始重建...")
+        for issue in health_status["issues"]:
+            print(f"问题: {issue}")
+        if self.rebuild_vector_db(job):
+            return _result("向量数据库已重建", True, "rebuild", issues=health_status["issues"])
+        return _result("向量数据库重建失败", False, "rebuild_failed", issues=health_status["issues"])
 
 # 全局 RAG 服务实例（延迟初始化）
 rag_service = None
 _rag_initialized = False
 
+# 后台预热状态：idle / warming / ready / failed
+# 初始化失败后按指数退避重试，避免每个请求都重新加载模型
+RAG_INIT_BACKOFF = float(os.getenv("RAG_INIT_BACKOFF", 30))          # 首次重试间隔（秒）
+RAG_INIT_BACKOFF_MAX = float(os.getenv("RAG_INIT_BACKOFF_MAX", 600))  # 最大重试间隔（秒）
+_rag_state = "idle"
+_rag_init_attempts = 0
+_rag_next_init_at = 0.0
+_rag_last_error = None
+_rag_ready_at = None
+_rag_state_lock = threading.Lock()
+
 def get_rag_service() -> RAGService:
     """获取 RAG 服务实例"""
     global rag_service
@@ -552,79 +1367,138 @@ def get_rag_service() -> RAGService:
     return rag_service
 
 def initialize_rag_service():
-    """初始化 RAG 服务（延迟初始化）"""
-    global _rag_initialized
+    """初始化 RAG 服务（同步执行，失败后记录退避时间）"""
+    global _rag_initialized, _rag_state, _rag_init_attempts, _rag_next_init_at, _rag_last_error, _rag_ready_at
     if _rag_initialized:
         return True
     
+    _rag_init_attempts += 1
     try:
         service = get_rag_service()
         result = service.initialize()
-        _rag_initialized = result
         if result:
             print("RAG 服务初始化成功")
         else:
             print("RAG 服务初始化失败，将使用基础 LLM 功能")
-        return result
+            _rag_last_error = "初始化失败，详见日志"
     except Exception as e:
         print(f"RAG 服务初始化异常: {e}")
         print("RAG 服务将不可用，使用基础 LLM 功能")
-        return False
+        _rag_last_error = str(e)
+        result = False
 
-def check_and_initialize_vector_db():
-    """检查并初始化向量数据库"""
-    try:
-        service = get_rag_service()
-        
-        health_status = service.check_vector_db_health()
-        
-        if health_status["healthy"]:
-            if service.load_vector_store():
-                return True
-        
-        if not os.path.exists(service.knowledge_base_path):
-            return False
-        
-        documents = service.load_knowledge_base()
-        if not documents:
+    with _rag_state_lock:
+        _rag_initialized = result
+        if result:
+            _rag_state = "ready"
+            _rag_ready_at = time.time()
+            _rag_last_error = None
+        else:
+            _rag_state = "failed"
+            delay = min(RAG_INIT_BACKOFF_MAX, RAG_INIT_BACKOFF * 2 ** (_rag_init_attempts - 1))
+            _rag_next_init_at = time.time() + delay
+            print(f"RAG 服务将在 {delay:.0f} 秒后重试初始化")
+    return result
+
+def start_rag_warmup() -> bool:
+    """
+    在后台线程中预热 RAG（加载嵌入模型和向量库），立即返回
+
+    已就绪、正在预热或处于退避期时不做任何事。返回是否启动了新的预热线程。
+    """
+    global _rag_state
+    with _rag_state_lock:
+        if _rag_initialized or _rag_state == "warming" or time.time() < _rag_next_init_at:
             return False
-        
-        return service.initialize()
-            
-    except Exception as e:
-        print(f"向量数据库检查失败: {e}")
-        return False
+        _rag_state = "warming"
+
+    threading.Thread(target=initialize_rag_service, name="rag-warmup", daemon=True).start()
+    return True
+
+def get_rag_readiness() -> dict:
+    """RAG 预热状态，供 /readyz 使用"""
+    with _rag_state_lock:
+        return {
+            "state": _rag_state,
+            "ready": _rag_initialized,
+            "attempts": _rag_init_attempts,
+            "last_error": _rag_last_error,
+            "next_retry_in": round(max(0.0, _rag_next_init_at - time.time()), 1) if _rag_state == "failed" else None,
+            "ready_at": _rag_ready_at,
+        }
+
+
+def _basic_query(user_query: str) -> str:
+    """RAG 不可用时的基础查询"""
+    return f"""用户问题：{user_query}
+
+请基于您的知识回答用户的问题。"""
+
 
+def enhance_query_with_rag(user_query: str, max_tokens: int = None) -> str:
+    """
+    使用 RAG 增强用户查询
 
-def enhance_query_with_rag(user_query: str) -> str:
-    """使用 RAG 增强用户查询"""
+    Args:
+        max_tokens: 增强后文本的 token 上限（由调用方按模型上下文计算），None 表示不限制
+    """
+    return prepare_rag_query(user_query, max_tokens)["text"]
+
+
+def prepare_rag_query(user_query: str, max_tokens: int = None) -> dict:
+    """
+    使用 RAG 增强用户查询，并返回查询向量、使用的块ID和索引版本（供语义答案缓存使用）
+
+    RAG 不可用时 embedding 为 None，格式见 RAGService.prepare_query
+    """
+    basic = {"text": _basic_query(user_query), "embedding": None, "chunk_ids": (), "index_version": None}
     try:
-        # 如果RAG服务未初始化，尝试初始化
-        if not _rag_initialized:
-            print("RAG服务未初始化，尝试初始化...")
-            initialize_rag_service()
-        
         service = get_rag_service()
+        
+        # RAG 未就绪时不阻塞请求：触发后台预热（遵守退避），本次使用词法检索后备或基础查询
+        if not _rag_initialized and not service.is_available():
+            if start_rag_warmup():
+                print("RAG服务未初始化，已在后台开始预热")
+            return _lexical_query(user_query, max_tokens) or basic
+        
+        service.reload_if_stale()
         if service.is_available():
-            return service.enhance_query(user_query)
+            return service.prepare_query(user_query, max_tokens)
         else:
             print("RAG服务不可用，使用基础查询")
-            return f"""用户问题：{user_query}
-
-请基于您的知识回答用户的问题。"""
+            return _lexical_query(user_query, max_tokens) or basic
     except Exception as e:
         print(f"RAG 增强查询失败: {e}")
         # 返回原始查询，不进行增强
-        return user_query
+        return dict(basic, text=user_query)
+
+def _lexical_query(user_query: str, max_tokens: int = None):
+    """嵌入模型不可用时使用 BM25 词法检索（已启用时），否则返回 None"""
+    from simple_rag import get_lexical_fallback
+
+    lexical = get_lexical_fallback()
+    if lexical is None:
+        return None
+    return lexical.prepare_query(user_query, max_tokens)
 
 def get_rag_status():
     """获取 RAG 服务状态"""
     try:
+        from simple_rag import get_simple_rag_service
+        from embed_server import get_embed_server_stats
+
         service = get_rag_service()
         return {
             "initialized": _rag_initialized,
             "available": service.is_available(),
-            "knowledge_base_path": service.knowledge_base_path
+            "warmup": get_rag_readiness(),
+            "knowledge_base_path": service.knowledge_base_path,
+            "embed_backend": service.embed_backend,
+            "embed_server": get_embed_server_stats(),
+            "cache": service.get_cache_stats(),
+            "retrieval": service.get_retrieval_stats(),
+            "rerank": get_rerank_stats(),
+            "lexical": get_simple_rag_service().get_stats()
         }
     except Exception as e:
         return {"error": str(e)}
\ No newline at end of file
@@ -0,0 +1,225 @@
+"""
+流式回复的检查点持久化与断线续传
+
+生成过程中的分片追加到列表（检查点时合并），每 STREAM_CHECKPOINT_CHUNKS 个分片或
+STREAM_CHECKPOINT_INTERVAL 秒把当前内容写入 chatcontent 的同一行（status='streaming'），
+结束时标记为 complete（正常结束）或 interrupted（出错 / 客户端断开）。
+worker 崩溃时最多丢失最后一个检查点之后的内容，已写入的部分仍可在历史记录中看到。
+
+检查点写入在后台任务中进行，不阻塞向客户端输出；写入期间又到达的检查点会合并为一次。
+
+客户端通过响应头 X-Stream-Id 拿到流ID，连接中断后用 /stream/resume?stream_id=&offset= 续传：
+- 本进程中正在生成（或刚结束）的流：从内存读取并继续跟随新分片
+- 其他 worker 上的流：轮询数据库中的检查点，直到标记结束，或超过 STREAM_STALE_SECONDS 未更新（生成进程已退出）
+offset 为客户端已收到的字符数（Unicode 码点）。
+
+检查点依赖迁移 002 添加的 status / stream_id / updated_at 列；尚未执行迁移的数据库不写检查点，
+回复结束时整条交给消息存储保存，续传只能读取本进程内存中的流。
+"""
+import os
+import time
+import asyncio
+from typing import Dict
+
+from database import get_async_db_connection, has_columns
+
+STREAM_CHECKPOINT = os.getenv("STREAM_CHECKPOINT", "true").lower() in ("1", "true", "yes")
+STREAM_CHECKPOINT_CHUNKS = int(os.getenv("STREAM_CHECKPOINT_CHUNKS", 64))          # 分片数（约等于 token 数）
+STREAM_CHECKPOINT_INTERVAL = float(os.getenv("STREAM_CHECKPOINT_INTERVAL", 2.0))   # 秒
+STREAM_STALE_SECONDS = int(os.getenv("STREAM_STALE_SECONDS", 30))  # streaming 状态超过该时间未更新视为生成已中断
+STREAM_RESUME_POLL = 1.0   # 续传其他 worker 的流时轮询数据库的间隔（秒）
+STREAM_LIVE_TTL = 300      # 结束后的流在内存中保留的时间（秒），供稍晚的续传请求读取
+
+STATUS_STREAMING = "streaming"
+STATUS_COMPLETE = "complete"
+STATUS_INTERRUPTED = "interrupted"
+
+_live: Dict[str, "ReplyStream"] = {}
+
+
+async def _checkpoint_columns() -> bool:
+    return await has_columns("002_stream_checkpoints.sql")
+
+
+class ReplyStream:
+    """一次流式回复：分片缓冲、定期检查点、续传读取"""
+
+    def __init__(self, stream_id: str, subjectid: int):
+        self.stream_id = stream_id
+        self.subjectid = subjectid
+        self.message_id = None
+        self.status = STATUS_STREAMING
+        self.length = 0
+        self._chunks = []
+        self._since_checkpoint = 0
+        self._last_checkpoint = time.monotonic()
+        self._writer = None
+        self._dirty = False
+        self._updated = asyncio.Event()
+        if stream_id:
+            _live[stream_id] = self
+
+    @property
+    def finished(self) -> bool:
+        return self.status != STATUS_STREAMING
+
+    def text(self) -> str:
+        """当前完整内容（合并分片，后续调用不再重复拼接）"""
+        if len(self._chunks) > 1:
+            self._chunks = ["".join(self._chunks)]
+        return self._chunks[0] if self._chunks else ""
+
+    def append(self, chunk: str):
+        self._chunks.append(chunk)
+        self.length += len(chunk)
+        self._since_checkpoint += 1
+        self._notify()
+        if STREAM_CHECKPOINT and (self._since_checkpoint >= STREAM_CHECKPOINT_CHUNKS
+                                  or time.monotonic() - self._last_checkpoint >= STREAM_CHECKPOINT_INTERVAL):
+            self._schedule_checkpoint()
+
+    def finish(self, complete: bool):
+        """
+        结束流并保存最终内容（在后台完成，不受请求取消影响）
+
+        Args:
+            complete: 正常生成结束为 True，出错或客户端断开为 False
+        """
+        from llm_utils import spawn_background_task
+
+        if self.finished:
+            return
+        self.status = STATUS_COMPLETE if complete else STATUS_INTERRUPTED
+        self._notify()
+        if self.stream_id:
+            asyncio.get_running_loop().call_later(STREAM_LIVE_TTL, _live.pop, self.stream_id, None)
+        if not self.length and self.message_id is None:
+            return
+        if STREAM_CHECKPOINT:
+            self._schedule_checkpoint()
+        else:
+            from llm_utils import _async_save_assistant_reply
+            spawn_background_task(_async_save_assistant_reply(self.subjectid, self.text()))
+
+    def _notify(self):
+        self._updated.set()
+        self._updated = asyncio.Event()
+
+    def _schedule_checkpoint(self):
+        from llm_utils import spawn_background_task
+
+        self._since_checkpoint = 0
+        self._last_checkpoint = time.monotonic()
+        if self._writer is not None and not self._writer.done():
+            self._dirty = True
+            return
+        self._writer = spawn_background_task(self._write_loop())
+
+    async def _write_loop(self):
+        while True:
+            self._dirty = False
+            try:
+                await self._persist()
+            except Exception as e:
+                print(f"保存回复检查点失败（stream_id={self.stream_id}）: {e}")
+                if self.finished:
+                    await self._fallback_save()
+                return
+            if not self._dirty:
+                return
+
+    async def _persist(self):
+        """把当前内容写入（首次插入，之后按ID更新）"""
+        content, status = self.text(), self.status
+        if not await _checkpoint_columns():
+            if status != STATUS_STREAMING:
+                await self._fallback_save()
+            return
+        if self.message_id is None:
+            # 先写入该主题排队中的消息（本轮用户消息），保证回复的自增ID在用户消息之后
+            from message_store import get_message_store
+            await get_message_store().sync_subject(self.subjectid)
+        async with get_async_db_connection() as conn:
+            async with conn.cursor() as cursor:
+                if self.message_id is None:
+                    await cursor.execute(
+                        "INSERT INTO chatcontent (subjectid, content, role, status, stream_id) "
+                        "VALUES (%s, %s, %s, %s, %s)",
+                        (self.subjectid, content, "assistant", status, self.stream_id or None)
+                    )
+                    self.message_id = cursor.lastrowid
+                else:
+                    await cursor.execute(
+                        "UPDATE chatcontent SET content = %s, status = %s WHERE id = %s",
+                        (content, status, self.message_id)
+                    )
+                await conn.commit()
+        if status != STATUS_STREAMING:
+            print(f"AI 回复已保存：subjectid={self.subjectid}, length={len(content)}, status={status}")
+
+    async def _fallback_save(self):
+        """最终保存失败且还没有检查点行时，交给消息存储（WAL）保存完整回复"""
+        if self.message_id is not None:
+            return
+        from llm_utils import _async_save_assistant_reply
+        await _async_save_assistant_reply(self.subjectid, self.text())
+
+    async def follow(self, offset: int):
+        """从 offset 开始返回内容，并跟随新分片直到流结束"""
+        while True:
+            updated = self._updated
+            text = self.text()
+            if len(text) > offset:
+                yield text[offset:]
+                offset = len(text)
+            if self.finished:
+                return
+            await updated.wait()
+
+
+async def _fetch_checkpoint(stream_id: str):
+    if not await _checkpoint_columns():
+        return None
+    async with get_async_db_connection() as conn:
+        async with conn.cursor() as cursor:
+            await cursor.execute(
+                "SELECT id, content, status, TIMESTAMPDIFF(SECOND, updated_at, NOW()) AS idle "
+                "FROM chatcontent WHERE stream_id = %s",
+                (stream_id,)
+            )
+            return await cursor.fetchone()
+
+
+async def find_stream(stream_id: str) -> bool:
+    """流是否存在（本进程中在生成，或数据库中已有检查点）"""
+    return stream_id in _live or await _fetch_checkpoint(stream_id) is not None
+
+
+async def resume_stream(stream_id: str, offset: int = 0):
+    """续传：返回流从 offset 开始的内容，流仍在生成时继续跟随"""
+    live = _live.get(stream_id)
+    if live is not None:
+        async for piece in live.follow(offset):
+            yield piece
+        return
+
+    # 在其他 worker 上生成（或生成进程已退出）：轮询检查点
+    while True:
+        row = await _fetch_checkpoint(stream_id)
+        if row is None:
+            return
+        content = row["content"] or ""
+        if len(content) > offset:
+            yield content[offset:]
+            offset = len(content)
+        if row["status"] != STATUS_STREAMING or (row["idle"] or 0) > STREAM_STALE_SECONDS:
+            return
+        await asyncio.sleep(STREAM_RESUME_POLL)
+
+
+def get_stream_stats() -> dict:
+    return {
+        "checkpoint": STREAM_CHECKPOINT,
+        "live": sum(1 for reply in _live.values() if not reply.finished),
+        "retained": len(_live),
+    }
@@ -0,0 +1,156 @@
+"""
+检索结果重排序：本地交叉编码器（cross-encoder）对 (问题, 文本块) 打分
+
+开启后检索先取较多的候选（RERANK_CANDIDATES），一次批量打分后按得分排序，
+只保留得分不低于 RERANK_THRESHOLD 的前 RERANK_TOP_K 个文本块，再按 token 预算裁剪；
+不相关的文本块不再进入提示词，减少推理服务的预填充耗时。
+
+打分按 (归一化问题, 块ID, 索引版本) 缓存，相同问题的重复检索只对新的候选打分。
+sentence-transformers 在首次加载模型时按需导入（通常在 RAG 后台预热中），加载失败时跳过重排序。
+"""
+import os
+import time
+import threading
+from typing import List, Tuple
+
+from cache_utils import LRUCache, normalize_query
+
+RERANK = os.getenv("RERANK", "false").lower() in ("1", "true", "yes")
+# 本地模型目录（../bge-reranker）存在时优先使用，否则按名称从 HuggingFace 加载
+RERANK_MODEL = os.getenv("RERANK_MODEL", "")
+RERANK_DEFAULT_MODEL = "BAAI/bge-reranker-base"
+RERANK_CANDIDATES = int(os.getenv("RERANK_CANDIDATES", 30))       # 交给重排序的候选数
+RERANK_TOP_K = int(os.getenv("RERANK_TOP_K", 3))                  # 最多保留的文本块数
+RERANK_THRESHOLD = float(os.getenv("RERANK_THRESHOLD", 0.3))      # 得分（0~1）下限
+RERANK_BATCH_SIZE = int(os.getenv("RERANK_BATCH_SIZE", 32))
+RERANK_MAX_LENGTH = int(os.getenv("RERANK_MAX_LENGTH", 512))      # 问题 + 文本块的最大 token 数
+RERANK_CACHE_SIZE = int(os.getenv("RERANK_CACHE_SIZE", 20000))
+
+
+class Reranker:
+    """交叉编码器重排序（CPU），打分结果缓存"""
+
+    def __init__(self):
+        self.model = None
+        self.model_name = None
+        self.load_error = None
+        self._load_lock = threading.Lock()
+        self._loaded = False
+        self.score_cache = LRUCache(RERANK_CACHE_SIZE)
+        self.calls = 0
+        self.scored_pairs = 0
+        self.candidates = 0
+        self.kept = 0
+        self.seconds = 0.0
+
+    def _model_path(self) -> str:
+        if RERANK_MODEL:
+            return RERANK_MODEL
+        local_path = os.path.join(os.path.dirname(__file__), "..", "bge-reranker")
+        return local_path if os.path.exists(local_path) else RERANK_DEFAULT_MODEL
+
+    def load(self) -> bool:
+        """加载模型（只尝试一次），返回是否可用"""
+        if self._loaded:
+            return self.model is not None
+        with self._load_lock:
+            if self._loaded:
+                return self.model is not None
+            model_path = self._model_path()
+            try:
+                from sentence_transformers import CrossEncoder
+                start = time.time()
+                self.model = CrossEncoder(model_path, max_length=RERANK_MAX_LENGTH, device="cpu")
+                self.model_name = os.path.basename(os.path.normpath(model_path))
+                print(f"重排序模型加载成功: {model_path}，耗时 {time.time() - start:.2f}秒")
+            except Exception as e:
+                print(f"重排序模型加载失败，跳过重排序: {e}")
+                self.load_error = str(e)
+                self.model = None
+            self._loaded = True
+        return self.model is not None
+
+    def score(self, query: str, chunks: List[Tuple[str, str]], index_version=None) -> List[float]:
+        """
+        对 [(块ID, 文本)] 打分（0~1，越高越相关），未缓存的候选一次批量计算
+
+        Returns:
+            与 chunks 顺序一致的得分列表
+        """
+        normalized = normalize_query(query)
+        keys = [(normalized, chunk_id or text, index_version) for chunk_id, text in chunks]
+        scores = [self.score_cache.get(key) for key in keys]
+        missing = [i for i, score in enumerate(scores) if score is None]
+        if missing:
+            predicted = self.model.predict(
+                [(query, chunks[i][1]) for i in missing],
+                batch_size=RERANK_BATCH_SIZE,
+                show_progress_bar=False
+            )
+            for i, score in zip(missing, predicted):
+                scores[i] = float(score)
+                self.score_cache.set(keys[i], scores[i])
+            self.scored_pairs += len(missing)
+        return scores
+
+    def rerank(self, query: str, chunks: List[Tuple[str, str]], index_version=None,
+               top_k: int = None, threshold: float = None) -> List[Tuple[str, str, float]]:
+        """
+        重排序并过滤
+
+        Returns:
+            [(块ID, 文本, 得分)]，按得分从高到低，只含得分不低于阈值的前 top_k 个
+        """
+        top_k = RERANK_TOP_K if top_k is None else top_k
+        threshold = RERANK_THRESHOLD if threshold is None else threshold
+        if not chunks:
+            return []
+        start = time.perf_counter()
+        scores = self.score(query, chunks, index_version)
+        ranked = sorted(zip(chunks, scores), key=lambda item: item[1], reverse=True)
+        kept = [(chunk_id, text, score) for (chunk_id, text), score in ranked if score >= threshold][:top_k]
+
+        self.calls += 1
+        self.candidates += len(chunks)
+        self.kept += len(kept)
+        self.seconds += time.perf_counter() - start
+        return kept
+
+    def get_stats(self) -> dict:
+        return {
+            "enabled": RERANK,
+            "model": self.model_name,
+            "available": self.model is not None,
+            "load_error": self.load_error,
+            "candidates": RERANK_CANDIDATES,
+            "top_k": RERANK_TOP_K,
+            "threshold": RERANK_THRESHOLD,
+            "calls": self.calls,
+            "avg_ms": round(self.seconds / self.calls * 1000, 2) if self.calls else None,
+            "avg_kept": round(self.kept / self.calls, 2) if self.calls else None,
+            "avg_candidates": round(self.candidates / self.calls, 2) if self.calls else None,
+            "scored_pairs": self.scored_pairs,
+            "score_cache": self.score_cache.stats(),
+        }
+
+
+_reranker = None
+_reranker_lock = threading.Lock()
+
+
+def get_reranker():
+    """RERANK 开启且模型可用时返回重排序器，否则返回 None"""
+    global _reranker
+    if not RERANK:
+        return None
+    if _reranker is None:
+        with _reranker_lock:
+            if _reranker is None:
+                _reranker = Reranker()
+    return _reranker if _reranker.load() else None
+
+
+def get_rerank_stats() -> dict:
+    if _reranker is None:
+        return {"enabled": RERANK, "available": False}
+    return _reranker.get_stats()
@@ -1,18 +1,29 @@
-from fastapi import APIRouter, UploadFile, HTTPException
+from fastapi import APIRouter, UploadFile, HTTPException, Query
 from fastapi.responses import StreamingResponse, JSONResponse
+from starlette.requests import ClientDisconnect
 from pydantic import BaseModel
-from typing import List
+from typing import List, Optional
 from pathlib import Path
 import mimetypes
 import os
+import json
+import asyncio
 from uuid import uuid4
 
-from database import get_db_connection
-from llm_utils import llm_stream, llm
-from rag_service import get_rag_status
+from database import get_db_connection, get_async_db_connection, has_columns
+from llm_utils import (async_llm_stream, async_llm, get_http_client_stats, get_answer_cache_stats,
+                       get_generation_stats, spawn_background_task)
+from token_budget import PromptTooLongError
+from message_store import get_message_store
+from rag_service import get_rag_status, get_rag_readiness
 
 router = APIRouter()
 
+# 列表接口分页配置
+SUBJECT_PAGE_SIZE = int(os.getenv("SUBJECT_PAGE_SIZE", 50))
+CHAT_PAGE_SIZE = int(os.getenv("CHAT_PAGE_SIZE", 50))
+MAX_PAGE_SIZE = 200
+
 
 # 内部工具：保存上传文件并返回 URL
 async def _save_upload(img1: UploadFile) -> JSONResponse:
@@ -68,13 +79,15 @@ async def upload_lower(img1: UploadFile):
 
 # 简单聊天
 @router.post("/chat")
-def chat(request: dict):
+async def chat(request: dict):
     try:
         text = request.get("text", "")
         if not text:
             raise HTTPException(status_code=400, detail="缺少text参数")
-        ai_content = llm(text)
+        ai_content = await async_llm(text)
         return {"code": 2000, "content": ai_content}
+    except PromptTooLongError as e:
+        raise HTTPException(status_code=413, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"LLM 调用失败: {e}")
 
@@ -110,9 +123,86 @@ def extract_clean_title(raw_title: str) -> str:
     return title
 
 
+# 主题生成提示词
+TITLE_PROMPT_TEMPLATE = "对话内容：{text}\n请严格按以下要求生成主题：\n内容要求：需准确概括对话核心信息（如事件、讨论话题、核心诉求等），能让他人通过主题快速知晓对话大致内容；禁止仅用单一时间名词（如 '2014 年''周一'），禁止仅用无意义的宽泛表述（如 '日常对话''问题讨论'）。\n格式要求：仅返回纯文字主题，字数控制在 5-10 字，使用短语或名词组合（如 '讨论产品定价''咨询旅行攻略'）；绝对禁止添加 '主题：''答：' 等任何前缀 / 后缀，禁止出现标点符号（除必要的连接符 '-' 外）。\n输出要求：仅输出最终主题文本，不附带任何额外说明、解释或补充文字。"
+
+
+# 新主题先以占位标题入库，真正的标题在后台生成后回写
+PLACEHOLDER_TITLE = "新对话"
+TITLE_MAX_TOKENS = int(os.getenv("TITLE_MAX_TOKENS", 64))
+TITLE_SYSTEM_PROMPT = "你是对话标题生成器，只输出简短的中文标题。"
+
+
+async def _generate_title(text: str) -> str:
+    """调用 LLM 生成对话主题（不走 RAG，短提示词、小 max_tokens），失败时使用默认主题"""
+    try:
+        raw_title = await async_llm(
+            TITLE_PROMPT_TEMPLATE.format(text=text[:500]),
+            use_rag=False,
+            system_prompt=TITLE_SYSTEM_PROMPT,
+            max_tokens=TITLE_MAX_TOKENS,
+        )
+        return extract_clean_title(raw_title)
+    except Exception as title_err:
+        print(f"生成主题失败: {title_err}")
+        return PLACEHOLDER_TITLE  # 使用默认主题
+
+
+async def _generate_and_save_title(subjectid: int, text: str):
+    """后台任务：生成主题并回写到 subject 表（仅覆盖占位标题）"""
+    title = await _generate_title(text)
+    if title == PLACEHOLDER_TITLE:
+        return
+    try:
+        async with get_async_db_connection() as conn:
+            async with conn.cursor() as cursor:
+                await cursor.execute(
+                    "UPDATE subject SET title = %s WHERE id = %s AND title = %s",
+                    (title, subjectid, PLACEHOLDER_TITLE)
+                )
+                await conn.commit()
+                print(f"主题已生成：subjectid={subjectid}, title={title}")
+    except Exception as e:
+        print(f"保存主题失败: {e}")
+
+
+async def _wait_disconnect(receive):
+    while True:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            return
+
+
+class CancellableStreamingResponse(StreamingResponse):
+    """
+    客户端断开时立即结束生成器的流式响应
+
+    新版 Starlette 只在下一次发送失败时才发现断开（等待首 token 期间察觉不到），
+    且发送失败后生成器停在 yield 处，要等垃圾回收才关闭。这里另起任务监听 http.disconnect，
+    断开时取消发送任务，并在响应结束后显式关闭生成器：生成器的 finally 随即关闭到推理服务的连接，
+    推理服务据此中止该请求，已生成的内容照常保存。
+    """
+
+    async def __call__(self, scope, receive, send):
+        sending = asyncio.ensure_future(super().__call__(scope, receive, send))
+        disconnect = asyncio.ensure_future(_wait_disconnect(receive))
+        try:
+            await asyncio.wait((sending, disconnect), return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            for task in (sending, disconnect):
+                task.cancel()
+            await asyncio.gather(sending, disconnect, return_exceptions=True)
+            if hasattr(self.body_iterator, "aclose"):
+                await self.body_iterator.aclose()
+        if not sending.cancelled():
+            error = sending.exception()
+            if error is not None and not isinstance(error, (ClientDisconnect, OSError)):
+                raise error
+
+
 # 流式对话
 @router.post("/stream")
-def stream(request: dict):
+async def stream(request: dict):
     try:
         text = request.get("text", "")
         subjectid = request.get("subjectid", 0)
@@ -122,69 +212,32 @@ def stream(request: dict):
         
         # 确保subjectid有效
         final_subjectid = subjectid
+        new_subject = False
         
         try:
-            with get_db_connection() as conn:
-                with conn.cursor() as cursor:
-                    # 如果是新对话，创建主题
-                    if subjectid == 0:
-                        try:
-                            raw_title = llm(f"对话内容：{text}\n请严格按以下要求生成主题：\n内容要求：需准确概括对话核心信息（如事件、讨论话题、核心诉求等），能让他人通过主题快速知晓对话大致内容；禁止仅用单一时间名词（如 '2014 年''周一'），禁止仅用无意义的宽泛表述（如 '日常对话''问题讨论'）。\n格式要求：仅返回纯文字主题，字数控制在 5-10 字，使用短语或名词组合（如 '讨论产品定价''咨询旅行攻略'）；绝对禁止添加 '主题：''答：' 等任何前缀 / 后缀，禁止出现标点符号（除必要的连接符 '-' 外）。\n输出要求：仅输出最终主题文本，不附带任何额外说明、解释或补充文字。")
-                            title = extract_clean_title(raw_title)
-                        except Exception as title_err:
-                            print(f"生成主题失败: {title_err}")
-                            title = "新对话"  # 使用默认主题
-
-                        # 插入主题
-                        insert_subject_sql = "INSERT INTO subject (title) VALUES (%s)"
-                        cursor.execute(insert_subject_sql, (title,))
-                        final_subjectid = cursor.lastrowid
-                        
-                        # 验证主题是否创建成功
-                        if final_subjectid == 0:
-                            cursor.execute("SELECT id FROM subject WHERE title = %s ORDER BY id DESC LIMIT 1", (title,))
-                            result = cursor.fetchone()
-                            if result:
-                                final_subjectid = result['id']
-
-                        # 保存用户消息（事务内）
-                        insert_chat_sql = "INSERT INTO chatcontent (subjectid, content, role) VALUES (%s, %s, %s)"
-                        cursor.execute(insert_chat_sql, (final_subjectid, text, "user"))
-
-                        conn.commit()  # 提交事务
-                        print(f"用户消息已保存，subjectid: {final_subjectid}")
-
-                    else:
-                        # 验证现有主题是否存在
-                        cursor.execute("SELECT id FROM subject WHERE id = %s", (subjectid,))
-                        if not cursor.fetchone():
-                            print(f"主题ID {subjectid} 不存在，创建新主题")
-                            try:
-                                raw_title = llm(f"对话内容：{text}\n请严格按以下要求生成主题：\n内容要求：需准确概括对话核心信息（如事件、讨论话题、核心诉求等），能让他人通过主题快速知晓对话大致内容；禁止仅用单一时间名词（如 '2014 年''周一'），禁止仅用无意义的宽泛表述（如 '日常对话''问题讨论'）。\n格式要求：仅返回纯文字主题，字数控制在 5-10 字，使用短语或名词组合（如 '讨论产品定价''咨询旅行攻略'）；绝对禁止添加 '主题：''答：' 等任何前缀 / 后缀，禁止出现标点符号（除必要的连接符 '-' 外）。\n输出要求：仅输出最终主题文本，不附带任何额外说明、解释或补充文字。")
-                                title = extract_clean_title(raw_title)
-                            except Exception as title_err:
-                                print(f"生成主题失败: {title_err}")
-                                title = "新对话"  # 使用默认主题
-                            cursor.execute("INSERT INTO subject (title) VALUES (%s)", (title,))
-                            final_subjectid = cursor.lastrowid
-                        
-                        # 保存用户消息
-                        insert_chat_sql = "INSERT INTO chatcontent (subjectid, content, role) VALUES (%s, %s, %s)"
-                        cursor.execute(insert_chat_sql, (final_subjectid, text, "user"))
-                        conn.commit()
-                        print(f"用户消息已保存，subjectid: {final_subjectid}")
-                        
+            store = get_message_store()
+            # 新对话或主题不存在时创建主题（先用占位标题，标题在后台生成）；已确认存在的主题不再查询
+            final_subjectid, new_subject = await store.ensure_subject(subjectid, PLACEHOLDER_TITLE)
+            # 用户消息写入 WAL 后由后台批量入库，不在响应路径上等待数据库
+            await store.add(final_subjectid, "user", text)
         except Exception as db_err:
             # 不中断流式对话，记录错误并继续
             print(f"用户消息入库失败: {db_err}")
             # 如果数据库操作失败，使用默认subjectid
             if final_subjectid == 0:
                 final_subjectid = 1  # 使用默认主题ID
-
-        # 流式返回 AI 回复（llm_stream 内部会保存 AI 回复）
-        return StreamingResponse(
-            llm_stream(text, final_subjectid),
-            media_type="text/plain"
+            new_subject = False
+
+        # 新主题：在后台生成标题，不阻塞首字返回（前端在流结束后刷新主题列表获取）
+        if new_subject:
+            spawn_background_task(_generate_and_save_title(final_subjectid, text))
+
+        # 流式返回 AI 回复（async_llm_stream 内部定期保存检查点并在结束时保存 AI 回复）
+        stream_id = uuid4().hex
+        return CancellableStreamingResponse(
+            async_llm_stream(text, final_subjectid, stream_id=stream_id),
+            media_type="text/plain",
+            headers={"X-Stream-Id": stream_id}
         )
 
     except Exception as e:
@@ -192,23 +245,78 @@ def stream(request: dict):
         raise HTTPException(status_code=500, detail=f"流式对话失败: {e}")
 
 
+# 断线续传：返回流从 offset（已收到的字符数）开始的内容，仍在生成时继续跟随
+@router.get("/stream/resume")
+async def resume_stream(stream_id: str, offset: int = Query(0, ge=0)):
+    from reply_stream import find_stream, resume_stream as resume_reply
+
+    if not await find_stream(stream_id):
+        raise HTTPException(status_code=404, detail="流不存在或尚未保存检查点")
+    return CancellableStreamingResponse(
+        resume_reply(stream_id, offset),
+        media_type="text/plain",
+        headers={"X-Stream-Id": stream_id}
+    )
+
+
 # 获取主题
 @router.get("/get_subject")
-def get_subject():
+def get_subject(
+    before_id: Optional[int] = None,
+    after_id: Optional[int] = None,
+    limit: int = Query(SUBJECT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+):
+    """
+    获取主题列表（按创建时间倒序，键集分页）
+
+    Args:
+        before_id: 返回排在该主题之后（更早创建）的主题，用于加载下一页
+        after_id: 返回排在该主题之前（更晚创建）的主题，用于拉取新主题
+        limit: 每页条数；返回条数等于 limit 时可能还有更多
+    """
+    if before_id is not None and after_id is not None:
+        raise HTTPException(status_code=400, detail="before_id 和 after_id 不能同时使用")
     try:
         with get_db_connection() as conn:
             with conn.cursor() as cursor:
-                sql = "SELECT id, title, created_at FROM subject ORDER BY created_at DESC"
-                cursor.execute(sql)
-                return cursor.fetchall()
+                # 游标按 (created_at, id) 比较，命中 idx_subject_created_id 索引
+                cursor_id = before_id if before_id is not None else after_id
+                where, params = "", []
+                if cursor_id is not None:
+                    cursor.execute("SELECT created_at FROM subject WHERE id = %s", (cursor_id,))
+                    row = cursor.fetchone()
+                    if row is None:
+                        raise HTTPException(status_code=404, detail="主题不存在")
+                    op = "<" if before_id is not None else ">"
+                    where = f"WHERE created_at {op} %s OR (created_at = %s AND id {op} %s)"
+                    params = [row["created_at"], row["created_at"], cursor_id]
+                order = "ASC" if after_id is not None else "DESC"
+                sql = (f"SELECT id, title, created_at FROM subject {where} "
+                       f"ORDER BY created_at {order}, id {order} LIMIT %s")
+                cursor.execute(sql, (*params, limit))
+                rows = cursor.fetchall()
+                if after_id is not None:
+                    rows = list(reversed(rows))
+                return rows
+    except HTTPException:
+        raise
     except Exception as e:
         # 回退逻辑：兼容历史表结构缺少 created_at 的情况
         print(f"获取主题失败（将启用回退查询）：{e}")
         try:
             with get_db_connection() as conn:
                 with conn.cursor() as cursor:
-                    cursor.execute("SELECT id, title FROM subject ORDER BY id DESC")
+                    where, params = "", []
+                    if before_id is not None:
+                        where, params = "WHERE id < %s", [before_id]
+                    elif after_id is not None:
+                        where, params = "WHERE id > %s", [after_id]
+                    order = "ASC" if after_id is not None else "DESC"
+                    cursor.execute(f"SELECT id, title FROM subject {where} ORDER BY id {order} LIMIT %s",
+                                   (*params, limit))
                     rows = cursor.fetchall()
+                    if after_id is not None:
+                        rows = list(reversed(rows))
                     # 补齐 created_at 字段，避免前端取值报错
                     for r in rows:
                         if "created_at" not in r:
@@ -220,30 +328,67 @@ def get_subject():
 
 # 获取主题下的聊天记录
 @router.get("/get_chatcontent_at_subjectid")
-def get_chatcontent_at_subjectid(subjectid: int):
+async def get_chatcontent_at_subjectid(
+    subjectid: int,
+    before_id: Optional[int] = None,
+    after_id: Optional[int] = None,
+    limit: int = Query(CHAT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+):
+    """
+    获取主题下的聊天记录（按时间正序返回，键集分页）
+
+    不带游标时返回最新的 limit 条消息。
+
+    Args:
+        before_id: 返回该消息之前的更早消息，用于向上翻页
+        after_id: 返回该消息之后的新消息
+        limit: 每页条数；返回条数等于 limit 时可能还有更多
+    """
+    if before_id is not None and after_id is not None:
+        raise HTTPException(status_code=400, detail="before_id 和 after_id 不能同时使用")
     try:
-        with get_db_connection() as conn:
-            with conn.cursor() as cursor:
-                # 使用参数化查询防止注入
-                sql = "SELECT * FROM chatcontent WHERE subjectid = %s ORDER BY id LIMIT 20"
-                cursor.execute(sql, (subjectid,))
-                return cursor.fetchall()
+        # 先写入该主题尚在队列中的消息，保证读到完整记录
+        await get_message_store().sync_subject(subjectid)
+        # 未执行迁移 002 的数据库没有 status 列，统一返回 complete
+        columns = "id, role, content, created_at, " + (
+            "status" if await has_columns("002_stream_checkpoints.sql") else "'complete' AS status")
+        async with get_async_db_connection() as conn:
+            async with conn.cursor() as cursor:
+                # 使用参数化查询防止注入；(subjectid, id) 索引支持范围扫描和排序
+                if after_id is not None:
+                    sql = ("SELECT " + columns + " FROM chatcontent "
+                           "WHERE subjectid = %s AND id > %s ORDER BY id ASC LIMIT %s")
+                    await cursor.execute(sql, (subjectid, after_id, limit))
+                    return await cursor.fetchall()
+                if before_id is not None:
+                    sql = ("SELECT " + columns + " FROM chatcontent "
+                           "WHERE subjectid = %s AND id < %s ORDER BY id DESC LIMIT %s")
+                    await cursor.execute(sql, (subjectid, before_id, limit))
+                else:
+                    sql = ("SELECT " + columns + " FROM chatcontent "
+                           "WHERE subjectid = %s ORDER BY id DESC LIMIT %s")
+                    await cursor.execute(sql, (subjectid, limit))
+                return list(reversed(await cursor.fetchall()))
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"获取聊天记录失败: {e}")
 
 
 # 删除主题（兼容未启用 ON DELETE CASCADE 的环境）
 @router.delete("/subject/{subject_id}")
-def delete_subject(subject_id: int):
+async def delete_subject(subject_id: int):
     try:
-        with get_db_connection() as conn:
-            with conn.cursor() as cursor:
+        # 丢弃该主题尚未入库的消息
+        get_message_store().forget_subject(subject_id)
+        async with get_async_db_connection() as conn:
+            async with conn.cursor() as cursor:
                 # 先删除子表，避免 1451 外键约束错误
-                cursor.execute("DELETE FROM chatcontent WHERE subjectid = %s", (subject_id,))
+                await cursor.execute("DELETE FROM chatcontent WHERE subjectid = %s", (subject_id,))
                 # 再删除父表
-                cursor.execute("DELETE FROM subject WHERE id = %s", (subject_id,))
-                conn.commit()
-                return {"ok": True}
+                await cursor.execute("DELETE FROM subject WHERE id = %s", (subject_id,))
+                await conn.commit()
+        from conversation_memory import forget_subject
+        forget_subject(subject_id)
+        return {"ok": True}
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"删除主题失败: {e}")
 
@@ -257,6 +402,45 @@ def rag_status():
     except Exception as e:
         return {"error": f"获取 RAG 状态失败: {e}"}
 
+# LLM HTTP 连接池状态接口
+@router.get("/llm_status")
+def llm_status():
+    """获取 LLM HTTP 客户端连接池命中情况和对话记忆状态"""
+    try:
+        from conversation_memory import get_memory_stats
+        from token_budget import get_budget_info
+        stats = get_http_client_stats()
+        stats["memory"] = get_memory_stats()
+        stats["token_budget"] = get_budget_info()
+        stats["semantic_cache"] = get_answer_cache_stats()
+        stats["generation"] = get_generation_stats()
+        stats["message_store"] = get_message_store().stats()
+        from reply_stream import get_stream_stats
+        stats["streams"] = get_stream_stats()
+        return stats
+    except Exception as e:
+        return {"error": f"获取 LLM 连接池状态失败: {e}"}
+
+# 存活/就绪探针
+@router.get("/healthz")
+def healthz():
+    """存活探针：进程能响应即返回 200"""
+    return {"status": "ok"}
+
+@router.get("/readyz")
+def readyz():
+    """
+    就绪探针：RAG 首次预热完成前返回 503
+
+    预热失败时服务以基础 LLM 功能降级运行，返回 200 并标记 degraded，
+    后台按退避时间重试初始化。
+    """
+    readiness = get_rag_readiness()
+    if readiness["state"] == "warming" and readiness["attempts"] <= 1:
+        return JSONResponse(status_code=503, content={"status": "starting", "rag": readiness})
+    status = "ready" if readiness["ready"] else "degraded"
+    return {"status": status, "rag": readiness}
+
 # 向量数据库管理接口
 @router.get("/vector_db_info")
 def vector_db_info():
@@ -269,122 +453,105 @@ def vector_db_info():
     except Exception as e:
         return {"error": f"获取向量数据库信息失败: {e}"}
 
+# 维护任务 SSE 进度推送间隔（秒）
+JOB_EVENT_INTERVAL = float(os.getenv("JOB_EVENT_INTERVAL", 1))
+
+def _submit_maintenance_job(kind: str):
+    """提交维护任务；已有任务在运行时合并到该任务"""
+    from rag_service import get_rag_service
+    from maintenance_jobs import get_job_manager
+    service = get_rag_service()
+    func = service.rebuild_vector_db if kind == "rebuild" else service.refresh_vector_db
+    job, merged = get_job_manager().submit(kind, func)
+    if merged:
+        message = f"已有维护任务（{job.kind}）正在运行，已合并到该任务"
+    else:
+        message = "维护任务已在后台开始"
+    return {
+        "message": message,
+        "success": True,
+        "job_id": job.id,
+        "kind": job.kind,
+        "status": job.status,
+        "merged": merged,
+    }
+
 # 重建向量数据库接口
 @router.post("/rebuild_vector_db")
 def rebuild_vector_db():
-    """重建向量数据库"""
+    """
+    重建向量数据库（后台任务）
+
+    立即返回任务ID；重建期间旧索引继续提供检索，完成后热切换。
+    通过 /jobs/{job_id} 或 /jobs/{job_id}/events 查询进度。
+    """
     try:
-        from rag_service import get_rag_service
-        service = get_rag_service()
-        success = service.rebuild_vector_db()
-        if success:
-            return {"message": "向量数据库重建成功", "success": True}
-        else:
-            return {"message": "向量数据库重建失败", "success": False}
+        return _submit_maintenance_job("rebuild")
     except Exception as e:
         return {"error": f"重建向量数据库失败: {e}", "success": False}
 
 # 智能刷新向量数据库接口
 @router.post("/refresh_vector_db")
 def refresh_vector_db():
-    """智能刷新向量数据库（优化版）"""
+    """
+    智能刷新向量数据库（后台任务）
+
+    健康时增量更新，失败时重新加载，再失败则完全重建；结果见任务的 result 字段。
+    """
     try:
-        from rag_service import get_rag_service
-        import time
-        
-        start_time = time.time()
-        service = get_rag_service()
-        
-        print("=" * 50)
-        print("开始智能刷新向量数据库...")
-        print("=" * 50)
-        
-        # 1. 检查当前状态
-        print("检查向量数据库健康状态...")
-        health_status = service.check_vector_db_health()
-        
-        if health_status["healthy"]:
-            # 如果数据库健康，尝试增量更新新文件
-            print("向量数据库健康，尝试增量更新新文件...")
-            success = service.update_vector_db_with_new_files()
-            if success:
-                elapsed = time.time() - start_time
-                print(f"增量更新完成，耗时: {elapsed:.2f}秒")
-                return {
-                    "message": "向量数据库已更新新文件",
-                    "success": True,
-                    "action": "update",
-                    "elapsed_time": round(elapsed, 2)
-                }
-            else:
-                print("增量更新失败，尝试重新加载...")
-                # 增量更新失败，尝试重新加载
-                if service.load_vector_store():
-                    elapsed = time.time() - start_time
-                    print(f"重新加载完成，耗时: {elapsed:.2f}秒")
-                    return {
-                        "message": "向量数据库状态良好，已重新加载",
-                        "success": True,
-                        "action": "reload",
-                        "elapsed_time": round(elapsed, 2)
-                    }
-                else:
-                    print("重新加载失败，开始完全重建...")
-                    # 加载失败，需要重建
-                    success = service.rebuild_vector_db()
-                    elapsed = time.time() - start_time
-                    if success:
-                        print(f"完全重建完成，耗时: {elapsed:.2f}秒")
-                        return {
-                            "message": "向量数据库加载失败，已重建",
-                            "success": True,
-                            "action": "rebuild",
-                            "elapsed_time": round(elapsed, 2)
-                        }
-                    else:
-                        print(f"完全重建失败，耗时: {elapsed:.2f}秒")
-                        return {
-                            "message": "向量数据库重建失败",
-                            "success": False,
-                            "action": "rebuild_failed",
-                            "elapsed_time": round(elapsed, 2)
-                        }
-        else:
-            # 数据库不健康，需要重建
-            print("向量数据库不健康，开始重建...")
-            for issue in health_status["issues"]:
-                print(f"问题: {issue}")
-            
-            success = service.rebuild_vector_db()
-            elapsed = time.time() - start_time
-            if success:
-                print(f"重建完成，耗时: {elapsed:.2f}秒")
-                return {
-                    "message": "向量数据库已重建",
-                    "success": True,
-                    "action": "rebuild",
-                    "issues": health_status["issues"],
-                    "elapsed_time": round(elapsed, 2)
-                }
-            else:
-                print(f"重建失败，耗时: {elapsed:.2f}秒")
-                return {
-                    "message": "向量数据库重建失败",
-                    "success": False,
-                    "action": "rebuild_failed",
-                    "issues": health_status["issues"],
-                    "elapsed_time": round(elapsed, 2)
-                }
-                
+        return _submit_maintenance_job("refresh")
     except Exception as e:
-        import traceback
-        print(f"刷新向量数据库异常: {e}")
-        print(f"详细错误: {traceback.format_exc()}")
-        return {
-            "error": f"刷新向量数据库失败: {e}",
-            "success": False,
-            "action": "error"
-        }
+        return {"error": f"刷新向量数据库失败: {e}", "success": False, "action": "error"}
+
+# 后台任务查询接口
+@router.get("/jobs")
+def list_jobs():
+    """列出最近的后台维护任务"""
+    from maintenance_jobs import get_job_manager
+    return {"jobs": get_job_manager().list()}
+
+@router.get("/jobs/{job_id}")
+def get_job(job_id: str):
+    """查询后台维护任务状态和进度"""
+    from maintenance_jobs import get_job_manager
+    job = get_job_manager().get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="任务不存在")
+    return job.to_dict()
+
+@router.post("/jobs/{job_id}/cancel")
+def cancel_job(job_id: str):
+    """取消后台维护任务，已发布的新索引不会回滚"""
+    from maintenance_jobs import get_job_manager
+    job = get_job_manager().cancel(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="任务不存在")
+    return job.to_dict()
+
+@router.get("/jobs/{job_id}/events")
+async def job_events(job_id: str):
+    """以 SSE 推送任务进度，任务结束后关闭连接"""
+    from maintenance_jobs import get_job_manager
+    manager = get_job_manager()
+    # 任务可能在其他 worker 中运行，状态从共享的状态文件读取（文件读写不放在事件循环线程）
+    job = await asyncio.to_thread(manager.get, job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="任务不存在")
+
+    async def event_stream():
+        current, last = job, None
+        while True:
+            current = await asyncio.to_thread(manager.get, job_id) or current
+            data = json.dumps(current.to_dict(), ensure_ascii=False)
+            payload = (current.status, current.progress)
+            if payload != last:
+                yield f"data: {data}\n\n"
+                last = payload
+            if current.finished:
+                break
+            await asyncio.sleep(JOB_EVENT_INTERVAL)
+
+    return StreamingResponse(event_stream(), media_type="text/event-stream")
 
 # 查看文件处理状态接口
 @router.get("/file_processing_status")
@@ -394,29 +561,23 @@ def file_processing_status():
         from rag_service import get_rag_service
         service = get_rag_service()
         
-        # 获取当前知识库中的所有文件
-        current_files = set()
-        for root, dirs, files in os.walk(service.knowledge_base_path):
-            for file in files:
-                if any(file.endswith(ext) for ext in ['.txt', '.md', '.pdf']):
-                    file_path = os.path.join(root, file)
-                    current_files.add(file_path)
-        
-        # 获取已处理的文件列表
+        # 对比知识库与索引清单（大小/修改时间/内容哈希）
+        diff = service.diff_knowledge_base()
         processed_files = service.get_processed_files_list()
-        
-        # 找出新文件和已删除文件
-        new_files = current_files - processed_files
-        deleted_files = processed_files - current_files
+        new_files = list(diff["added"].values())
+        changed_files = list(diff["changed"].values())
+        deleted_files = list(diff["removed"].keys())
         
         return {
-            "total_files": len(current_files),
+            "total_files": len(diff["current"]),
             "processed_files": len(processed_files),
             "new_files": len(new_files),
+            "changed_files": len(changed_files),
             "deleted_files": len(deleted_files),
-            "new_file_list": list(new_files),
-            "deleted_file_list": list(deleted_files),
-            "needs_update": len(new_files) > 0 or len(deleted_files) > 0
+            "new_file_list": new_files,
+            "changed_file_list": changed_files,
+            "deleted_file_list": deleted_files,
+            "needs_update": len(new_files) > 0 or len(changed_files) > 0 or len(deleted_files) > 0
         }
     except Exception as e:
         return {"error": f"获取文件处理状态失败: {e}"}
@@ -1,124 +1,477 @@
 # -*- coding: utf-8 -*-
 """
-简化版 RAG 服务
-当复杂模型加载失败时使用
+简化版 RAG 服务：BM25 词法检索
+当嵌入模型加载失败时使用，不依赖 torch / FAISS
+
+- 文本提取：PDF 用 pypdf 逐页提取，txt/md 按 UTF-8 读取
+- 分块：安装了 langchain 时与向量索引使用同一分割器和块ID（检索结果可与向量检索对应），
+  否则使用相同参数的内置分割
+- 分词：中日韩字符按二元组（单字词保留单字），英文/数字按词；LEXICAL_TOKENIZER=jieba 时使用结巴分词
+- 倒排索引 + BM25 打分，保存到 vector_db/lexical/bm25.pkl；启动时直接加载（毫秒级），
+  知识库文件的大小或修改时间变化时重建
+
+BM25Index 同时用于向量索引旁的关键词索引（rag_service 混合检索，见 index_store.LEXICAL_FILE）。
 """
 import os
 import re
-from typing import List
+import math
+import time
+import heapq
+import pickle
+import threading
+import unicodedata
+from array import array
+from collections import Counter
+from typing import Dict, List
+
+# BM25 参数
+BM25_K1 = float(os.getenv("BM25_K1", 1.5))
+BM25_B = float(os.getenv("BM25_B", 0.75))
+# 分词方式：bigram（中日韩二元组，无额外依赖）/ jieba（需安装 jieba）
+LEXICAL_TOKENIZER = os.getenv("LEXICAL_TOKENIZER", "bigram").lower()
+# 嵌入模型加载失败时自动启用词法检索
+LEXICAL_FALLBACK = os.getenv("LEXICAL_FALLBACK", "true").lower() in ("1", "true", "yes")
+
+# 索引文件格式版本
+LEXICAL_INDEX_VERSION = 1
+LEXICAL_INDEX_FILE = "bm25.pkl"
+
+# 与向量索引相同的分块参数
+CHUNK_SIZE = 500
+CHUNK_OVERLAP = 50
+_SEPARATORS = ["\n\n", "\n", "。", "！", "？", "；", " ", ""]
+
+_CJK = r"\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff\u3040-\u30ff\uac00-\ud7af"  # 中日韩统一表意文字、假名、谚文
+_TOKEN_RE = re.compile(rf"[{_CJK}]+|[a-z0-9]+(?:[._-][a-z0-9]+)*")
+_CJK_RE = re.compile(rf"[{_CJK}]")
+
+_jieba = None
+
+
+def _get_jieba():
+    """按需导入结巴分词，不可用时返回 None（退回二元组）"""
+    global _jieba
+    if _jieba is None:
+        try:
+            import jieba
+            jieba.setLogLevel(60)
+            _jieba = jieba
+        except ImportError:
+            print("未安装 jieba，词法检索使用二元组分词")
+            _jieba = False
+    return _jieba or None
+
+
+def tokenizer_name() -> str:
+    return "jieba" if LEXICAL_TOKENIZER == "jieba" and _get_jieba() else "bigram"
+
+
+def tokenize(text: str) -> List[str]:
+    """检索分词：全角/半角统一、转小写后，中日韩文本切成二元组（或结巴分词），其余按词"""
+    text = unicodedata.normalize("NFKC", text or "").lower()
+    tokens = []
+    jieba = _get_jieba() if LEXICAL_TOKENIZER == "jieba" else None
+    for run in _TOKEN_RE.findall(text):
+        if not _CJK_RE.match(run):
+            tokens.append(run)
+        elif jieba is not None:
+            tokens.extend(word for word in jieba.lcut_for_search(run) if word.strip())
+        elif len(run) == 1:
+            tokens.append(run)
+        else:
+            tokens.extend(run[i:i + 2] for i in range(len(run) - 1))
+    return tokens
+
+
+def _split_text(text: str, separators: List[str] = _SEPARATORS) -> List[str]:
+    """内置的递归字符分割（参数与向量索引的 RecursiveCharacterTextSplitter 相同）"""
+    if len(text) <= CHUNK_SIZE:
+        return [text] if text.strip() else []
+    separator = next((sep for sep in separators if sep == "" or sep in text), "")
+    rest = separators[separators.index(separator) + 1:] if separator else []
+    pieces = text.split(separator) if separator else list(text)
+
+    chunks, current, length = [], [], 0
+    for piece in pieces:
+        if len(piece) > CHUNK_SIZE:
+            if current:
+                chunks.append(separator.join(current))
+                current, length = [], 0
+            chunks.extend(_split_text(piece, rest) if rest else [piece[i:i + CHUNK_SIZE]
+                                                                 for i in range(0, len(piece), CHUNK_SIZE)])
+            continue
+        added = len(piece) + (len(separator) if current else 0)
+        if length + added > CHUNK_SIZE and current:
+            chunks.append(separator.join(current))
+            # 保留末尾不超过 CHUNK_OVERLAP 的片段作为重叠
+            while current and length > CHUNK_OVERLAP:
+                length -= len(current.pop(0)) + (len(separator) if current else 0)
+            added = len(piece) + (len(separator) if current else 0)
+        current.append(piece)
+        length += added
+    if current:
+        chunks.append(separator.join(current))
+    return [chunk.strip() for chunk in chunks if chunk.strip()]
+
+
+def _extract_pages(file_path: str) -> List[str]:
+    """提取文件文本：PDF 逐页提取，其余按 UTF-8 文本读取"""
+    if file_path.endswith('.pdf'):
+        from pypdf import PdfReader
+        return [page.extract_text() or "" for page in PdfReader(file_path).pages]
+    with open(file_path, 'r', encoding='utf-8', errors='ignore') as f:
+        return [f.read()]
+
+
+def _langchain_available() -> bool:
+    try:
+        import langchain.text_splitter  # noqa: F401
+        import langchain_community.document_loaders  # noqa: F401
+        return True
+    except ImportError:
+        return False
+
+
+def _extract_chunks(file_path: str, use_langchain: bool):
+    """加载并分割单个文件，返回 (文件路径, [文本块], 错误)；在进程池中执行，必须是模块级函数"""
+    if use_langchain:
+        from rag_service import _load_and_split_file
+        file_path, docs, error = _load_and_split_file(file_path)
+        return file_path, [doc.page_content for doc in docs], error
+    try:
+        chunks = []
+        for page in _extract_pages(file_path):
+            chunks.extend(_split_text(page))
+        return file_path, chunks, None
+    except Exception as e:
+        return file_path, [], str(e)
+
+
+class BM25Index:
+    """
+    BM25 倒排索引
+
+    倒排表按词连续存放在 array 中：terms[词] = (起始位置, 文档频率)，
+    doc_ids / tfs 为对应的文本块序号和词频。可以不保存原文（与向量索引放在一起时，
+    原文从向量库的文本块存储读取）。
+    """
+
+    def __init__(self, data: dict):
+        self.data = data
+        avgdl = data["avgdl"] or 1.0
+        # 预计算每个文本块的长度归一化项
+        self.norm = array('f', (BM25_K1 * (1 - BM25_B + BM25_B * length / avgdl) for length in data["doc_len"]))
+
+    @classmethod
+    def build(cls, documents: List[tuple], keep_texts: bool = True, **extra) -> "BM25Index":
+        """
+        Args:
+            documents: [(块ID, 文本)]
+            keep_texts: 是否在索引中保存原文
+            extra: 额外写入索引的信息（如文件指纹）
+        """
+        postings = {}
+        doc_len = array('I')
+        for doc_id, (_, text) in enumerate(documents):
+            counts = Counter(tokenize(text))
+            doc_len.append(sum(counts.values()))
+            for term, tf in counts.items():
+                postings.setdefault(term, []).append((doc_id, min(tf, 65535)))
+
+        terms = {}
+        doc_ids, tfs = array('I'), array('H')
+        for term, entries in postings.items():
+            terms[term] = (len(doc_ids), len(entries))
+            for doc_id, tf in entries:
+                doc_ids.append(doc_id)
+                tfs.append(tf)
+
+        return cls({
+            "version": LEXICAL_INDEX_VERSION,
+            "tokenizer": tokenizer_name(),
+            "built_at": time.time(),
+            "chunk_ids": [chunk_id for chunk_id, _ in documents],
+            "texts": [text for _, text in documents] if keep_texts else None,
+            "doc_len": doc_len,
+            "avgdl": sum(doc_len) / len(doc_len) if doc_len else 0.0,
+            "terms": terms,
+            "doc_ids": doc_ids,
+            "tfs": tfs,
+            **extra,
+        })
+
+    @classmethod
+    def load(cls, path: str):
+        """从文件加载；文件不存在、格式或分词方式不一致时返回 None"""
+        try:
+            with open(path, 'rb') as f:
+                data = pickle.load(f)
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            print(f"读取 BM25 索引失败 {path}: {e}")
+            return None
+        if data.get("version") != LEXICAL_INDEX_VERSION or data.get("tokenizer") != tokenizer_name():
+            print(f"BM25 索引格式或分词方式已变化: {path}")
+            return None
+        return cls(data)
+
+    def save(self, path: str):
+        """原子写入文件"""
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.tmp-{os.getpid()}"
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(self.data, f, protocol=pickle.HIGHEST_PROTOCOL)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+
+    @property
+    def chunk_ids(self) -> List[str]:
+        return self.data["chunk_ids"]
+
+    def __len__(self):
+        return len(self.data["chunk_ids"])
+
+    def text(self, doc_id: int):
+        texts = self.data["texts"]
+        return texts[doc_id] if texts is not None else None
+
+    def search(self, query: str, k: int = 3) -> List[tuple]:
+        """BM25 检索，返回 [(文本块序号, 得分)]，按得分从高到低"""
+        terms, doc_ids, tfs, norm = self.data["terms"], self.data["doc_ids"], self.data["tfs"], self.norm
+        total = len(self)
+        scores = {}
+        for term in set(tokenize(query)):
+            posting = terms.get(term)
+            if posting is None:
+                continue
+            offset, df = posting
+            idf = math.log(1 + (total - df + 0.5) / (df + 0.5))
+            for i in range(offset, offset + df):
+                doc_id, tf = doc_ids[i], tfs[i]
+                scores[doc_id] = scores.get(doc_id, 0.0) + idf * tf * (BM25_K1 + 1) / (tf + norm[doc_id])
+        return heapq.nlargest(k, scores.items(), key=lambda item: item[1])
+
+    def get_stats(self) -> dict:
+        return {
+            "tokenizer": self.data["tokenizer"],
+            "chunks": len(self),
+            "terms": len(self.data["terms"]),
+        }
+
 
 class SimpleRAGService:
-    """简化版 RAG 服务"""
-    
+    """简化版 RAG 服务：持久化的 BM25 倒排索引"""
+
     def __init__(self, knowledge_base_path: str = None):
         self.knowledge_base_path = knowledge_base_path or os.path.join(os.path.dirname(__file__), "..", "datasets", "data")
-        self.documents = []
+        self.index_path = os.path.join(os.path.dirname(__file__), "vector_db", "lexical", LEXICAL_INDEX_FILE)
+        # 当前索引（整体替换，检索方一次性读取）
+        self._index = None
         self.initialized = False
-        
-    def load_documents(self):
-        """加载文档内容"""
-        try:
-            documents = []
+        self.load_ms = None
+        self.build_seconds = None
+        self._init_lock = threading.Lock()
+        self._searches = 0
+        self._search_seconds = 0.0
+
+    @property
+    def documents(self) -> list:
+        """已索引的文本块 ID 列表（兼容旧接口的可用性判断）"""
+        return self._index.chunk_ids if self._index else []
+
+    def _scan_files(self) -> Dict[str, str]:
+        """扫描知识库，返回 {相对路径: 绝对路径}（与向量索引清单的键一致）"""
+        from rag_service import SUPPORTED_EXTENSIONS
+
+        files = {}
+        for root, dirs, names in os.walk(self.knowledge_base_path):
+            for name in names:
+                if any(name.endswith(ext) for ext in SUPPORTED_EXTENSIONS):
+                    file_path = os.path.join(root, name)
+                    file_key = os.path.relpath(file_path, self.knowledge_base_path).replace(os.sep, "/")
+                    files[file_key] = file_path
+        return files
+
+    @staticmethod
+    def _fingerprints(files: Dict[str, str]) -> dict:
+        result = {}
+        for file_key, file_path in files.items():
+            try:
+                stat = os.stat(file_path)
+                result[file_key] = (stat.st_size, stat.st_mtime)
+            except OSError:
+                continue
+        return result
+
+    def load_documents(self, files: Dict[str, str] = None):
+        """
+        加载并分割知识库文档
+
+        Returns:
+            [(块ID, 文本)]，按文件相对路径排序，块ID与向量索引一致
+        """
+        from rag_service import RAGService, RAG_LOAD_WORKERS
+
+        if files is None:
             if not os.path.exists(self.knowledge_base_path):
                 print(f"知识库目录不存在: {self.knowledge_base_path}")
                 return []
-                
-            for root, dirs, files in os.walk(self.knowledge_base_path):
-                for file in files:
-                    if file.endswith('.pdf'):
-                        file_path = os.path.join(root, file)
-                        try:
-                            # 简单的文本提取（这里只是示例，实际需要 PDF 解析）
-                            with open(file_path, 'rb') as f:
-                                content = f.read()
-                                # 简单的文本提取，实际项目中应该使用 PyPDF 等库
-                                text_content = content.decode('utf-8', errors='ignore')
-                                documents.append({
-                                    'file': file,
-                                    'content': text_content[:1000]  # 限制长度
-                                })
-                                print(f"已加载: {file}")
-                        except Exception as e:
-                            print(f"加载文件失败 {file}: {e}")
-                            
-            return documents
-        except Exception as e:
-            print(f"文档加载失败: {e}")
-            return []
-    
-    def initialize(self):
-        """初始化简化 RAG 服务"""
+            files = self._scan_files()
+        keys = sorted(files)
+        use_langchain = _langchain_available()
+        results = {}
+        workers = min(RAG_LOAD_WORKERS, len(keys))
+        if workers > 1:
+            try:
+                from concurrent.futures import ProcessPoolExecutor
+                with ProcessPoolExecutor(max_workers=workers) as executor:
+                    for file_path, chunks, error in executor.map(
+                            _extract_chunks, [files[key] for key in keys], [use_langchain] * len(keys)):
+                        results[file_path] = (chunks, error)
+            except Exception as e:
+                print(f"并行加载失败，改为顺序加载: {e}")
+                results = {}
+
+        documents = []
+        for file_key in keys:
+            file_path = files[file_key]
+            chunks, error = results.get(file_path) or _extract_chunks(file_path, use_langchain)[1:]
+            if error:
+                print(f"加载文件失败 {file_path}: {error}")
+                continue
+            documents.extend((RAGService._chunk_id(file_key, n), text) for n, text in enumerate(chunks))
+        return documents
+
+    def build_index(self) -> bool:
+        """从知识库构建 BM25 索引并原子写入磁盘"""
+        start = time.time()
+        files = self._scan_files() if os.path.exists(self.knowledge_base_path) else {}
+        fingerprints = self._fingerprints(files)
+        documents = self.load_documents(files)
+        if not documents:
+            print("未找到文档，简化 RAG 服务不可用")
+            return False
+
+        index = BM25Index.build(documents, files=fingerprints)
         try:
-            print("正在初始化简化 RAG 服务...")
-            self.documents = self.load_documents()
-            if self.documents:
-                self.initialized = True
-                print(f"简化 RAG 服务初始化完成，加载了 {len(self.documents)} 个文档")
+            index.save(self.index_path)
+        except OSError as e:
+            print(f"保存 BM25 索引失败（仅在内存中使用）: {e}")
+
+        self._activate(index)
+        self.build_seconds = round(time.time() - start, 2)
+        print(f"BM25 索引构建完成：{len(index)} 个文本块，{index.get_stats()['terms']} 个词项，"
+              f"耗时 {self.build_seconds} 秒")
+        return True
+
+    def load_index(self) -> bool:
+        """从磁盘加载索引；格式、分词方式或知识库文件变化时返回 False"""
+        start = time.perf_counter()
+        index = BM25Index.load(self.index_path)
+        if index is None:
+            return False
+        if index.data.get("files") != self._fingerprints(self._scan_files()):
+            print("知识库文件已变化，BM25 索引需要重建")
+            return False
+        self._activate(index)
+        self.load_ms = round((time.perf_counter() - start) * 1000, 1)
+        print(f"BM25 索引加载完成：{len(index)} 个文本块，耗时 {self.load_ms} ms")
+        return True
+
+    def _activate(self, index: BM25Index):
+        self._index = index
+        self.initialized = True
+
+    def initialize(self):
+        """初始化简化 RAG 服务：优先加载磁盘上的索引，没有或已过期时重建"""
+        with self._init_lock:
+            if self.initialized:
                 return True
-            else:
-                print("未找到文档，简化 RAG 服务不可用")
+            try:
+                print("正在初始化简化 RAG 服务（BM25）...")
+                if self.load_index() or self.build_index():
+                    print(f"简化 RAG 服务初始化完成，共 {len(self.documents)} 个文本块")
+                    return True
                 return False
-        except Exception as e:
-            print(f"简化 RAG 服务初始化失败: {e}")
-            return False
-    
+            except Exception as e:
+                print(f"简化 RAG 服务初始化失败: {e}")
+                return False
+
     def search_documents(self, query: str, k: int = 3):
-        """简单的文档搜索"""
-        if not self.initialized:
+        """
+        BM25 检索
+
+        Returns:
+            [{"chunk_id", "content", "score"}]，按得分从高到低
+        """
+        index = self._index
+        if index is None:
             return []
-            
-        results = []
-        query_lower = query.lower()
-        
-        for doc in self.documents:
-            content_lower = doc['content'].lower()
-            # 简单的关键词匹配
-            if any(word in content_lower for word in query_lower.split()):
-                results.append(doc)
-                
-        return results[:k]
-    
-    def enhance_query(self, user_query: str) -> str:
-        """增强用户查询"""
-        if not self.initialized:
-            return f"""用户问题：{user_query}
 
-请基于您的知识回答用户的问题。"""
-            
+        start = time.perf_counter()
+        top = index.search(query, k)
+        self._searches += 1
+        self._search_seconds += time.perf_counter() - start
+        return [{"chunk_id": index.chunk_ids[doc_id], "content": index.text(doc_id), "score": score}
+                for doc_id, score in top]
+
+    def prepare_query(self, user_query: str, max_tokens: int = None) -> dict:
+        """检索并组装增强查询，返回格式与 RAGService.prepare_query 相同（没有查询向量）"""
+        from rag_service import _basic_query, fit_chunks
+        from prompt_builder import rag_user_message
+        from token_budget import count_tokens
+
+        index = self._index
+        result = {"text": _basic_query(user_query), "embedding": None, "chunk_ids": (),
+                  "index_version": f"bm25-{index.data['built_at']}" if index else None}
+        if index is None:
+            return result
+
         try:
             relevant_docs = self.search_documents(user_query)
             if not relevant_docs:
                 print("简化RAG未找到相关文档，将基于通用知识回答")
-                return f"""用户问题：{user_query}
-
-注意：在简化知识库中未找到相关信息，请基于您的通用知识回答用户的问题。"""
-                
-            context = "\n\n".join([doc['content'] for doc in relevant_docs])
-            enhanced_query = f"""请回答用户的问题。在回答时，请按以下优先级：
+                result["text"] = f"""用户问题：{user_query}
 
-1. 首先参考以下简化知识库信息（如果相关）：
-{context}
+注意：在专业知识库中未找到相关信息，请基于您的通用知识回答用户的问题。"""
+                return result
 
-2. 结合您的通用知识库进行补充和扩展
-3. 如果知识库信息不足或不够准确，请优先使用您的通用知识
-4. 确保回答准确、详细、有用
+            chunks = [(doc["chunk_id"], doc["content"]) for doc in relevant_docs]
+            if max_tokens is not None:
+                chunks = fit_chunks(chunks, max_tokens - count_tokens(rag_user_message([], user_query)))
+                if not chunks:
+                    return result
 
-用户问题：{user_query}
+            result["text"] = rag_user_message(chunks, user_query)
+            result["chunk_ids"] = tuple(sorted(chunk_id for chunk_id, _ in chunks))
+            print(f"简化 RAG 增强成功，检索到 {len(chunks)} 个相关文本块")
+            return result
 
-请基于以上信息给出完整的回答。"""
-            
-            print(f"简化 RAG 增强成功，检索到 {len(relevant_docs)} 个相关文档")
-            return enhanced_query
-            
         except Exception as e:
             print(f"简化 RAG 增强失败: {e}")
-            return f"""用户问题：{user_query}
+            return dict(result, text=_basic_query(user_query))
+
+    def enhance_query(self, user_query: str, max_tokens: int = None) -> str:
+        """增强用户查询"""
+        return self.prepare_query(user_query, max_tokens)["text"]
 
-请基于您的知识回答用户的问题。"""
-    
     def is_available(self) -> bool:
         """检查服务是否可用"""
-        return self.initialized and len(self.documents) > 0
+        return self.initialized and self._index is not None and len(self.documents) > 0
+
+    def get_stats(self) -> dict:
+        index = self._index
+        stats = index.get_stats() if index else {"tokenizer": tokenizer_name(), "chunks": 0, "terms": 0}
+        return {
+            "available": self.is_available(),
+            **stats,
+            "load_ms": self.load_ms,
+            "build_seconds": self.build_seconds,
+            "searches": self._searches,
+            "avg_search_ms": round(self._search_seconds / self._searches * 1000, 3) if self._searches else None,
+        }
 
 # 全局简化 RAG 服务实例
 simple_rag_service = None
@@ -138,3 +491,9 @@ def initialize_simple_rag():
     except Exception as e:
         print(f"简化 RAG 服务初始化异常: {e}")
         return False
+
+def get_lexical_fallback():
+    """已启用且可用的词法检索服务，否则返回 None"""
+    if not LEXICAL_FALLBACK or simple_rag_service is None or not simple_rag_service.is_available():
+        return None
+    return simple_rag_service
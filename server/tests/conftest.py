@@ -0,0 +1,5 @@
+"""测试公共配置：把 server 目录加入导入路径（与 uvicorn 在 server 目录下启动时一致）"""
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,31 @@
+"""llm_utils 后台任务：关闭时等待仍在运行的任务，超时的任务被取消"""
+import asyncio
+
+import llm_utils
+
+
+def test_wait_background_tasks_lets_running_tasks_finish():
+    saved = []
+
+    async def save():
+        await asyncio.sleep(0.05)
+        saved.append("回复")
+
+    async def main():
+        llm_utils.spawn_background_task(save())
+        assert await llm_utils.wait_background_tasks(1) == 0
+
+    asyncio.run(main())
+    assert saved == ["回复"]
+    assert not llm_utils._background_tasks
+
+
+def test_wait_background_tasks_cancels_after_timeout():
+    async def main():
+        task = llm_utils.spawn_background_task(asyncio.sleep(10))
+        assert await llm_utils.wait_background_tasks(0.05) == 1
+        await asyncio.sleep(0)
+        assert task.cancelled()
+
+    asyncio.run(main())
+    assert not llm_utils._background_tasks
@@ -0,0 +1,77 @@
+"""simple_rag：检索分词、BM25 排序与索引持久化"""
+import os
+
+import pytest
+
+import rag_service
+import simple_rag
+from simple_rag import BM25Index, SimpleRAGService, tokenize
+
+
+@pytest.fixture(autouse=True)
+def bigram_tokenizer(monkeypatch):
+    monkeypatch.setattr(simple_rag, "LEXICAL_TOKENIZER", "bigram")
+
+
+def test_tokenize_bigrams_cjk_and_keeps_ascii_words():
+    assert tokenize("航母编队ＡＢＣ v1.2 Test") == ["航母", "母编", "编队", "abc", "v1.2", "test"]
+    assert tokenize("舰，F-35") == ["舰", "f-35"]
+    assert tokenize("") == []
+
+
+def test_search_ranks_documents_by_bm25():
+    index = BM25Index.build([
+        ("a#0", "航母编队在南海进行远海训练"),
+        ("b#0", "无人机在现代冲突中的作用日益突出"),
+        ("c#0", "驱逐舰为航母提供防空掩护，航母是编队核心"),
+    ])
+    top = index.search("航母", k=3)
+    assert [index.chunk_ids[doc_id] for doc_id, _ in top] == ["c#0", "a#0"]
+    assert top[0][1] > top[1][1] > 0
+    assert index.search("潜艇", k=3) == []
+
+
+def test_save_and_load_round_trip(tmp_path):
+    path = str(tmp_path / "lexical" / simple_rag.LEXICAL_INDEX_FILE)
+    index = BM25Index.build([("a#0", "导弹防御系统"), ("b#0", "边境兵力部署")], keep_texts=False, files={"a": 1})
+    index.save(path)
+    assert os.listdir(os.path.dirname(path)) == [simple_rag.LEXICAL_INDEX_FILE]  # 没有残留临时文件
+
+    loaded = BM25Index.load(path)
+    assert loaded.chunk_ids == ["a#0", "b#0"]
+    assert loaded.text(0) is None and loaded.data["files"] == {"a": 1}
+    assert loaded.search("防御", k=1) == index.search("防御", k=1)
+
+
+def test_load_rejects_other_tokenizer_or_version(tmp_path, monkeypatch):
+    path = str(tmp_path / simple_rag.LEXICAL_INDEX_FILE)
+    BM25Index.build([("a#0", "测试文本")]).save(path)
+    monkeypatch.setattr(simple_rag, "LEXICAL_INDEX_VERSION", simple_rag.LEXICAL_INDEX_VERSION + 1)
+    assert BM25Index.load(path) is None
+    assert BM25Index.load(str(tmp_path / "missing.pkl")) is None
+
+
+def test_service_reuses_index_until_knowledge_base_changes(tmp_path, monkeypatch):
+    monkeypatch.setattr(rag_service, "RAG_LOAD_WORKERS", 1)
+    monkeypatch.setattr(simple_rag, "_langchain_available", lambda: False)
+    kb = tmp_path / "data"
+    kb.mkdir()
+    (kb / "ships.txt").write_text("航母编队进入南海进行远海训练", encoding="utf-8")
+
+    def service():
+        s = SimpleRAGService(str(kb))
+        s.index_path = str(tmp_path / "lexical" / simple_rag.LEXICAL_INDEX_FILE)
+        return s
+
+    first = service()
+    assert first.initialize() and first.build_seconds is not None
+    assert first.search_documents("航母", k=1)[0]["chunk_id"] == first.documents[0]
+
+    second = service()
+    assert second.load_index()   # 知识库未变化，直接加载
+
+    (kb / "drones.txt").write_text("无人机集群", encoding="utf-8")
+    assert not service().load_index()   # 新增文件后需要重建
+    rebuilt = service()
+    assert rebuilt.initialize() and len(rebuilt.documents) == 2
+    assert rebuilt.search_documents("无人机", k=1)[0]["content"] == "无人机集群"
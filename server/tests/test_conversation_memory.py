@@ -0,0 +1,56 @@
+"""conversation_memory：历史窗口按预算选取，分词计数不在事件循环线程中执行"""
+import asyncio
+import threading
+
+import conversation_memory
+import token_budget
+
+
+def _rows(n, size=20):
+    return [{"id": i + 1, "role": "user" if i % 2 == 0 else "assistant", "content": f"消息{i}" + "字" * size}
+            for i in range(n)]
+
+
+def test_fit_history_keeps_newest_within_budget():
+    rows = _rows(10)
+    summary, window, outside, tokens = conversation_memory._fit_history(None, rows, 100)
+    assert tokens <= 100
+    assert window and window[-1]["id"] == 10
+    assert [m["id"] for m in window] == list(range(11 - len(window), 11))
+    assert outside == rows[:10 - len(window)]
+
+
+def test_fit_history_caps_summary_at_half_budget():
+    summary, window, outside, tokens = conversation_memory._fit_history("摘" * 500, _rows(2), 100)
+    assert token_budget.count_tokens(summary) <= 50
+    assert tokens <= 100
+
+
+def test_build_context_counts_tokens_off_the_loop(monkeypatch):
+    loop_threads = set()
+    counted_on = set()
+    original = conversation_memory.count_tokens
+
+    def tracking_count(text):
+        counted_on.add(threading.get_ident())
+        return original(text)
+
+    async def fake_fetch(subjectid, after_id=0, upto_id=None, limit=None):
+        return _rows(6)
+
+    class Store:
+        async def sync_subject(self, subjectid, text):
+            pass
+
+    import message_store
+    monkeypatch.setattr(conversation_memory, "count_tokens", tracking_count)
+    monkeypatch.setattr(conversation_memory, "_fetch_messages", fake_fetch)
+    monkeypatch.setattr(message_store, "get_message_store", lambda: Store())
+
+    async def main():
+        loop_threads.add(threading.get_ident())
+        return await conversation_memory.build_conversation_context(1, "本轮问题", 1000)
+
+    context = asyncio.run(main())
+    assert len(context["messages"]) == 6
+    assert counted_on and not (counted_on & loop_threads)
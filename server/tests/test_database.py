@@ -0,0 +1,178 @@
+"""database.ConnectionPool：连接数上限、回收、ping 检查与计数"""
+import threading
+import time
+
+import pytest
+
+import database
+from database import ConnectionPool
+
+
+class FakeConnection:
+    def __init__(self):
+        self.open = True
+        self.server_status = 0
+        self.pings = 0
+        self.ping_ok = True
+        self.rollbacks = 0
+
+    def cursor(self):
+        class _Cursor:
+            def __enter__(self):
+                return self
+
+            def __exit__(self, *exc):
+                return False
+
+            def execute(self, sql):
+                pass
+        return _Cursor()
+
+    def ping(self, reconnect=False):
+        self.pings += 1
+        if not self.ping_ok:
+            raise OSError("gone")
+
+    def rollback(self):
+        self.rollbacks += 1
+
+    def close(self):
+        self.open = False
+
+
+@pytest.fixture
+def connections(monkeypatch):
+    created = []
+
+    def fake_connect(**kwargs):
+        connection = FakeConnection()
+        created.append(connection)
+        return connection
+
+    monkeypatch.setattr(database.pymysql, "connect", fake_connect)
+    return created
+
+
+def test_reuses_idle_connection(connections):
+    pool = ConnectionPool(min_size=0, max_size=2)
+    first = pool.acquire()
+    pool.release(first)
+    assert pool.acquire() is first
+    assert len(connections) == 1
+    assert pool.status()["reused"] == 1
+
+
+def test_max_size_blocks_and_times_out(connections):
+    pool = ConnectionPool(min_size=0, max_size=2, acquire_timeout=0.2)
+    pool.acquire()
+    pool.acquire()
+    with pytest.raises(TimeoutError):
+        pool.acquire()
+    assert pool.status()["size"] == 2
+
+
+def test_waiter_gets_released_connection(connections):
+    pool = ConnectionPool(min_size=0, max_size=1, acquire_timeout=5)
+    held = pool.acquire()
+    result = {}
+    waiter = threading.Thread(target=lambda: result.setdefault("conn", pool.acquire()))
+    waiter.start()
+    time.sleep(0.05)
+    pool.release(held)
+    waiter.join(2)
+    assert result["conn"] is held
+
+
+def test_recycles_connection_idle_too_long(connections, monkeypatch):
+    pool = ConnectionPool(min_size=0, max_size=2, recycle=10)
+    first = pool.acquire()
+    pool.release(first)
+    now = time.monotonic()
+    monkeypatch.setattr(database.time, "monotonic", lambda: now + 11)
+    second = pool.acquire()
+    assert second is not first
+    assert not first.open
+    status = pool.status()
+    assert status["recycled"] == 1
+    assert status["size"] == 1
+
+
+def test_pings_only_after_interval_and_drops_dead(connections, monkeypatch):
+    pool = ConnectionPool(min_size=0, max_size=2, recycle=0, ping_interval=30)
+    first = pool.acquire()
+    pool.release(first)
+    assert pool.acquire() is first
+    assert first.pings == 0
+
+    pool.release(first)
+    first.ping_ok = False
+    now = time.monotonic()
+    monkeypatch.setattr(database.time, "monotonic", lambda: now + 31)
+    second = pool.acquire()
+    assert first.pings == 1
+    assert second is not first
+    assert pool.status()["size"] == 1
+
+
+def test_release_rolls_back_open_transaction(connections):
+    pool = ConnectionPool(min_size=0, max_size=1)
+    connection = pool.acquire()
+    connection.server_status = database.SERVER_STATUS.SERVER_STATUS_IN_TRANS
+    pool.release(connection)
+    assert connection.rollbacks == 1
+    assert pool.status()["idle"] == 1
+
+
+def test_broken_release_frees_slot(connections):
+    pool = ConnectionPool(min_size=0, max_size=1, acquire_timeout=0.2)
+    connection = pool.acquire()
+    pool.release(connection, broken=True)
+    assert not connection.open
+    assert pool.acquire() is not connection
+    assert pool.status()["size"] == 1
+
+
+def test_failed_connect_does_not_leak_slot(monkeypatch):
+    def failing_connect(**kwargs):
+        raise OSError("refused")
+
+    monkeypatch.setattr(database.pymysql, "connect", failing_connect)
+    pool = ConnectionPool(min_size=1, max_size=1)
+    with pytest.raises(OSError):
+        pool.acquire()
+    assert pool.status()["size"] == 0
+
+
+def test_concurrent_use_never_exceeds_max_size(connections):
+    pool = ConnectionPool(min_size=0, max_size=3, acquire_timeout=5)
+    peak = []
+    lock = threading.Lock()
+
+    def worker():
+        for _ in range(50):
+            connection = pool.acquire()
+            with lock:
+                peak.append(pool.status()["in_use"])
+            pool.release(connection)
+
+    threads = [threading.Thread(target=worker) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert max(peak) <= 3
+    assert len(connections) <= 3
+    status = pool.status()
+    assert status["created"] == len(connections)
+    assert status["size"] == status["idle"] == len(connections)
+
+
+def test_pool_budget_splits_total(monkeypatch):
+    monkeypatch.setenv("DB_POOL_MAX_SIZE", "10")
+    monkeypatch.delenv("DB_ASYNC_POOL_MAX_SIZE", raising=False)
+    budget = database.pool_budget()
+    assert budget["sync_max"] + budget["async_max"] == 10
+
+    monkeypatch.setenv("DB_ASYNC_POOL_MAX_SIZE", "20")
+    budget = database.pool_budget()
+    assert budget["async_max"] == 9 and budget["sync_max"] == 1
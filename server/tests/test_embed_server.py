@@ -0,0 +1,55 @@
+"""embed_server：批量向量化分块提交，查询批次插在两块之间执行"""
+import asyncio
+import time
+
+import embed_server
+
+
+class SlowModel:
+    """每次推理耗时固定，记录调用顺序"""
+
+    def __init__(self):
+        self.calls = []
+
+    def embed_query(self, text):
+        return [0.0, 0.0]
+
+    def embed_documents(self, texts):
+        time.sleep(0.02)
+        self.calls.append(list(texts))
+        return [[float(len(text)), 1.0] for text in texts]
+
+
+def test_documents_split_into_chunks_in_original_order(monkeypatch):
+    monkeypatch.setattr(embed_server, "EMBED_SERVER_MAX_BATCH", 2)
+    model = SlowModel()
+
+    async def main():
+        server = embed_server.EmbedServer(model, "fake", "test")
+        return server, await server.embed_documents(["ccc", "a", "bb", "dddd", "e"])
+
+    server, vectors = asyncio.run(main())
+    assert [vector[0] for vector in vectors] == [3.0, 1.0, 2.0, 4.0, 1.0]
+    assert all(len(call) <= 2 for call in model.calls)
+    assert server.get_stats()["document_chunks"] == 3
+
+
+def test_query_batch_runs_between_document_chunks(monkeypatch):
+    monkeypatch.setattr(embed_server, "EMBED_SERVER_MAX_BATCH", 4)
+    monkeypatch.setattr(embed_server, "EMBED_SERVER_MAX_WAIT_MS", 1)
+    model = SlowModel()
+
+    async def main():
+        server = embed_server.EmbedServer(model, "fake", "test")
+        batcher = asyncio.create_task(server.batch_loop())
+        documents = asyncio.create_task(server.embed_documents([f"文档{i}" for i in range(40)]))
+        await asyncio.sleep(0.03)
+        await server.embed_queries(["查询"])
+        query_done_before_documents = not documents.done()
+        await documents
+        batcher.cancel()
+        return query_done_before_documents
+
+    assert asyncio.run(main())
+    query_call = model.calls.index(["查询"])
+    assert 0 < query_call < len(model.calls) - 1
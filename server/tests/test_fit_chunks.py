@@ -0,0 +1,43 @@
+"""rag_service.fit_chunks：知识库文本块按相关度顺序装入 token 预算"""
+import pytest
+
+import rag_service
+from rag_service import RAG_MIN_CHUNK_TOKENS, fit_chunks
+
+
+@pytest.fixture(autouse=True)
+def char_tokens(monkeypatch):
+    # 每个字符计为一个 token，预算计算与分词器无关
+    monkeypatch.setattr(rag_service, "count_tokens", len)
+    monkeypatch.setattr(rag_service, "truncate_to_tokens", lambda text, n: text[:n])
+
+
+def _chunk(chunk_id, size):
+    return chunk_id, "字" * size
+
+
+def test_keeps_chunks_in_order_while_they_fit():
+    chunks = [_chunk("a", 100), _chunk("b", 100), _chunk("c", 100)]
+    # 每块额外 1 个 token 的分隔换行
+    assert [cid for cid, _ in fit_chunks(chunks, 202)] == ["a", "b"]
+    assert fit_chunks(chunks, 303) == chunks
+
+
+def test_truncates_last_chunk_when_enough_budget_remains():
+    chunks = [_chunk("a", 100), _chunk("b", 300), _chunk("c", 10)]
+    selected = fit_chunks(chunks, 101 + RAG_MIN_CHUNK_TOKENS + 1)
+    assert [cid for cid, _ in selected] == ["a", "b"]
+    assert len(selected[1][1]) == RAG_MIN_CHUNK_TOKENS
+    # 截断后不再继续装入后面的小块，保持相关度顺序
+    assert "c" not in [cid for cid, _ in selected]
+
+
+def test_drops_last_chunk_when_remainder_is_too_small():
+    chunks = [_chunk("a", 100), _chunk("b", 300)]
+    selected = fit_chunks(chunks, 101 + RAG_MIN_CHUNK_TOKENS)
+    assert [cid for cid, _ in selected] == ["a"]
+
+
+def test_empty_budget_or_chunks():
+    assert fit_chunks([], 100) == []
+    assert fit_chunks([_chunk("a", 10)], 0) == []
@@ -0,0 +1,61 @@
+"""index_store：增量更新（删除后新增）后每个向量仍对应正确的文本块"""
+import numpy as np
+import pytest
+
+faiss = pytest.importorskip("faiss")
+
+import index_store  # noqa: E402
+
+
+def _langchain_delete(index, mapping, chunk_ids):
+    """与 langchain FAISS.delete 相同：remove_ids 后把剩余映射按原顺序重新编号"""
+    reverse = {chunk_id: i for i, chunk_id in mapping.items()}
+    positions = [reverse[chunk_id] for chunk_id in chunk_ids]
+    index.remove_ids(np.array(positions, dtype="int64"))
+    remaining = [chunk_id for i, chunk_id in sorted(mapping.items()) if i not in positions]
+    return {i: chunk_id for i, chunk_id in enumerate(remaining)}
+
+
+def _langchain_add(index, mapping, vectors, chunk_ids):
+    """与 langchain FAISS.add_embeddings 相同：新向量编号接在映射末尾"""
+    start = len(mapping)
+    index.add(vectors)
+    return {**mapping, **{start + j: chunk_id for j, chunk_id in enumerate(chunk_ids)}}
+
+
+@pytest.mark.parametrize("description", ["Flat", "SQ8", "IVF4,Flat", "IVF4,SQ8", "HNSW8"])
+def test_delete_then_add_keeps_vectors_mapped_to_their_chunks(description):
+    rng = np.random.default_rng(0)
+    vectors = rng.random((400, 16), dtype="float32")
+    chunk_ids = [f"doc#{i}" for i in range(400)]
+    stale = set(chunk_ids[10:60:3])
+    new_vectors = rng.random((20, 16), dtype="float32")
+    new_ids = [f"new#{i}" for i in range(20)]
+
+    index = index_store.create_index(vectors, description)
+    mapping = dict(enumerate(chunk_ids))
+    if index_store.supports_remove(index):
+        mapping = _langchain_delete(index, mapping, sorted(stale))
+        mapping = _langchain_add(index, mapping, new_vectors, new_ids)
+    else:
+        # rag_service 对不支持删除的索引执行完全重建
+        keep = [i for i, chunk_id in enumerate(chunk_ids) if chunk_id not in stale]
+        index = index_store.create_index(np.vstack([vectors[keep], new_vectors]), description)
+        mapping = dict(enumerate([chunk_ids[i] for i in keep] + new_ids))
+
+    expected = {chunk_id: vector for chunk_id, vector in zip(chunk_ids + new_ids, np.vstack([vectors, new_vectors]))
+                if chunk_id not in stale}
+    assert index.ntotal == len(mapping) == len(expected)
+    if "IVF" in description:
+        faiss.ParameterSpace().set_index_parameter(index, "nprobe", 4)  # 检索全部聚类，结果精确
+    queries = np.array(list(expected.values()), dtype="float32")
+    _, found = index.search(queries, 1)
+    assert [mapping[int(i)] for i in found[:, 0]] == list(expected)
+
+
+def test_only_flat_indexes_take_the_incremental_path():
+    vectors = np.random.default_rng(1).random((400, 16), dtype="float32")
+    assert index_store.supports_remove(index_store.create_index(vectors, "Flat"))
+    assert index_store.supports_remove(index_store.create_index(vectors, "SQ8"))
+    assert not index_store.supports_remove(index_store.create_index(vectors, "IVF4,Flat"))
+    assert not index_store.supports_remove(index_store.create_index(vectors, "HNSW8"))
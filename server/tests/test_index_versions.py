@@ -0,0 +1,42 @@
+"""RAGService 版本目录：清理只删除 versions 下的旧版本，不触碰随仓库提供的索引"""
+import os
+import time
+
+from rag_service import RAGService
+
+
+def _service(tmp_path):
+    service = RAGService(knowledge_base_path=str(tmp_path / "data"))
+    service.vector_db_path = str(tmp_path / "vector_db")
+    service.legacy_index_path = os.path.join(service.vector_db_path, "faiss_index")
+    service.versions_path = os.path.join(service.vector_db_path, "versions")
+    service.current_pointer_path = os.path.join(service.versions_path, "CURRENT")
+    return service
+
+
+def test_cleanup_keeps_current_previous_and_legacy(tmp_path):
+    service = _service(tmp_path)
+    os.makedirs(os.path.join(service.legacy_index_path))
+    open(os.path.join(service.vector_db_path, "processed_files.txt"), "w").close()
+    names = ["index-20240101-000000-aaaaaa", "index-20240102-000000-bbbbbb",
+             "index-20240103-000000-cccccc", "index-20240104-000000-dddddd"]
+    for name in names + ["notes", ".tmp-20240105-000000-eeeeee", ".tmp-20240101-000000-ffffff"]:
+        os.makedirs(os.path.join(service.versions_path, name))
+    old = time.time() - 7200
+    os.utime(os.path.join(service.versions_path, ".tmp-20240101-000000-ffffff"), (old, old))
+
+    service._cleanup_old_versions(keep=names[-1])
+
+    remaining = set(os.listdir(service.versions_path))
+    assert remaining == {names[2], names[3], "notes", ".tmp-20240105-000000-eeeeee"}
+    assert os.path.isdir(service.legacy_index_path)
+    assert os.path.exists(os.path.join(service.vector_db_path, "processed_files.txt"))
+
+
+def test_index_path_falls_back_to_legacy(tmp_path):
+    service = _service(tmp_path)
+    assert service.vector_index_path == service.legacy_index_path
+    os.makedirs(service.versions_path)
+    with open(service.current_pointer_path, "w") as f:
+        f.write("index-20240101-000000-aaaaaa")
+    assert service.vector_index_path == os.path.join(service.versions_path, "index-20240101-000000-aaaaaa")
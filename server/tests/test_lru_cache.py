@@ -0,0 +1,56 @@
+"""cache_utils.LRUCache / normalize_query：RAG 查询向量与检索结果缓存"""
+import time
+
+from cache_utils import LRUCache, normalize_query
+
+
+def test_normalize_query_ignores_width_case_spacing_and_trailing_punct():
+    assert normalize_query("  航母  编队ＡＢＣ？ ") == normalize_query("航母 编队abc")
+    assert normalize_query("What is RAG?!") == "what is rag"
+    assert normalize_query(None) == ""
+
+
+def test_evicts_least_recently_used():
+    cache = LRUCache(max_size=2)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    assert cache.get("a") == 1  # a 变为最近使用
+    cache.set("c", 3)
+    assert cache.get("b") is None
+    assert cache.get("a") == 1 and cache.get("c") == 3
+    assert len(cache) == 2
+
+
+def test_overwrite_refreshes_position():
+    cache = LRUCache(max_size=2)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    cache.set("a", 10)
+    cache.set("c", 3)
+    assert cache.get("a") == 10
+    assert cache.get("b") is None
+
+
+def test_ttl_expires_entries(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(time, "monotonic", lambda: now[0])
+    cache = LRUCache(max_size=10, ttl=5)
+    cache.set("a", 1)
+    now[0] += 4
+    assert cache.get("a") == 1
+    now[0] += 2
+    assert cache.get("a", "过期") == "过期"
+    assert len(cache) == 0
+
+
+def test_zero_size_disables_cache_and_stats_count_hits():
+    disabled = LRUCache(max_size=0)
+    disabled.set("a", 1)
+    assert disabled.get("a") is None
+
+    cache = LRUCache(max_size=4)
+    cache.set("a", 1)
+    cache.get("a")
+    cache.get("missing")
+    stats = cache.stats()
+    assert (stats["hits"], stats["misses"], stats["hit_rate"]) == (1, 1, 0.5)
@@ -0,0 +1,162 @@
+"""maintenance_jobs：任务合并、取消、失败状态与历史记录"""
+import json
+import threading
+import time
+
+from maintenance_jobs import JobManager, MaintenanceJob
+
+
+def _wait(job, timeout=2.0):
+    deadline = time.monotonic() + timeout
+    while not job.finished and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert job.finished, job.status
+
+
+def _wait_shared(manager, job_id, timeout=2.0):
+    """等待状态文件写入最终状态（运行任务的 worker 先更新内存对象，再写文件）"""
+    deadline = time.monotonic() + timeout
+    while not manager.get(job_id).finished and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+
+def test_submit_while_running_merges_into_active_job():
+    manager = JobManager()
+    started, release = threading.Event(), threading.Event()
+    calls = []
+
+    def work(job):
+        calls.append(job.id)
+        started.set()
+        release.wait(2)
+        return {"success": True}
+
+    job, merged = manager.submit("rebuild", work)
+    assert not merged
+    started.wait(2)
+    again, merged_again = manager.submit("refresh", work)
+    assert merged_again and again is job
+    assert manager.active() is job
+
+    release.set()
+    _wait(job)
+    assert job.status == "succeeded" and calls == [job.id]
+    assert manager.active() is None
+
+    # 结束后再提交会启动新任务
+    fresh, merged = manager.submit("refresh", work)
+    assert not merged and fresh is not job
+    _wait(fresh)
+
+
+def test_cancel_stops_job_at_next_progress_report():
+    manager = JobManager()
+    started = threading.Event()
+    reported = []
+
+    def work(job):
+        report = job.reporter("embedding", done_key="chunks_embedded")
+        started.set()
+        for done in range(1, 1000):
+            report(done, 1000)
+            reported.append(done)
+            time.sleep(0.005)
+        return {"success": True}
+
+    job, _ = manager.submit("rebuild", work)
+    started.wait(2)
+    assert manager.cancel(job.id) is job
+    _wait(job)
+    assert job.status == "cancelled"
+    assert len(reported) < 999
+    assert job.to_dict()["cancel_requested"]
+    assert manager.cancel("missing") is None
+
+
+def test_failures_are_recorded():
+    manager = JobManager()
+
+    def boom(job):
+        raise RuntimeError("磁盘已满")
+
+    failed, _ = manager.submit("rebuild", boom)
+    _wait(failed)
+    assert failed.status == "failed" and failed.error == "磁盘已满"
+
+    unsuccessful, _ = manager.submit("refresh", lambda job: {"success": False})
+    _wait(unsuccessful)
+    assert unsuccessful.status == "failed"
+
+
+def test_history_keeps_most_recent_finished_jobs():
+    manager = JobManager(max_history=2)
+    jobs = []
+    for _ in range(4):
+        job, _ = manager.submit("refresh", lambda job: True)
+        _wait(job)
+        jobs.append(job)
+    listed = [item["job_id"] for item in manager.list()]
+    assert jobs[-1].id in listed and jobs[0].id not in listed
+    assert len(listed) <= 3  # 最多 max_history 个已结束的任务 + 新提交的任务
+
+
+def test_progress_estimates_remaining_time(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(time, "time", lambda: now[0])
+    job = MaintenanceJob("rebuild")
+    job.update("embedding", 0, 100)
+    now[0] += 10
+    job.update("embedding", 25, 100, chunks_embedded=25)
+    assert job.progress["eta_seconds"] == 30.0
+    assert job.progress["chunks_embedded"] == 25
+    job.update("writing", 1, 1)
+    assert job.progress["eta_seconds"] == 0
+
+
+# ---------------------------------------------------------------------------
+# 多 worker：两个 JobManager 共享同一个状态目录（文件锁按打开的文件区分，同一进程内即可模拟）
+# ---------------------------------------------------------------------------
+def test_other_worker_merges_polls_and_cancels(tmp_path):
+    worker_a = JobManager(state_dir=str(tmp_path))
+    worker_b = JobManager(state_dir=str(tmp_path))
+    started = threading.Event()
+
+    def work(job):
+        started.set()
+        while True:
+            job.update("embedding", 1, 10)
+            time.sleep(0.01)
+
+    job, _ = worker_a.submit("rebuild", work)
+    started.wait(2)
+
+    merged, was_merged = worker_b.submit("refresh", work)
+    assert was_merged and merged.id == job.id
+    assert worker_b.get(job.id).status == "running"
+    assert worker_b.active().id == job.id
+    assert job.id in [item["job_id"] for item in worker_b.list()]
+
+    assert worker_b.cancel(job.id).cancel_requested
+    _wait(job)
+    assert job.status == "cancelled"
+    _wait_shared(worker_b, job.id)
+    assert worker_b.get(job.id).status == "cancelled"
+
+    # 任务结束后文件锁已释放，其他 worker 可以启动新任务
+    fresh, was_merged = worker_b.submit("refresh", lambda job: True)
+    assert not was_merged
+    _wait_shared(worker_a, fresh.id)
+    assert worker_a.get(fresh.id).status == "succeeded"
+
+
+def test_job_of_exited_worker_is_reported_failed(tmp_path):
+    manager = JobManager(state_dir=str(tmp_path))
+    orphan = MaintenanceJob("rebuild")
+    orphan.status = "running"
+    (tmp_path / f"{orphan.id}.json").write_text(json.dumps(orphan.to_dict()), encoding="utf-8")
+    (tmp_path / "ACTIVE").write_text(orphan.id, encoding="utf-8")
+
+    job = manager.get(orphan.id)
+    assert job.status == "failed" and "退出" in job.error
+    assert manager.active() is None
+    assert manager.get("../etc/passwd") is None
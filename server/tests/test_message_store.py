@@ -0,0 +1,250 @@
+"""message_store：WAL 回放按记录ID去重、外键失败进入死信文件、数据库不可用时消息留在 WAL"""
+import asyncio
+import json
+import os
+import time
+from contextlib import asynccontextmanager
+
+import pytest
+
+import message_store
+
+
+class FakeDB:
+    """模拟 chatcontent 表：外键检查、wal_id 唯一索引、事务提交"""
+
+    def __init__(self, subjects=(1, 2), with_wal_id=True):
+        self.subjects = set(subjects)
+        self.columns = {"id", "subjectid", "content", "role", "created_at"}
+        if with_wal_id:
+            self.columns.add("wal_id")
+        self.rows = []
+        self.down = False
+
+    @asynccontextmanager
+    async def connection(self):
+        if self.down:
+            raise ConnectionError("MySQL 不可用")
+        yield FakeConnection(self)
+
+    async def has_columns(self, migration):
+        if self.down:
+            raise ConnectionError("MySQL 不可用")
+        return "wal_id" in self.columns
+
+
+class FakeConnection:
+    def __init__(self, db):
+        self.db = db
+        self.staged = []
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    async def commit(self):
+        self.db.rows.extend(self.staged)
+        self.staged = []
+
+
+class FakeCursor:
+    def __init__(self, conn):
+        self.conn = conn
+        self.result = []
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+    async def execute(self, sql, params=()):
+        db = self.conn.db
+        rows = db.rows + self.conn.staged
+        if sql.startswith("SELECT wal_id"):
+            self.result = [{"wal_id": row["wal_id"]} for row in rows if row.get("wal_id") in set(params)]
+        elif sql.startswith("SELECT 1"):
+            subjectid, role, ts, content = params
+            self.result = [{"1": 1} for row in rows
+                           if (row["subjectid"], row["role"], row["ts"], row["content"]) == (subjectid, role, ts, content)]
+        elif sql.startswith("INSERT INTO chatcontent"):
+            width = 5 if "wal_id" in sql else 4
+            new = []
+            for i in range(0, len(params), width):
+                values = params[i:i + width]
+                row = {"subjectid": values[0], "content": values[1], "role": values[2], "ts": values[3],
+                       "wal_id": values[4] if width == 5 else None}
+                if row["subjectid"] not in db.subjects:
+                    raise Exception(message_store.FK_ERROR, "foreign key constraint fails")
+                if row["wal_id"] and any(r.get("wal_id") == row["wal_id"] for r in rows + new):
+                    raise Exception(1062, "Duplicate entry")
+                new.append(row)
+            self.conn.staged.extend(new)
+        else:
+            raise AssertionError(sql)
+
+    async def fetchone(self):
+        return self.result[0] if self.result else None
+
+    async def fetchall(self):
+        return self.result
+
+
+@pytest.fixture
+def db(monkeypatch, tmp_path):
+    fake = FakeDB()
+    monkeypatch.setattr(message_store, "get_async_db_connection", fake.connection)
+    monkeypatch.setattr(message_store, "has_columns", fake.has_columns)
+    monkeypatch.setattr(message_store, "MESSAGE_WAL_DIR", str(tmp_path))
+    monkeypatch.setattr(message_store, "MESSAGE_WRITE_BEHIND", True)
+    monkeypatch.setattr(message_store, "MESSAGE_FLUSH_INTERVAL", 60)
+    return fake
+
+
+def _write_wal(tmp_path, records, name="wal-1-1-1.jsonl"):
+    with open(os.path.join(tmp_path, name), "w", encoding="utf-8") as f:
+        for record in records:
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+
+def _wal_lines(tmp_path):
+    lines = []
+    for name in os.listdir(tmp_path):
+        if name.startswith("wal-"):
+            with open(os.path.join(tmp_path, name), encoding="utf-8") as f:
+                lines.extend(f.read().splitlines())
+    return lines
+
+
+async def _run_store(actions):
+    store = message_store.MessageStore()
+    await store.start()
+    try:
+        await actions(store)
+    finally:
+        await store.close()
+    return store
+
+
+def test_add_flush_writes_rows_with_wal_ids(db, tmp_path):
+    async def actions(store):
+        await store.add(1, "user", "问题")
+        await store.add(1, "assistant", "回答")
+        assert await store.flush()
+
+    store = asyncio.run(_run_store(actions))
+    assert [(row["role"], row["content"]) for row in db.rows] == [("user", "问题"), ("assistant", "回答")]
+    assert all(len(row["wal_id"]) == 32 for row in db.rows)
+    assert store.stats_counters["written"] == 2
+    assert _wal_lines(tmp_path) == []
+
+
+def test_replay_skips_records_already_committed(db, tmp_path):
+    ts = int(time.time())
+    records = [{"subjectid": 1, "role": "user", "content": "问题", "ts": ts, "wid": "a" * 32},
+               {"subjectid": 1, "role": "assistant", "content": "回答", "ts": ts, "wid": "b" * 32}]
+    # 第一条已提交，但崩溃发生在删除 WAL 之前
+    db.rows.append({"subjectid": 1, "role": "user", "content": "问题", "ts": ts, "wal_id": "a" * 32})
+    _write_wal(tmp_path, records)
+
+    store = asyncio.run(_run_store(lambda store: store.flush()))
+    assert [row["wal_id"] for row in db.rows] == ["a" * 32, "b" * 32]
+    assert store.stats_counters["recovered"] == 2
+    assert store.stats_counters["written"] == 1
+
+
+def test_replay_keeps_identical_messages_in_same_second(db, tmp_path):
+    ts = int(time.time())
+    same = {"subjectid": 1, "role": "user", "content": "好的", "ts": ts}
+    db.rows.append(dict(same, wal_id="a" * 32))
+    _write_wal(tmp_path, [dict(same, wid="a" * 32), dict(same, wid="c" * 32)])
+
+    asyncio.run(_run_store(lambda store: store.flush()))
+    assert sorted(row["wal_id"] for row in db.rows) == ["a" * 32, "c" * 32]
+
+
+def test_replay_without_wal_id_column_falls_back_to_content_match(db, tmp_path):
+    db.columns.discard("wal_id")
+    ts = int(time.time())
+    old = {"subjectid": 1, "role": "user", "content": "旧版本记录", "ts": ts}
+    db.rows.append(dict(old, wal_id=None))
+    _write_wal(tmp_path, [old, {"subjectid": 1, "role": "assistant", "content": "回答", "ts": ts}])
+
+    asyncio.run(_run_store(lambda store: store.flush()))
+    assert [row["content"] for row in db.rows] == ["旧版本记录", "回答"]
+
+
+def test_foreign_key_failure_dead_letters_only_failing_rows(db, tmp_path):
+    async def actions(store):
+        await store.add(1, "user", "有效主题")
+        await store.add(9, "user", "已删除的主题")
+        await store.add(2, "assistant", "另一个有效主题")
+        assert await store.flush()
+
+    store = asyncio.run(_run_store(actions))
+    assert [row["content"] for row in db.rows] == ["有效主题", "另一个有效主题"]
+    assert store.stats_counters["dead_lettered"] == 1
+    with open(os.path.join(tmp_path, message_store.DEAD_LETTER_FILE), encoding="utf-8") as f:
+        dead = [json.loads(line) for line in f]
+    assert [(entry["subjectid"], entry["content"]) for entry in dead] == [(9, "已删除的主题")]
+    assert _wal_lines(tmp_path) == []
+
+
+def test_messages_survive_database_outage_and_replay_once(db, tmp_path):
+    db.down = True
+
+    async def actions(store):
+        await store.add(1, "user", "断网期间的消息")
+        assert not await store.flush()
+
+    asyncio.run(_run_store(actions))
+    assert db.rows == []
+    assert len(_wal_lines(tmp_path)) == 1
+
+    db.down = False
+    store = asyncio.run(_run_store(lambda store: store.flush()))
+    assert [row["content"] for row in db.rows] == ["断网期间的消息"]
+    assert store.stats_counters["recovered"] == 1
+    assert _wal_lines(tmp_path) == []
+
+    # 再次启动不会重复写入
+    asyncio.run(_run_store(lambda store: store.flush()))
+    assert len(db.rows) == 1
+
+
+def test_wal_dir_resolves_against_module_directory():
+    assert os.path.isabs(message_store.MESSAGE_WAL_DIR)
+
+
+def test_fsync_runs_off_the_event_loop_and_groups_concurrent_adds(db, tmp_path, monkeypatch):
+    synced_lines = []
+
+    def slow_fsync(fd):
+        time.sleep(0.05)  # 模拟慢磁盘
+        synced_lines.append(len(_wal_lines(tmp_path)))
+
+    monkeypatch.setattr(message_store, "MESSAGE_WAL_FSYNC", True)
+    monkeypatch.setattr(message_store.os, "fsync", slow_fsync)
+
+    async def actions(store):
+        ticks = 0
+
+        async def ticker():
+            nonlocal ticks
+            while True:
+                ticks += 1
+                await asyncio.sleep(0.005)
+
+        ticking = asyncio.get_running_loop().create_task(ticker())
+        await store.add(1, "user", "第一条")
+        # add() 返回时 fsync 已覆盖这条记录
+        assert synced_lines == [1]
+        await asyncio.gather(*(store.add(1, "user", f"并发{i}") for i in range(10)))
+        ticking.cancel()
+        assert ticks > 3  # fsync 期间事件循环仍在运行
+        assert await store.flush()
+
+    asyncio.run(_run_store(actions))
+    # 10 条并发消息最多两次 fsync：一次进行中时追加的记录由下一次一并落盘
+    assert len(synced_lines) <= 3
+    assert synced_lines[-1] == 11
+    assert len(db.rows) == 11
@@ -0,0 +1,58 @@
+"""onnx_embeddings：导出在临时目录中进行并原子移入缓存目录，跨进程文件锁"""
+import fcntl
+import os
+import threading
+
+import pytest
+
+import onnx_embeddings
+
+
+def _fake_export(files):
+    def export(model_dir, out_dir):
+        for name, content in files.items():
+            with open(os.path.join(out_dir, name), "w") as f:
+                f.write(content)
+            if content == "fail":
+                raise RuntimeError("导出中断")
+    return export
+
+
+def test_export_moves_complete_files_into_cache(monkeypatch, tmp_path):
+    cache_dir = str(tmp_path / "model-abc")
+    monkeypatch.setattr(onnx_embeddings, "export_onnx",
+                        _fake_export({onnx_embeddings.ONNX_FILE: "graph", "tokenizer.json": "{}"}))
+
+    onnx_embeddings.export_into("model", cache_dir)
+    assert sorted(os.listdir(cache_dir)) == sorted([onnx_embeddings.ONNX_FILE, "tokenizer.json"])
+    assert os.listdir(tmp_path) == ["model-abc"]  # 临时目录已删除
+
+
+def test_interrupted_export_leaves_no_model_file(monkeypatch, tmp_path):
+    cache_dir = str(tmp_path / "model-abc")
+    monkeypatch.setattr(onnx_embeddings, "export_onnx",
+                        _fake_export({onnx_embeddings.ONNX_FILE: "partial", "tokenizer.json": "fail"}))
+
+    with pytest.raises(RuntimeError):
+        onnx_embeddings.export_into("model", cache_dir)
+    assert not os.path.exists(os.path.join(cache_dir, onnx_embeddings.ONNX_FILE))
+    assert os.listdir(tmp_path) == ["model-abc"]
+
+
+def test_export_lock_waits_for_other_process(tmp_path):
+    cache_dir = str(tmp_path / "model-abc")
+    entered = threading.Event()
+
+    def worker():
+        with onnx_embeddings._export_lock(cache_dir):
+            entered.set()
+
+    # 另一个进程持有文件锁（flock 按打开的文件区分，同一进程内单独打开即可模拟）
+    with open(cache_dir + ".lock", "a") as other:
+        fcntl.flock(other, fcntl.LOCK_EX)
+        thread = threading.Thread(target=worker)
+        thread.start()
+        assert not entered.wait(0.2)
+        fcntl.flock(other, fcntl.LOCK_UN)
+    assert entered.wait(2)
+    thread.join()
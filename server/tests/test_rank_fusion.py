@@ -0,0 +1,61 @@
+"""rag_service.reciprocal_rank_fusion：向量检索与关键词检索结果的倒数排名融合"""
+import threading
+from types import SimpleNamespace
+
+from rag_service import _LatencyStats, reciprocal_rank_fusion
+
+
+def _doc(chunk_id, text=None):
+    return SimpleNamespace(page_content=text or f"文本{chunk_id}", metadata={"chunk_id": chunk_id} if chunk_id else {})
+
+
+def _ids(docs):
+    return [doc.metadata.get("chunk_id") or doc.page_content for doc in docs]
+
+
+def test_chunks_found_by_both_retrievers_rank_first():
+    vector = [_doc("a"), _doc("b"), _doc("c")]
+    lexical = [_doc("c"), _doc("d"), _doc("a")]
+    # a: 1/61 + 1/63，c: 1/63 + 1/61，b: 1/62，d: 1/62
+    assert _ids(reciprocal_rank_fusion([vector, lexical], limit=4, rrf_k=60)) == ["a", "c", "b", "d"]
+
+
+def test_ties_keep_vector_results_first_and_limit_applies():
+    vector = [_doc("v1"), _doc("v2")]
+    lexical = [_doc("l1"), _doc("l2")]
+    assert _ids(reciprocal_rank_fusion([vector, lexical], limit=3, rrf_k=60)) == ["v1", "l1", "v2"]
+
+
+def test_deduplicates_by_chunk_id_and_falls_back_to_text():
+    first = _doc("x", "向量库中的文本")
+    vector = [first, _doc(None, "旧索引文本")]
+    lexical = [_doc("x", "词法索引中的同一块"), _doc(None, "旧索引文本")]
+    fused = reciprocal_rank_fusion([vector, lexical], limit=5)
+    assert len(fused) == 2
+    assert fused[0] is first   # 同一块保留先出现的文档对象
+
+
+def test_smaller_k_favours_top_ranks():
+    vector = [_doc("a"), _doc("x"), _doc("y"), _doc("b")]
+    lexical = [_doc("c"), _doc("z"), _doc("w"), _doc("b")]
+    # rrf_k 越小，单路第一名的权重越大；越大则越看重两路都出现
+    assert _ids(reciprocal_rank_fusion([vector, lexical], limit=1, rrf_k=1)) == ["a"]
+    assert _ids(reciprocal_rank_fusion([vector, lexical], limit=1, rrf_k=60)) == ["b"]
+
+
+def test_latency_stats_count_concurrent_retrievals():
+    latency = _LatencyStats()
+
+    def worker():
+        for _ in range(2000):
+            latency.add(0.001)
+
+    threads = [threading.Thread(target=worker) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    stats = latency.stats()
+    assert stats["count"] == 16000
+    assert stats["avg_ms"] == 1.0
+    assert stats["max_ms"] == 1.0
@@ -0,0 +1,43 @@
+"""reply_stream：未执行迁移 002 的数据库不写检查点，结束时整条交给消息存储保存"""
+import asyncio
+
+import database
+import llm_utils
+import reply_stream
+
+
+def test_check_schema_lists_missing_migrations(monkeypatch):
+    async def columns(table):
+        return {"id", "subjectid", "content", "role", "created_at", "wal_id"}
+
+    monkeypatch.setattr(database, "get_table_columns", columns)
+    assert asyncio.run(database.check_schema()) == ["002_stream_checkpoints.sql"]
+
+
+def test_without_checkpoint_columns_reply_saved_once_at_finish(monkeypatch):
+    saved = []
+
+    async def no_columns(migration):
+        return False
+
+    async def save(subjectid, content):
+        saved.append((subjectid, content))
+
+    def no_database():
+        raise AssertionError("未执行迁移时不应写检查点")
+
+    monkeypatch.setattr(reply_stream, "has_columns", no_columns)
+    monkeypatch.setattr(reply_stream, "get_async_db_connection", no_database)
+    monkeypatch.setattr(llm_utils, "_async_save_assistant_reply", save)
+
+    async def main():
+        reply = reply_stream.ReplyStream(None, 7)
+        reply.append("第一段")
+        await reply._persist()  # 生成中的检查点被跳过
+        reply.append("第二段")
+        reply.status = reply_stream.STATUS_COMPLETE
+        await reply._persist()
+        assert await reply_stream._fetch_checkpoint("missing") is None
+
+    asyncio.run(main())
+    assert saved == [(7, "第一段第二段")]
@@ -0,0 +1,48 @@
+"""cache_utils.SemanticCache：按分组键 + 向量相似度命中的回答缓存"""
+import time
+
+from cache_utils import SemanticCache
+
+
+def test_hit_requires_same_group_and_similarity_above_threshold():
+    cache = SemanticCache(max_size=10, threshold=0.95)
+    cache.set([1.0, 0.0], "chunks-1", "回答A")
+    assert cache.get([0.99, 0.05], "chunks-1") == "回答A"
+    assert cache.get([0.99, 0.05], "chunks-2") is None   # 检索结果不同
+    assert cache.get([0.6, 0.8], "chunks-1") is None     # 语义不够接近
+    assert cache.get([0.0, 0.0], "chunks-1") is None     # 零向量不命中
+
+
+def test_returns_most_similar_entry():
+    cache = SemanticCache(max_size=10, threshold=0.9)
+    cache.set([1.0, 0.2], "g", "较远")
+    cache.set([1.0, 0.0], "g", "较近")
+    # 两条互相足够相似时，第二次写入替换第一条
+    assert len(cache) == 1
+    cache.set([0.0, 1.0], "g", "另一个问题")
+    assert cache.get([1.0, 0.01], "g") == "较近"
+    assert cache.get([0.01, 1.0], "g") == "另一个问题"
+
+
+def test_evicts_least_recently_used_entries():
+    cache = SemanticCache(max_size=2, threshold=0.99)
+    cache.set([1.0, 0.0, 0.0], "g", "a")
+    cache.set([0.0, 1.0, 0.0], "g", "b")
+    assert cache.get([1.0, 0.0, 0.0], "g") == "a"   # a 变为最近使用
+    cache.set([0.0, 0.0, 1.0], "g", "c")
+    assert cache.get([0.0, 1.0, 0.0], "g") is None
+    assert cache.get([1.0, 0.0, 0.0], "g") == "a"
+    assert cache.get([0.0, 0.0, 1.0], "g") == "c"
+
+
+def test_ttl_and_purge(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(time, "monotonic", lambda: now[0])
+    cache = SemanticCache(max_size=10, ttl=10, threshold=0.9)
+    cache.set([1.0, 0.0], ("v1", "a"), "旧索引")
+    cache.set([0.0, 1.0], ("v2", "b"), "新索引")
+    assert cache.purge(lambda key: key[0] == "v1") == 1
+    assert cache.get([1.0, 0.0], ("v1", "a")) is None
+    now[0] += 11
+    assert cache.get([0.0, 1.0], ("v2", "b")) is None
+    assert len(cache) == 0
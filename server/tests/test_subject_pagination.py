@@ -0,0 +1,86 @@
+"""/get_subject 键集分页：同一创建时间的主题按 id 排序，翻页不重复、不遗漏"""
+import sqlite3
+from contextlib import contextmanager
+
+import pytest
+from fastapi import HTTPException
+
+import routes
+
+
+class SqliteCursor:
+    """把 pymysql 风格的 %s 占位符转换为 sqlite，返回 dict 行"""
+
+    def __init__(self, conn):
+        self.cursor = conn.cursor()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.cursor.close()
+        return False
+
+    def execute(self, sql, params=()):
+        self.cursor.execute(sql.replace("%s", "?"), params)
+
+    def _row(self, row):
+        return {column[0]: value for column, value in zip(self.cursor.description, row)}
+
+    def fetchone(self):
+        row = self.cursor.fetchone()
+        return None if row is None else self._row(row)
+
+    def fetchall(self):
+        return [self._row(row) for row in self.cursor.fetchall()]
+
+
+@pytest.fixture
+def subjects(monkeypatch):
+    conn = sqlite3.connect(":memory:")
+    conn.execute("CREATE TABLE subject (id INTEGER PRIMARY KEY, title TEXT, created_at TEXT)")
+    # 每三个主题共用一个创建时间，分页必须靠 id 区分
+    for i in range(1, 11):
+        conn.execute("INSERT INTO subject VALUES (?, ?, ?)", (i, f"主题{i}", f"2024-01-0{(i - 1) // 3 + 1} 00:00:00"))
+
+    class Connection:
+        def cursor(self):
+            return SqliteCursor(conn)
+
+    @contextmanager
+    def get_db_connection():
+        yield Connection()
+
+    monkeypatch.setattr(routes, "get_db_connection", get_db_connection)
+    return list(range(10, 0, -1))  # 创建时间倒序，同一时间 id 倒序
+
+
+def test_before_id_walks_all_pages_without_gaps(subjects):
+    seen, before_id = [], None
+    while True:
+        page = routes.get_subject(before_id=before_id, after_id=None, limit=3)
+        seen.extend(row["id"] for row in page)
+        if len(page) < 3:
+            break
+        before_id = page[-1]["id"]
+    assert seen == subjects
+
+
+def test_after_id_returns_newer_subjects_in_display_order(subjects):
+    page = routes.get_subject(before_id=None, after_id=5, limit=3)
+    assert [row["id"] for row in page] == [8, 7, 6]
+
+
+def test_first_page_is_newest(subjects):
+    page = routes.get_subject(before_id=None, after_id=None, limit=4)
+    assert [row["id"] for row in page] == subjects[:4]
+    assert set(page[0]) == {"id", "title", "created_at"}
+
+
+def test_unknown_cursor_and_conflicting_cursors_are_rejected(subjects):
+    with pytest.raises(HTTPException) as missing:
+        routes.get_subject(before_id=99, after_id=None, limit=3)
+    assert missing.value.status_code == 404
+    with pytest.raises(HTTPException) as conflict:
+        routes.get_subject(before_id=3, after_id=5, limit=3)
+    assert conflict.value.status_code == 400
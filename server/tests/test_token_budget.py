@@ -0,0 +1,61 @@
+"""token_budget：事件循环中不等待分词器加载、不解析上下文长度"""
+import asyncio
+
+import pytest
+
+import token_budget
+
+
+@pytest.fixture
+def unloaded(monkeypatch):
+    started = []
+    monkeypatch.setattr(token_budget, "_tokenizer", None)
+    monkeypatch.setattr(token_budget, "_tokenizer_loaded", False)
+    monkeypatch.setattr(token_budget, "_max_context", None)
+    monkeypatch.setattr(token_budget, "start_warmup", lambda: started.append(True))
+    return started
+
+
+def test_event_loop_uses_estimate_while_lock_is_held(unloaded):
+    async def main():
+        # 后台线程正在加载（持有锁）时，事件循环中的调用立即返回
+        with token_budget._tokenizer_lock:
+            assert token_budget.get_tokenizer() is None
+            return token_budget.count_tokens("测试文本 hello")
+
+    assert asyncio.run(main()) == token_budget.estimate_tokens("测试文本 hello")
+    assert unloaded
+
+
+def test_event_loop_does_not_resolve_context(unloaded, monkeypatch):
+    def fail():
+        raise AssertionError("不应在事件循环中请求推理服务")
+
+    monkeypatch.setattr(token_budget, "_context_from_server", fail)
+    monkeypatch.setattr(token_budget, "LLM_MAX_CONTEXT", 0)
+
+    async def main():
+        with token_budget._max_context_lock:
+            return token_budget.get_max_context()
+
+    assert asyncio.run(main()) == token_budget.DEFAULT_MAX_CONTEXT
+    assert token_budget._max_context is None
+
+
+def test_worker_thread_resolves_and_caches(unloaded, monkeypatch):
+    monkeypatch.setattr(token_budget, "LLM_MAX_CONTEXT", 0)
+    monkeypatch.setattr(token_budget, "_context_from_server", lambda: 8192)
+    assert token_budget.get_max_context() == 8192
+    assert token_budget._max_context == 8192
+
+
+def test_static_count_recomputed_after_tokenizer_loads(unloaded, monkeypatch):
+    class Tokenizer:
+        def encode(self, text, add_special_tokens=False):
+            return list(range(7))
+
+    text = "系统提示词 for static count"
+    assert token_budget.count_static_tokens(text) == token_budget.estimate_tokens(text)
+    monkeypatch.setattr(token_budget, "_tokenizer", Tokenizer())
+    monkeypatch.setattr(token_budget, "_tokenizer_loaded", True)
+    assert token_budget.count_static_tokens(text) == 7
@@ -0,0 +1,278 @@
+"""
+Token 计数与预算
+
+优先使用推理服务所用模型的分词器（transformers，本地加载）；
+分词器不可用时退回按字符类别的估算：中日韩字符按 1 个 token，其余文本按 4 个字符 1 个 token。
+
+分词器加载和上下文长度解析（可能请求推理服务）只在后台线程中执行：在事件循环线程中调用时
+不等待锁、不做网络请求，尚未就绪时使用估算计数和保守的默认上下文长度，并在后台开始解析。
+"""
+import os
+import re
+import json
+import math
+import asyncio
+import threading
+from functools import lru_cache
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# 分词器路径：默认使用 LOCAL_MODEL_NAME（vLLM 等按本地路径加载模型时与推理服务一致）
+LLM_TOKENIZER_PATH = os.getenv("LLM_TOKENIZER_PATH") or os.getenv("LOCAL_MODEL_NAME", "")
+
+# 每条消息的对话模板开销（角色标记、分隔符）
+MESSAGE_OVERHEAD_TOKENS = 4
+
+_CJK_RE = re.compile(r"[\u2e80-\u9fff\uac00-\ud7af\uf900-\ufaff\uff00-\uffef]")
+
+_tokenizer = None
+_tokenizer_loaded = False
+_tokenizer_lock = threading.Lock()
+_warmup_started = False
+_warmup_lock = threading.Lock()
+
+
+def _on_event_loop() -> bool:
+    """当前线程是否正在运行事件循环（此时不能等待锁或做阻塞 I/O）"""
+    try:
+        asyncio.get_running_loop()
+        return True
+    except RuntimeError:
+        return False
+
+
+def start_warmup():
+    """在后台线程中加载分词器并解析上下文长度（只启动一次）"""
+    global _warmup_started
+    with _warmup_lock:
+        if _warmup_started:
+            return
+        _warmup_started = True
+    threading.Thread(target=warmup, name="tokenizer-warmup", daemon=True).start()
+
+
+def get_tokenizer():
+    """按需加载分词器（只加载一次），不可用或在事件循环中尚未加载完成时返回 None"""
+    global _tokenizer, _tokenizer_loaded
+    if _tokenizer_loaded:
+        return _tokenizer
+    if _on_event_loop():
+        start_warmup()
+        return None
+    with _tokenizer_lock:
+        if _tokenizer_loaded:
+            return _tokenizer
+        if LLM_TOKENIZER_PATH:
+            try:
+                from transformers import AutoTokenizer
+                _tokenizer = AutoTokenizer.from_pretrained(
+                    LLM_TOKENIZER_PATH,
+                    local_files_only=os.path.isdir(LLM_TOKENIZER_PATH),
+                    trust_remote_code=True
+                )
+                print(f"已加载分词器: {LLM_TOKENIZER_PATH}")
+            except Exception as e:
+                print(f"分词器加载失败，使用估算计数: {e}")
+                _tokenizer = None
+        else:
+            print("未配置 LLM_TOKENIZER_PATH，使用估算计数")
+        _tokenizer_loaded = True
+    return _tokenizer
+
+
+def estimate_tokens(text: str) -> int:
+    """不依赖分词器的估算：中日韩字符 1 个 token，其余 4 个字符 1 个 token"""
+    if not text:
+        return 0
+    cjk = len(_CJK_RE.findall(text))
+    return cjk + math.ceil((len(text) - cjk) / 4)
+
+
+def count_tokens(text: str) -> int:
+    """计算文本的 token 数"""
+    if not text:
+        return 0
+    tokenizer = get_tokenizer()
+    if tokenizer is None:
+        return estimate_tokens(text)
+    return len(tokenizer.encode(text, add_special_tokens=False))
+
+
+def count_static_tokens(text: str) -> int:
+    """系统提示词等固定文本的 token 数（按文本缓存；分词器加载完成后重新计算一次）"""
+    return _count_static_tokens(text, _tokenizer_loaded)
+
+
+@lru_cache(maxsize=128)
+def _count_static_tokens(text: str, tokenizer_loaded: bool) -> int:
+    return count_tokens(text)
+
+
+def count_message_tokens(messages: list) -> int:
+    """计算对话消息列表的 token 数（含每条消息的模板开销）"""
+    return sum(count_tokens(m.get("content", "")) + MESSAGE_OVERHEAD_TOKENS for m in messages)
+
+
+def truncate_to_tokens(text: str, max_tokens: int, keep: str = "head") -> str:
+    """
+    把文本截断到 max_tokens 以内
+
+    Args:
+        keep: "head" 保留开头，"tail" 保留结尾
+    """
+    if max_tokens <= 0:
+        return ""
+    if count_tokens(text) <= max_tokens:
+        return text
+    tokenizer = get_tokenizer()
+    if tokenizer is not None:
+        ids = tokenizer.encode(text, add_special_tokens=False)
+        ids = ids[:max_tokens] if keep == "head" else ids[-max_tokens:]
+        return tokenizer.decode(ids)
+    # 估算模式：按比例截取后逐步收缩
+    ratio = max_tokens / max(1, estimate_tokens(text))
+    length = max(1, int(len(text) * ratio))
+    while length > 1:
+        piece = text[:length] if keep == "head" else text[-length:]
+        if estimate_tokens(piece) <= max_tokens:
+            return piece
+        length = int(length * 0.9)
+    return ""
+
+
+# ---------------------------------------------------------------------------
+# 上下文预算
+# ---------------------------------------------------------------------------
+# 模型上下文长度（输入 + 输出），0 表示自动获取：
+# 推理服务 /v1/models 的 max_model_len（vLLM）-> 模型目录 config.json -> 默认值
+LLM_MAX_CONTEXT = int(os.getenv("LLM_MAX_CONTEXT", 0))
+DEFAULT_MAX_CONTEXT = 3000
+LLM_MAX_OUTPUT_TOKENS = int(os.getenv("LLM_MAX_OUTPUT_TOKENS", 1000))
+LLM_MIN_OUTPUT_TOKENS = 100
+SAFETY_TOKENS = 200  # 对话模板、特殊 token 等的余量
+
+_max_context = None
+_max_context_source = None
+_max_context_lock = threading.Lock()
+
+
+class PromptTooLongError(ValueError):
+    """输入本身超出模型上下文，发给推理服务也只会被拒绝或截断"""
+
+    def __init__(self, tokens: int, limit: int):
+        self.tokens = tokens
+        self.limit = limit
+        super().__init__(f"输入过长：约 {tokens} 个 token，超过上限 {limit}，请缩短后重试")
+
+
+def _context_from_server():
+    """从 OpenAI 兼容推理服务的 /v1/models 读取 max_model_len（vLLM 提供）"""
+    model_url = os.getenv("LOCAL_MODEL_URL", "")
+    if "/v1/" not in model_url:
+        return None
+    models_url = model_url[:model_url.index("/v1/")] + "/v1/models"
+    try:
+        import requests
+        response = requests.get(models_url, timeout=3)
+        response.raise_for_status()
+        models = response.json().get("data", [])
+    except Exception as e:
+        print(f"无法从推理服务获取上下文长度: {e}")
+        return None
+    model_name = os.getenv("LOCAL_MODEL_NAME", "")
+    for model in sorted(models, key=lambda m: m.get("id") != model_name):
+        if model.get("max_model_len"):
+            return int(model["max_model_len"])
+    return None
+
+
+def _context_from_model_config():
+    """从本地模型目录的 config.json 读取 max_position_embeddings"""
+    config_path = os.path.join(LLM_TOKENIZER_PATH, "config.json") if LLM_TOKENIZER_PATH else ""
+    if not os.path.isfile(config_path):
+        return None
+    try:
+        with open(config_path, "r", encoding="utf-8") as f:
+            config = json.load(f)
+    except (OSError, ValueError) as e:
+        print(f"读取模型配置失败: {e}")
+        return None
+    value = config.get("max_position_embeddings") or config.get("max_sequence_length")
+    return int(value) if value else None
+
+
+def get_max_context() -> int:
+    """
+    模型上下文长度（首次调用时解析并缓存）
+
+    在事件循环中调用且尚未解析时不等待：返回 LLM_MAX_CONTEXT 或默认值（不缓存），后台开始解析。
+    """
+    global _max_context, _max_context_source
+    if _max_context is not None:
+        return _max_context
+    if _on_event_loop():
+        start_warmup()
+        return LLM_MAX_CONTEXT or DEFAULT_MAX_CONTEXT
+    with _max_context_lock:
+        if _max_context is not None:
+            return _max_context
+        for source, resolve in (("LLM_MAX_CONTEXT", lambda: LLM_MAX_CONTEXT or None),
+                                ("推理服务", _context_from_server),
+                                ("模型配置", _context_from_model_config)):
+            value = resolve()
+            if value:
+                _max_context, _max_context_source = value, source
+                break
+        else:
+            _max_context, _max_context_source = DEFAULT_MAX_CONTEXT, "默认值"
+        print(f"模型上下文长度: {_max_context}（来源: {_max_context_source}）")
+    return _max_context
+
+
+def max_input_tokens(max_context: int = None) -> int:
+    """输入（全部消息）最多可用的 token 数，至少给回复留 LLM_MIN_OUTPUT_TOKENS"""
+    max_context = max_context or get_max_context()
+    return max_context - SAFETY_TOKENS - LLM_MIN_OUTPUT_TOKENS
+
+
+def check_prompt_fits(prompt_tokens: int, max_context: int = None):
+    """输入超出上下文时直接拒绝，不再发给推理服务"""
+    limit = max_input_tokens(max_context)
+    if prompt_tokens > limit:
+        raise PromptTooLongError(prompt_tokens, limit)
+
+
+def user_message_budget(system_tokens: int, max_context: int = None) -> int:
+    """
+    RAG 增强后的用户消息可用的 token 数
+
+    在系统提示词之外为回复保留 LLM_MAX_OUTPUT_TOKENS，剩余的给用户问题和检索到的知识库文本。
+    """
+    max_context = max_context or get_max_context()
+    reserved_output = min(LLM_MAX_OUTPUT_TOKENS, max_context // 2)
+    return max_context - SAFETY_TOKENS - reserved_output - system_tokens - 2 * MESSAGE_OVERHEAD_TOKENS
+
+
+def output_budget(prompt_tokens: int, max_context: int = None) -> int:
+    """根据输入 token 数计算可用的生成长度（max_tokens）"""
+    max_context = max_context or get_max_context()
+    available = max_context - prompt_tokens - SAFETY_TOKENS
+    return max(LLM_MIN_OUTPUT_TOKENS, min(available, LLM_MAX_OUTPUT_TOKENS))
+
+
+def get_budget_info() -> dict:
+    return {
+        "max_context": get_max_context(),
+        "max_context_source": _max_context_source,
+        "max_output_tokens": LLM_MAX_OUTPUT_TOKENS,
+        "tokenizer": LLM_TOKENIZER_PATH if get_tokenizer() is not None else None,
+        "ready": _tokenizer_loaded and _max_context is not None,
+    }
+
+
+def warmup():
+    """后台预热：加载分词器并解析上下文长度，避免第一个对话请求承担这些耗时"""
+    get_tokenizer()
+    get_max_context()
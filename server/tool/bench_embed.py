@@ -0,0 +1,197 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+嵌入后端基准测试：torch（sentence-transformers）与 ONNX Runtime（fp32 / int8）
+
+每个后端在独立子进程中运行（走 RAGService.initialize_models 的实际加载路径），统计：
+    加载耗时、进程峰值内存
+    查询延迟     单条 embed_query 的中位数 / p95
+    重建吞吐     embed_documents 对知识库文本块的向量化速度（块/秒）
+与 torch 输出对比的兼容性：
+    余弦相似度   同一文本两种后端向量的最小值 / 平均值（EMBED_ONNX_MIN_COSINE 为启用门槛）
+    top-k 一致率 用该后端的查询向量检索 torch 的文本块向量（即现有索引），
+                 与 torch 查询向量检索结果的重合比例
+
+文本取自知识库（与构建索引相同的分割方式），查询为从文本块中抽取的句子。
+
+用法（在 server 目录下运行，需要 torch、onnxruntime；首次运行 ONNX 后端时会导出模型）：
+    python tool/bench_embed.py
+    python tool/bench_embed.py --docs 2000 --threads 4 --json embed.json
+    python tool/bench_embed.py --backends torch,onnx-int8 --k 5
+"""
+
+import argparse
+import json
+import os
+import random
+import re
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+SENTENCE_RE = re.compile(r"[^。！？!?\n]{12,80}[。！？!?]?")
+
+BACKEND_ENV = {
+    "torch": {"EMBED_BACKEND": "torch"},
+    "onnx": {"EMBED_BACKEND": "onnx", "EMBED_ONNX_QUANTIZE": "none"},
+    "onnx-int8": {"EMBED_BACKEND": "onnx", "EMBED_ONNX_QUANTIZE": "int8"},
+}
+
+
+def percentile(values, p: float) -> float:
+    ordered = sorted(values)
+    return ordered[max(0, int(len(ordered) * p) - 1)]
+
+
+def load_texts(n_docs: int, n_queries: int, seed: int = 0):
+    """知识库文本块（前 n_docs 个）和从中抽取的查询句子"""
+    from simple_rag import SimpleRAGService
+
+    docs = [text for _, text in SimpleRAGService().load_documents()][:n_docs]
+    rng = random.Random(seed)
+    queries = []
+    for text in rng.sample(docs, len(docs)):
+        sentences = SENTENCE_RE.findall(text)
+        if sentences:
+            queries.append(sentences[len(sentences) // 2].strip())
+        if len(queries) >= n_queries:
+            break
+    return docs, queries
+
+
+def worker(args):
+    """子进程：加载一个后端，测量延迟和吞吐，向量写入 args.out"""
+    import numpy as np
+    from rag_service import RAGService
+
+    with open(args.texts, "r", encoding="utf-8") as f:
+        texts = json.load(f)
+    docs, queries = texts["docs"], texts["queries"]
+
+    start = time.perf_counter()
+    service = RAGService()
+    if not service.initialize_models():
+        sys.exit("嵌入模型加载失败")
+    load_seconds = time.perf_counter() - start
+    model = service.embed_model
+
+    model.embed_query(queries[0])  # 预热
+    latencies, query_vectors = [], []
+    for query in queries:
+        start = time.perf_counter()
+        query_vectors.append(model.embed_query(query))
+        latencies.append((time.perf_counter() - start) * 1000)
+
+    start = time.perf_counter()
+    doc_vectors = model.embed_documents(docs)
+    embed_seconds = time.perf_counter() - start
+
+    np.savez(args.out, queries=np.asarray(query_vectors, dtype="float32"),
+             docs=np.asarray(doc_vectors, dtype="float32"))
+    print(json.dumps({
+        "backend": service.embed_backend,
+        "load_seconds": round(load_seconds, 2),
+        "query_median_ms": round(statistics.median(latencies), 2),
+        "query_p95_ms": round(percentile(latencies, 0.95), 2),
+        "docs_per_second": round(len(docs) / embed_seconds, 1) if embed_seconds else None,
+        "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+    }))
+
+
+def run_backend(name: str, args, texts_path: str, out_path: str):
+    env = dict(os.environ, **BACKEND_ENV[name])
+    if args.threads:
+        env["EMBED_THREADS"] = env["EMBED_ONNX_THREADS"] = str(args.threads)
+    if args.batch_size:
+        env["EMBED_BATCH_SIZE"] = str(args.batch_size)
+    proc = subprocess.run([sys.executable, __file__, "--worker", "--texts", texts_path, "--out", out_path],
+                          env=env, capture_output=True, text=True)
+    if proc.returncode != 0:
+        print(proc.stdout + proc.stderr)
+        sys.exit(f"后端 {name} 运行失败")
+    return json.loads(proc.stdout.strip().splitlines()[-1])
+
+
+def compare(vectors: dict, reference: dict, k: int) -> dict:
+    """与 torch 向量的余弦相似度，以及检索 torch 文本块向量时的 top-k 一致率"""
+    import numpy as np
+    from onnx_embeddings import cosine_agreement
+
+    cosine = cosine_agreement(np.vstack([vectors["queries"], vectors["docs"]]),
+                              np.vstack([reference["queries"], reference["docs"]]))
+    k = min(k, len(reference["docs"]))
+    top = np.argsort(-vectors["queries"] @ reference["docs"].T, axis=1)[:, :k]
+    top_ref = np.argsort(-reference["queries"] @ reference["docs"].T, axis=1)[:, :k]
+    overlap = [len(set(a) & set(b)) / k for a, b in zip(top.tolist(), top_ref.tolist())]
+    return {**cosine, "topk_agreement": round(statistics.mean(overlap), 4)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="嵌入后端（torch / ONNX / ONNX int8）延迟、吞吐与一致性基准测试")
+    parser.add_argument("--backends", default="torch,onnx,onnx-int8", help="逗号分隔：torch,onnx,onnx-int8")
+    parser.add_argument("--docs", type=int, default=1000, help="用于吞吐测试的文本块数")
+    parser.add_argument("--queries", type=int, default=100, help="查询数")
+    parser.add_argument("--k", type=int, default=3, help="top-k 一致率的 k")
+    parser.add_argument("--threads", type=int, default=0, help="推理线程数（EMBED_THREADS / EMBED_ONNX_THREADS）")
+    parser.add_argument("--batch-size", type=int, default=0, help="向量化批大小（默认同 EMBED_BATCH_SIZE）")
+    parser.add_argument("--json", help="把结果写入 JSON 文件，便于跟踪")
+    parser.add_argument("--worker", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--texts", help=argparse.SUPPRESS)
+    parser.add_argument("--out", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        worker(args)
+        return
+
+    import numpy as np
+
+    backends = [name.strip() for name in args.backends.split(",") if name.strip()]
+    unknown = [name for name in backends if name not in BACKEND_ENV]
+    if unknown:
+        sys.exit(f"未知后端: {', '.join(unknown)}")
+    if "torch" not in backends:
+        backends.insert(0, "torch")  # 一致性以 torch 输出为基准
+
+    docs, queries = load_texts(args.docs, args.queries)
+    if not docs or not queries:
+        sys.exit("知识库中没有可用的文本")
+
+    print(f"文本块 {len(docs)} 个，查询 {len(queries)} 条，线程数 {args.threads or '默认'}")
+    print(f"{'后端':>10}{'加载s':>8}{'查询ms':>9}{'p95':>8}{'块/秒':>9}{'内存MB':>9}"
+          f"{'最低余弦':>10}{'平均余弦':>10}{f'top{args.k}一致':>10}")
+    report = {"docs": len(docs), "queries": len(queries), "k": args.k, "threads": args.threads, "results": []}
+    with tempfile.TemporaryDirectory() as tmp:
+        texts_path = os.path.join(tmp, "texts.json")
+        with open(texts_path, "w", encoding="utf-8") as f:
+            json.dump({"docs": docs, "queries": queries}, f, ensure_ascii=False)
+
+        reference = None
+        for name in backends:
+            out_path = os.path.join(tmp, f"{name}.npz")
+            result = run_backend(name, args, texts_path, out_path)
+            vectors = dict(np.load(out_path))
+            if name == "torch":
+                reference = vectors
+            result.update(name=name, **compare(vectors, reference, args.k))
+            report["results"].append(result)
+            print(f"{name:>10}{result['load_seconds']:>8.2f}{result['query_median_ms']:>9.2f}"
+                  f"{result['query_p95_ms']:>8.2f}{result['docs_per_second']:>9.1f}{result['peak_rss_mb']:>9.1f}"
+                  f"{result['min_cosine']:>10.4f}{result['mean_cosine']:>10.4f}{result['topk_agreement']:>10.3f}")
+            if result["backend"] != name and name != "torch":
+                print(f"{'':>10}注意：实际使用的后端为 {result['backend']}（ONNX 不可用或校验未通过）")
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"\n结果已写入 {args.json}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+共享嵌入服务并发基准测试：多个并发客户端的查询向量吞吐与延迟
+
+对比两种方式（相同的并发线程数、相同的查询）：
+    local   本进程加载的嵌入模型，每个请求单独计算（未开启 EMBED_SERVER 时的行为）
+    server  共享嵌入服务（UNIX socket），并发请求在服务端合并成批
+输出每秒查询数、延迟中位数 / p95，以及服务端的平均批大小。
+查询互不相同（带序号），避免命中服务端的同批去重。
+
+用法（在 server 目录下运行；服务未运行时自动启动）：
+    python tool/bench_embed_server.py --concurrency 1,8,32
+    python tool/bench_embed_server.py --requests 2000 --skip-local
+"""
+
+import argparse
+import statistics
+import sys
+import threading
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import embed_server  # noqa: E402
+
+QUERIES = [
+    "航母编队的远海训练通常包括哪些科目？",
+    "导弹防御系统如何影响区域战略平衡",
+    "无人机在现代冲突中的作用",
+    "What are the main roles of a destroyer in a carrier strike group?",
+    "边境地区兵力部署的最新动态",
+]
+
+
+def percentile(values, p: float) -> float:
+    ordered = sorted(values)
+    return ordered[max(0, int(len(ordered) * p) - 1)]
+
+
+def run(model, concurrency: int, requests: int) -> dict:
+    latencies = []
+    lock = threading.Lock()
+    counter = iter(range(requests))
+
+    def worker():
+        while True:
+            with lock:
+                n = next(counter, None)
+            if n is None:
+                return
+            start = time.perf_counter()
+            model.embed_query(f"{QUERIES[n % len(QUERIES)]} {n}")
+            elapsed = (time.perf_counter() - start) * 1000
+            with lock:
+                latencies.append(elapsed)
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    seconds = time.perf_counter() - start
+    return {
+        "qps": round(requests / seconds, 1),
+        "median_ms": round(statistics.median(latencies), 2),
+        "p95_ms": round(percentile(latencies, 0.95), 2),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="共享嵌入服务并发吞吐/延迟基准测试")
+    parser.add_argument("--concurrency", default="1,8,32", help="逗号分隔的并发线程数")
+    parser.add_argument("--requests", type=int, default=500, help="每种并发下的查询数")
+    parser.add_argument("--skip-local", action="store_true", help="不测试本进程模型")
+    args = parser.parse_args()
+
+    models = []
+    if not args.skip_local:
+        embed_server.EMBED_SERVER = False
+        from rag_service import RAGService
+        service = RAGService()
+        if not service.initialize_models():
+            sys.exit("嵌入模型加载失败")
+        models.append(("local", service.embed_model))
+    if not embed_server.start_server():
+        sys.exit("嵌入服务不可用")
+    client = embed_server.EmbedServerClient()
+    models.append(("server", client))
+
+    print(f"{'方式':>8}{'并发':>6}{'qps':>10}{'中位ms':>10}{'p95ms':>10}{'平均批':>8}")
+    for concurrency in [int(c) for c in args.concurrency.split(",")]:
+        for name, model in models:
+            model.embed_query(QUERIES[0])  # 预热
+            before = client.get_stats()["server"]
+            result = run(model, concurrency, args.requests)
+            avg_batch = "-"
+            if name == "server":
+                after = client.get_stats()["server"]
+                batches = after["batches"] - before["batches"]
+                avg_batch = f"{(after['queries'] - before['queries']) / batches:.1f}" if batches else "-"
+            print(f"{name:>8}{concurrency:>6}{result['qps']:>10.1f}{result['median_ms']:>10.2f}"
+                  f"{result['p95_ms']:>10.2f}{avg_batch:>8}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+FAISS 索引召回率/延迟基准测试
+
+对比 flat / IVF / HNSW 以及 SQ8 / PQ 量化在同一批向量上的
+recall@k（以精确 Flat 检索为基准）、单条查询延迟和索引大小，
+用于选择 RAG_INDEX_TYPE / RAG_INDEX_QUANT / RAG_IVF_NPROBE / RAG_HNSW_EF_SEARCH。
+
+用法：
+    python tool/bench_index.py                         # 合成数据（聚类分布）
+    python tool/bench_index.py --index-dir vector_db/versions/index-xxx   # 使用现有 flat 索引中的向量
+    python tool/bench_index.py --vectors vectors.npy --k 3
+"""
+
+import argparse
+import time
+
+import numpy as np
+import faiss
+
+
+def synthetic_vectors(n: int, dim: int, clusters: int = 64, seed: int = 0):
+    """生成带聚类结构的向量，比均匀随机数据更接近真实文本向量"""
+    rng = np.random.default_rng(seed)
+    centers = rng.normal(size=(clusters, dim)).astype("float32")
+    labels = rng.integers(0, clusters, size=n)
+    vectors = centers[labels] + 0.3 * rng.normal(size=(n, dim)).astype("float32")
+    faiss.normalize_L2(vectors)
+    return vectors
+
+
+def load_vectors(args):
+    if args.vectors:
+        return np.load(args.vectors).astype("float32")
+    if args.index_dir:
+        index = faiss.read_index(f"{args.index_dir}/index.faiss")
+        return index.reconstruct_n(0, index.ntotal)
+    return synthetic_vectors(args.n, args.dim)
+
+
+def make_queries(vectors, nq: int, seed: int = 1):
+    """从库中抽样并加噪声作为查询"""
+    rng = np.random.default_rng(seed)
+    picks = rng.choice(len(vectors), size=min(nq, len(vectors)), replace=False)
+    queries = vectors[picks] + 0.05 * rng.normal(size=(len(picks), vectors.shape[1])).astype("float32")
+    return queries.astype("float32")
+
+
+def configs(n: int, dim: int, pq_m: int):
+    """待测试的索引配置：(名称, factory 描述串, 检索参数列表)"""
+    nlist = max(2, min(int(4 * n ** 0.5), n // 39))
+    items = [
+        ("flat", "Flat", [None]),
+        ("flat+sq8", "SQ8", [None]),
+        ("ivf", f"IVF{nlist},Flat", [("nprobe", p) for p in (1, 4, 16, 64) if p <= nlist]),
+        ("ivf+sq8", f"IVF{nlist},SQ8", [("nprobe", p) for p in (4, 16, 64) if p <= nlist]),
+        ("hnsw", "HNSW32", [("efSearch", ef) for ef in (16, 64, 256)]),
+        ("hnsw+sq8", "HNSW32_SQ8", [("efSearch", ef) for ef in (16, 64, 256)]),
+    ]
+    if dim % pq_m == 0 and n >= 256:
+        items.insert(2, ("flat+pq", f"PQ{pq_m}", [None]))
+        items.append(("ivf+pq", f"IVF{nlist},PQ{pq_m}", [("nprobe", p) for p in (4, 16, 64) if p <= nlist]))
+    return items
+
+
+def recall(found, truth):
+    k = truth.shape[1]
+    hits = sum(len(set(f[:k]) & set(t)) for f, t in zip(found, truth))
+    return hits / truth.size
+
+
+def bench(vectors, queries, k: int, pq_m: int):
+    n, dim = vectors.shape
+    exact = faiss.IndexFlatL2(dim)
+    exact.add(vectors)
+    _, truth = exact.search(queries, k)
+
+    print(f"向量数 {n}，维度 {dim}，查询数 {len(queries)}，k={k}")
+    print(f"{'配置':<22}{'参数':<16}{'recall@k':>10}{'平均ms':>10}{'p95 ms':>10}{'大小MB':>10}{'构建s':>10}")
+
+    for name, description, param_list in configs(n, dim, pq_m):
+        start = time.time()
+        index = faiss.index_factory(dim, description)
+        if not index.is_trained:
+            index.train(vectors)
+        index.add(vectors)
+        build_seconds = time.time() - start
+        size_mb = faiss.serialize_index(index).nbytes / 1024 / 1024
+
+        for param in param_list:
+            if param:
+                faiss.ParameterSpace().set_index_parameter(index, param[0], param[1])
+            latencies = []
+            found = []
+            # 逐条查询，模拟线上单请求检索
+            for query in queries:
+                t0 = time.perf_counter()
+                _, ids = index.search(query.reshape(1, -1), k)
+                latencies.append((time.perf_counter() - t0) * 1000)
+                found.append(ids[0])
+            label = f"{param[0]}={param[1]}" if param else "-"
+            print(f"{name:<22}{label:<16}{recall(found, truth):>10.3f}"
+                  f"{np.mean(latencies):>10.3f}{np.percentile(latencies, 95):>10.3f}"
+                  f"{size_mb:>10.1f}{build_seconds:>10.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="FAISS 索引召回率/延迟基准测试")
+    parser.add_argument("--n", type=int, default=50000, help="合成向量数")
+    parser.add_argument("--dim", type=int, default=512, help="合成向量维度")
+    parser.add_argument("--vectors", help="从 .npy 文件读取向量")
+    parser.add_argument("--index-dir", help="从现有 flat 索引目录读取向量")
+    parser.add_argument("--queries", type=int, default=500, help="查询数")
+    parser.add_argument("--k", type=int, default=3, help="top-k（与检索器一致，默认 3）")
+    parser.add_argument("--pq-m", type=int, default=16, help="PQ 子向量数")
+    parser.add_argument("--threads", type=int, default=1, help="faiss 线程数（线上为单请求检索，默认 1）")
+    args = parser.parse_args()
+
+    faiss.omp_set_num_threads(args.threads)
+    vectors = load_vectors(args)
+    queries = make_queries(vectors, args.queries)
+    bench(vectors, queries, args.k, args.pq_m)
+
+
+if __name__ == "__main__":
+    main()
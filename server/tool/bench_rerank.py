@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+重排序候选数基准测试：检索 + 交叉编码器重排序的延迟与召回率
+
+对每个候选数（RERANK_CANDIDATES）统计：
+    候选召回率     相关文本块出现在检索候选中的比例（重排序能达到的上限）
+    最终召回率     相关文本块出现在重排序、阈值过滤后保留的文本块中的比例
+    检索/重排序耗时（重排序不使用打分缓存，即首次查询的耗时）
+    保留块数、保留文本的 token 数（进入提示词的知识库文本）
+第一行为不重排序的基线（直接取检索前 top-k）。
+
+评测集：--queries 指定 JSONL 文件，每行 {"query": "...", "relevant": ["块ID", ...]}；
+不指定时从当前索引中抽样文本块，取其中一句作为查询，该文本块即相关文本块。
+
+用法（在 server 目录下运行，需要嵌入模型、已构建的索引和重排序模型）：
+    python tool/bench_rerank.py
+    python tool/bench_rerank.py --candidates 10,20,30,50 --threshold 0.3 --json rerank.json
+    python tool/bench_rerank.py --queries eval.jsonl --model BAAI/bge-reranker-base
+"""
+
+import argparse
+import json
+import random
+import re
+import statistics
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import reranker as reranker_module  # noqa: E402
+from rag_service import RAGService  # noqa: E402
+from token_budget import count_tokens  # noqa: E402
+
+SENTENCE_RE = re.compile(r"[^。！？!?\n]{12,80}[。！？!?]?")
+
+
+def load_queries(path: str):
+    queries = []
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                item = json.loads(line)
+                queries.append((item["query"], set(item["relevant"])))
+    return queries
+
+
+def sample_queries(service: RAGService, n: int, seed: int = 0):
+    """从索引中抽样文本块，取中间的一句作为查询"""
+    vector_store = service.vector_store
+    ids = list(vector_store.index_to_docstore_id.values())
+    rng = random.Random(seed)
+    queries = []
+    for chunk_id in rng.sample(ids, min(len(ids), n * 3)):
+        doc = vector_store.docstore.search(chunk_id)
+        if isinstance(doc, str):
+            continue
+        sentences = SENTENCE_RE.findall(doc.page_content)
+        if not sentences:
+            continue
+        queries.append((sentences[len(sentences) // 2].strip(), {doc.metadata.get("chunk_id") or chunk_id}))
+        if len(queries) >= n:
+            break
+    return queries
+
+
+def percentile(values, p: float) -> float:
+    ordered = sorted(values)
+    return ordered[max(0, int(len(ordered) * p) - 1)]
+
+
+def run(service: RAGService, reranker, queries, candidates: int, top_k: int, threshold: float):
+    """candidates 为 0 时不重排序，直接取检索前 top_k 个"""
+    retrieve_ms, rerank_ms, kept_counts, kept_tokens = [], [], [], []
+    candidate_hits = final_hits = 0
+    reranker.score_cache.clear()
+    service.retrieval_cache.clear()
+    for query, relevant in queries:
+        start = time.perf_counter()
+        docs = service.retrieve_relevant_docs(query, k=candidates or top_k)
+        retrieve_ms.append((time.perf_counter() - start) * 1000)
+        chunks = [(doc.metadata.get("chunk_id", ""), doc.page_content) for doc in docs]
+        candidate_hits += any(chunk_id in relevant for chunk_id, _ in chunks)
+
+        if candidates:
+            start = time.perf_counter()
+            kept = [(chunk_id, text) for chunk_id, text, _ in
+                    reranker.rerank(query, chunks, service.index_version, top_k=top_k, threshold=threshold)]
+            rerank_ms.append((time.perf_counter() - start) * 1000)
+        else:
+            kept = chunks[:top_k]
+        final_hits += any(chunk_id in relevant for chunk_id, _ in kept)
+        kept_counts.append(len(kept))
+        kept_tokens.append(sum(count_tokens(text) for _, text in kept))
+
+    total = len(queries)
+    return {
+        "candidates": candidates,
+        "candidate_recall": round(candidate_hits / total, 3),
+        "final_recall": round(final_hits / total, 3),
+        "retrieve_median_ms": round(statistics.median(retrieve_ms), 2),
+        "rerank_median_ms": round(statistics.median(rerank_ms), 2) if rerank_ms else 0.0,
+        "rerank_p95_ms": round(percentile(rerank_ms, 0.95), 2) if rerank_ms else 0.0,
+        "mean_kept": round(statistics.mean(kept_counts), 2),
+        "mean_kept_tokens": round(statistics.mean(kept_tokens), 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="重排序候选数的延迟/召回率基准测试")
+    parser.add_argument("--queries", help="评测集 JSONL：{\"query\", \"relevant\": [块ID]}")
+    parser.add_argument("--n", type=int, default=100, help="未指定评测集时抽样的查询数")
+    parser.add_argument("--candidates", default="10,20,30,50", help="逗号分隔的候选数")
+    parser.add_argument("--top-k", type=int, default=reranker_module.RERANK_TOP_K, help="最多保留的文本块数")
+    parser.add_argument("--threshold", type=float, default=reranker_module.RERANK_THRESHOLD, help="得分下限")
+    parser.add_argument("--model", help="重排序模型（默认同 RERANK_MODEL）")
+    parser.add_argument("--json", help="把结果写入 JSON 文件，便于跟踪")
+    args = parser.parse_args()
+
+    if args.model:
+        reranker_module.RERANK_MODEL = args.model
+    service = RAGService()
+    if not service.initialize_models() or not service.load_vector_store():
+        sys.exit("嵌入模型或向量索引不可用，请先构建索引")
+    reranker = reranker_module.Reranker()
+    if not reranker.load():
+        sys.exit("重排序模型不可用")
+
+    queries = load_queries(args.queries) if args.queries else sample_queries(service, args.n)
+    if not queries:
+        sys.exit("没有可用的查询")
+    # 预热：首次推理包含内存分配等开销
+    reranker.score(queries[0][0], [("warmup", queries[0][0])])
+
+    print(f"查询 {len(queries)} 条，top_k={args.top_k}，阈值 {args.threshold}，模型 {reranker.model_name}")
+    print(f"{'候选数':>8}{'候选召回':>10}{'最终召回':>10}{'检索ms':>10}{'重排ms':>10}"
+          f"{'重排p95':>10}{'保留块数':>10}{'保留tokens':>12}")
+    report = {"queries": len(queries), "top_k": args.top_k, "threshold": args.threshold,
+              "model": reranker.model_name, "results": []}
+    for candidates in [0] + [int(c) for c in args.candidates.split(",")]:
+        result = run(service, reranker, queries, candidates, args.top_k, args.threshold)
+        report["results"].append(result)
+        label = "基线" if not candidates else str(candidates)
+        print(f"{label:>8}{result['candidate_recall']:>10.3f}{result['final_recall']:>10.3f}"
+              f"{result['retrieve_median_ms']:>10.2f}{result['rerank_median_ms']:>10.2f}"
+              f"{result['rerank_p95_ms']:>10.2f}{result['mean_kept']:>10.2f}{result['mean_kept_tokens']:>12.1f}")
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"\n结果已写入 {args.json}")
+
+
+if __name__ == "__main__":
+    main()
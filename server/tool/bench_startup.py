@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+后端启动时间基准测试
+
+测量两项指标，便于跟踪启动性能的变化：
+1. 各模块的导入耗时（每个模块在独立的新进程中导入，避免缓存影响），
+   以及 python -X importtime 统计出的最慢的顶层包
+2. 从启动 uvicorn 到 /test1 首次返回 200 的时间
+
+用法（在 server 目录下运行）：
+    python tool/bench_startup.py
+    python tool/bench_startup.py --runs 5 --json startup.json
+    python tool/bench_startup.py --no-warmup      # 关闭 RAG 后台预热再测
+"""
+
+import argparse
+import json
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import time
+import urllib.request
+from pathlib import Path
+
+SERVER_DIR = Path(__file__).resolve().parent.parent
+MODULES = ["database", "cache_utils", "maintenance_jobs", "index_store", "rag_service", "llm_utils", "routes", "main"]
+
+
+def import_seconds(module: str) -> float:
+    """在新进程中导入模块，返回导入耗时（秒）"""
+    code = f"import time; t = time.perf_counter(); import {module}; print(time.perf_counter() - t)"
+    result = subprocess.run([sys.executable, "-c", code], cwd=SERVER_DIR,
+                            capture_output=True, text=True, timeout=300)
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr.strip().splitlines()[-1] if result.stderr else "导入失败")
+    return float(result.stdout.strip().splitlines()[-1])
+
+
+def slowest_packages(module: str = "main", top: int = 15):
+    """用 -X importtime 统计导入 module 时累计耗时最长的顶层包"""
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"],
+                            cwd=SERVER_DIR, capture_output=True, text=True, timeout=300)
+    packages = {}
+    for line in result.stderr.splitlines():
+        # 格式: "import time:  self_us |  cumulative_us |   package"，表头行跳过
+        parts = line.replace("import time:", "", 1).split("|")
+        if len(parts) != 3 or not parts[1].strip().isdigit():
+            continue
+        name = parts[2].strip()
+        if "." in name:
+            continue
+        packages[name] = max(packages.get(name, 0), int(parts[1]))
+    ranked = sorted(packages.items(), key=lambda item: item[1], reverse=True)[:top]
+    return [(name, us / 1e6) for name, us in ranked]
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def time_to_first_response(warmup: bool, timeout: float = 120) -> float:
+    """启动 uvicorn，轮询 /test1 直到返回 200，返回耗时（秒）"""
+    port = free_port()
+    env = dict(os.environ, RAG_WARMUP="true" if warmup else "false")
+    start = time.perf_counter()
+    process = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--host", "127.0.0.1", "--port", str(port)],
+        cwd=SERVER_DIR, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    try:
+        url = f"http://127.0.0.1:{port}/test1"
+        while time.perf_counter() - start < timeout:
+            if process.poll() is not None:
+                raise RuntimeError(f"uvicorn 进程已退出，返回码 {process.returncode}")
+            try:
+                with urllib.request.urlopen(url, timeout=1) as response:
+                    if response.status == 200:
+                        return time.perf_counter() - start
+            except OSError:
+                pass
+            time.sleep(0.02)
+        raise TimeoutError(f"{timeout} 秒内 /test1 未返回 200")
+    finally:
+        process.terminate()
+        try:
+            process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            process.kill()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="后端启动时间基准测试")
+    parser.add_argument("--runs", type=int, default=3, help="每项测量的重复次数，取中位数")
+    parser.add_argument("--no-warmup", action="store_true", help="启动时关闭 RAG 后台预热")
+    parser.add_argument("--json", help="把结果写入 JSON 文件，便于跟踪")
+    args = parser.parse_args()
+
+    report = {"python": sys.version.split()[0], "imports": {}, "slowest_packages": [], "first_response": None}
+
+    print("模块导入耗时（新进程，中位数）：")
+    for module in MODULES:
+        try:
+            seconds = statistics.median(import_seconds(module) for _ in range(args.runs))
+            report["imports"][module] = round(seconds, 4)
+            print(f"  {module:<18}{seconds * 1000:>10.1f} ms")
+        except Exception as e:
+            report["imports"][module] = None
+            print(f"  {module:<18}{'失败':>10}  {e}")
+
+    print("\n导入 main 时最慢的包（-X importtime 累计耗时）：")
+    for name, seconds in slowest_packages():
+        report["slowest_packages"].append({"package": name, "seconds": round(seconds, 4)})
+        print(f"  {name:<24}{seconds * 1000:>10.1f} ms")
+
+    print(f"\n启动 uvicorn 到 /test1 返回 200（RAG 预热{'关闭' if args.no_warmup else '开启'}）：")
+    try:
+        samples = [time_to_first_response(warmup=not args.no_warmup) for _ in range(args.runs)]
+        report["first_response"] = {"median": round(statistics.median(samples), 4),
+                                    "samples": [round(s, 4) for s in samples]}
+        print(f"  中位数 {statistics.median(samples) * 1000:.0f} ms，样本 "
+              + ", ".join(f"{s * 1000:.0f}" for s in samples))
+    except Exception as e:
+        print(f"  失败: {e}")
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"\n结果已写入 {args.json}")
+
+
+if __name__ == "__main__":
+    main()
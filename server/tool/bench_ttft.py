@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+首 token 延迟（TTFT）基准测试：对比前缀缓存友好布局和原布局
+
+对推理服务依次发送两组 RAG 请求（相同的问题和检索结果，只是提示词布局不同），
+记录从发送请求到收到第一个内容分片的时间；推理服务提供 Prometheus 指标时（vLLM /metrics），
+同时统计每组请求的前缀缓存命中率。
+
+知识库文本块从 KNOWLEDGE_BASE_PATH 读取并按 500 字切分；每个请求从较小的文本块池中
+随机抽取 k 个（模拟热门话题反复检索到相同文本块），并打乱检索名次。
+
+推理服务需开启前缀缓存（vLLM: --enable-prefix-caching），否则两种布局没有差别。
+
+用法（在 server 目录下运行）：
+    python tool/bench_ttft.py
+    python tool/bench_ttft.py --requests 50 --pool 12 --k 3 --json ttft.json
+"""
+
+import argparse
+import json
+import os
+import random
+import re
+import statistics
+import sys
+import time
+from pathlib import Path
+
+import requests
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import prompt_builder  # noqa: E402
+from llm_utils import MILITARY_ANALYST_SYSTEM_PROMPT, _parse_sse_line  # noqa: E402
+from token_budget import count_tokens  # noqa: E402
+
+QUESTIONS = [
+    "请分析该地区当前的军事态势及其对周边国家的影响。",
+    "各方在这一冲突中的战略意图分别是什么？",
+    "结合以上信息，评估未来半年冲突升级的可能性。",
+    "该地区主要国家的联盟关系如何影响危机走向？",
+    "从后勤和补给角度分析各方的持续作战能力。",
+    "请总结相关武器装备的技术特点和作战运用。",
+]
+
+FALLBACK_TEXT = ("该地区近期局势持续紧张，多方在边境附近增加兵力部署，并举行了多次联合军事演习。"
+                 "分析人士认为，各方的战略意图与能源通道、海上航线安全以及区域影响力密切相关。") * 6
+
+METRIC_RE = re.compile(r"^(vllm:prefix_cache_(?:queries|hits)_total)\{[^}]*\}\s+([0-9.eE+]+)", re.M)
+
+
+def load_chunks(kb_path: str, pool: int, chunk_size: int = 500):
+    """读取知识库文本并切分，返回 [(块ID, 文本)]；没有文本文件时使用合成文本"""
+    texts = []
+    for path in sorted(Path(kb_path).rglob("*")) if os.path.isdir(kb_path) else []:
+        if path.suffix in (".txt", ".md"):
+            texts.append(path.read_text(encoding="utf-8", errors="ignore"))
+    if not texts:
+        texts = [FALLBACK_TEXT.replace("该地区", f"第{i}号地区") for i in range(pool)]
+    chunks = []
+    for text in texts:
+        for start in range(0, len(text), chunk_size):
+            piece = text[start:start + chunk_size].strip()
+            if piece:
+                chunks.append((f"{len(chunks):05d}", piece))
+    return chunks[:pool]
+
+
+def make_workload(chunks, n: int, k: int, seed: int = 0):
+    """生成 (问题, 按检索名次排列的文本块) 列表"""
+    rng = random.Random(seed)
+    workload = []
+    for i in range(n):
+        picked = rng.sample(chunks, min(k, len(chunks)))
+        question = f"{QUESTIONS[i % len(QUESTIONS)]}（问题 {i}）"
+        workload.append((question, picked))
+    return workload
+
+
+def build_messages(layout: str, question: str, chunks):
+    prompt_builder.PROMPT_LAYOUT = layout
+    prompt_builder.rag_system_prompt.cache_clear()
+    system_prompt = prompt_builder.rag_system_prompt(MILITARY_ANALYST_SYSTEM_PROMPT)
+    user_content = prompt_builder.rag_user_message(chunks, question)
+    messages, _ = prompt_builder.build_messages(system_prompt, user_content)
+    return messages
+
+
+def time_to_first_token(url: str, model: str, messages, max_tokens: int, timeout: float) -> float:
+    payload = {"model": model, "messages": messages, "max_tokens": max_tokens,
+               "temperature": 0.0, "stream": True}
+    payload.update(prompt_builder.cache_hint_fields(messages))
+    start = time.perf_counter()
+    with requests.post(url, json=payload, stream=True, timeout=timeout) as response:
+        response.raise_for_status()
+        for line in response.iter_lines():
+            if not line:
+                continue
+            done, content = _parse_sse_line(line.decode("utf-8"))
+            if content or done:
+                return time.perf_counter() - start
+    raise RuntimeError("响应中没有内容分片")
+
+
+def prefix_cache_counters(metrics_url: str):
+    """读取 vLLM 前缀缓存计数器 (queries, hits)，不可用时返回 None"""
+    try:
+        text = requests.get(metrics_url, timeout=3).text
+    except requests.RequestException:
+        return None
+    values = {}
+    for name, value in METRIC_RE.findall(text):
+        values[name] = values.get(name, 0) + float(value)
+    if len(values) != 2:
+        return None
+    return values["vllm:prefix_cache_queries_total"], values["vllm:prefix_cache_hits_total"]
+
+
+def run_layout(layout: str, workload, args):
+    before = prefix_cache_counters(args.metrics_url)
+    samples = []
+    prompt_tokens = []
+    for question, chunks in workload:
+        messages = build_messages(layout, question, chunks)
+        prompt_tokens.append(sum(count_tokens(m["content"]) for m in messages))
+        samples.append(time_to_first_token(args.url, args.model, messages, args.max_tokens, args.timeout))
+    after = prefix_cache_counters(args.metrics_url)
+
+    result = {
+        "median_ms": round(statistics.median(samples) * 1000, 1),
+        "p95_ms": round(sorted(samples)[int(len(samples) * 0.95) - 1] * 1000, 1),
+        "mean_ms": round(statistics.mean(samples) * 1000, 1),
+        "mean_prompt_tokens": round(statistics.mean(prompt_tokens)),
+        "prefix_cache_hit_rate": None,
+    }
+    if before and after and after[0] > before[0]:
+        result["prefix_cache_hit_rate"] = round((after[1] - before[1]) / (after[0] - before[0]), 3)
+    return result
+
+
+def main():
+    model_url = os.getenv("LOCAL_MODEL_URL", "http://localhost:8000/v1/chat/completions")
+    parser = argparse.ArgumentParser(description="提示词布局的首 token 延迟基准测试")
+    parser.add_argument("--url", default=model_url, help="chat/completions 接口地址")
+    parser.add_argument("--model", default=os.getenv("LOCAL_MODEL_NAME", ""), help="模型名")
+    parser.add_argument("--metrics-url", default=model_url.split("/v1/")[0] + "/metrics",
+                        help="Prometheus 指标地址（vLLM）")
+    parser.add_argument("--kb", default=os.getenv("KNOWLEDGE_BASE_PATH", "./datasets/data"), help="知识库目录")
+    parser.add_argument("--requests", type=int, default=30, help="每种布局的请求数")
+    parser.add_argument("--pool", type=int, default=12, help="文本块池大小（越小重复检索越多）")
+    parser.add_argument("--k", type=int, default=3, help="每个请求的文本块数（与检索器一致，默认 3）")
+    parser.add_argument("--max-tokens", type=int, default=8, help="生成长度，只测首 token 时可以很小")
+    parser.add_argument("--timeout", type=float, default=120)
+    parser.add_argument("--layouts", default="legacy,prefix", help="按顺序测试的布局")
+    parser.add_argument("--json", help="把结果写入 JSON 文件，便于跟踪")
+    args = parser.parse_args()
+
+    chunks = load_chunks(args.kb, args.pool)
+    workload = make_workload(chunks, args.requests, args.k)
+    print(f"文本块池 {len(chunks)} 个，每种布局 {len(workload)} 个请求，每个请求 {args.k} 个文本块")
+
+    report = {"requests": len(workload), "pool": len(chunks), "k": args.k, "layouts": {}}
+    print(f"{'布局':<10}{'中位数ms':>12}{'p95 ms':>12}{'平均ms':>12}{'输入tokens':>12}{'前缀命中率':>12}")
+    for layout in args.layouts.split(","):
+        result = run_layout(layout.strip(), workload, args)
+        report["layouts"][layout] = result
+        hit_rate = "-" if result["prefix_cache_hit_rate"] is None else f"{result['prefix_cache_hit_rate']:.1%}"
+        print(f"{layout:<10}{result['median_ms']:>12.1f}{result['p95_ms']:>12.1f}{result['mean_ms']:>12.1f}"
+              f"{result['mean_prompt_tokens']:>12}{hit_rate:>12}")
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"\n结果已写入 {args.json}")
+
+
+if __name__ == "__main__":
+    main()
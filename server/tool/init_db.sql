@@ -1,3 +1,5 @@
+-- 新建数据库时执行（当前完整表结构）；已有数据库按顺序执行 tool/migrations/ 下尚未执行的迁移
+
 -- 创建数据库（如果还没有）
 CREATE DATABASE IF NOT EXISTS ai_chat CHARACTER SET utf8mb4 COLLATE utf8mb4_unicode_ci;
 
@@ -8,7 +10,8 @@ USE ai_chat;
 CREATE TABLE subject (
     id INT AUTO_INCREMENT PRIMARY KEY,
     title VARCHAR(255) NOT NULL COMMENT '主题标题',
-    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP COMMENT '创建时间'
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP COMMENT '创建时间',
+    INDEX idx_subject_created_id (created_at, id)
 ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
 
 -- 创建 chatcontent 表（聊天消息）
@@ -17,9 +20,15 @@ CREATE TABLE chatcontent (
     subjectid INT NOT NULL COMMENT '关联主题ID',
     content TEXT NOT NULL COMMENT '消息内容（支持[附件]标记）',
     role ENUM('user', 'assistant') NOT NULL COMMENT '角色：用户或AI助手',
+    status ENUM('complete', 'streaming', 'interrupted') NOT NULL DEFAULT 'complete' COMMENT '回复状态：完整 / 生成中 / 中断',
+    stream_id CHAR(32) NULL COMMENT '流式回复ID（断线续传）',
+    wal_id CHAR(32) NULL COMMENT '消息 WAL 记录ID（回放去重）',
     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP COMMENT '创建时间',
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP COMMENT '最近更新时间',
     FOREIGN KEY (subjectid) REFERENCES subject(id) ON DELETE CASCADE,
-    INDEX idx_subjectid (subjectid)
+    INDEX idx_chatcontent_subject_id (subjectid, id),
+    UNIQUE KEY uk_chatcontent_stream (stream_id),
+    UNIQUE KEY uk_chatcontent_wal (wal_id)
 ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
 
 -- 显示表结构确认
@@ -0,0 +1,19 @@
+-- 迁移 001：聊天记录 / 主题列表键集分页索引
+-- 适用于按旧版 init_db.sql 建立的数据库，只需执行一次：
+--   mysql -u root -p ai_chat < tool/migrations/001_pagination_indexes.sql
+
+USE ai_chat;
+
+-- chatcontent(subjectid, id)：按主题取最新/更早消息时直接在索引上范围扫描并排序，
+-- 不再需要 filesort；同时满足 subjectid 外键对索引的要求，可替换原 idx_subjectid
+ALTER TABLE chatcontent
+    ADD INDEX idx_chatcontent_subject_id (subjectid, id),
+    DROP INDEX idx_subjectid;
+
+-- subject(created_at, id)：主题列表按 (created_at, id) 倒序分页
+ALTER TABLE subject
+    ADD INDEX idx_subject_created_id (created_at, id);
+
+-- 确认索引
+SHOW INDEX FROM chatcontent;
+SHOW INDEX FROM subject;
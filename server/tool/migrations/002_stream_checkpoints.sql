@@ -0,0 +1,19 @@
+-- 迁移 002：流式回复检查点与断线续传
+-- 适用于按旧版 init_db.sql 建立的数据库，只需执行一次：
+--   mysql -u root -p ai_chat < tool/migrations/002_stream_checkpoints.sql
+
+USE ai_chat;
+
+-- status：生成中的回复按检查点写入同一行（streaming），结束时标记为 complete / interrupted
+-- stream_id：/stream 响应头 X-Stream-Id，断线后按它续传；普通消息为 NULL（唯一索引允许多个 NULL）
+-- updated_at：最近一次检查点时间，续传时据此判断生成进程是否已退出
+ALTER TABLE chatcontent
+    ADD COLUMN status ENUM('complete', 'streaming', 'interrupted') NOT NULL DEFAULT 'complete'
+        COMMENT '回复状态：完整 / 生成中 / 中断' AFTER role,
+    ADD COLUMN stream_id CHAR(32) NULL COMMENT '流式回复ID（断线续传）' AFTER status,
+    ADD COLUMN updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP
+        COMMENT '最近更新时间' AFTER created_at,
+    ADD UNIQUE KEY uk_chatcontent_stream (stream_id);
+
+-- 确认表结构
+DESCRIBE chatcontent;
@@ -0,0 +1,14 @@
+-- 迁移 003：消息 WAL 记录ID
+-- 适用于按旧版 init_db.sql 建立的数据库，只需执行一次：
+--   mysql -u root -p ai_chat < tool/migrations/003_message_wal_id.sql
+
+USE ai_chat;
+
+-- wal_id：写后持久化时每条消息的 WAL 记录ID，启动回放时按它去重（精确到条，不受同一秒内重复内容影响）
+-- 直接写入的消息为 NULL（唯一索引允许多个 NULL）
+ALTER TABLE chatcontent
+    ADD COLUMN wal_id CHAR(32) NULL COMMENT '消息 WAL 记录ID（回放去重）' AFTER stream_id,
+    ADD UNIQUE KEY uk_chatcontent_wal (wal_id);
+
+-- 确认表结构
+DESCRIBE chatcontent;